@@ -4,6 +4,7 @@ Miscellaneous routines needed by yamcmc.
 __author__ = 'Brandon C. Kelly'
 
 import numpy as np
+from scipy.special import ndtri
 
 def cholupdate_r1(L, v, downdate):
     """
@@ -33,5 +34,260 @@ def cholupdate_r1(L, v, downdate):
             v[k + 1:] = c * v[k + 1:] - s * L[k, k + 1:]
 
 
+def _as_chains(chains):
+    # view the samples as an array of shape (nchains, nsamples, nvariables)
+    chains = np.asarray(chains, dtype=float)
+    if chains.ndim == 1:
+        chains = chains[np.newaxis]
+    return chains.reshape(chains.shape[:2] + (-1,))
 
 
+def autocovariance(chains):
+    """
+    Compute the autocovariance function of each variable in each chain, using the fast fourier transform. All of the
+    chains and variables are transformed in a single batched call.
+
+    :param chains: The samples, an array of shape (nchains, nsamples, ...). A single chain may also be supplied as an
+                   array of shape (nsamples,).
+    :return: The autocovariances at lags 0, ..., nsamples - 1, an array of shape (nchains, nsamples, nvariables).
+    """
+    chains = _as_chains(chains)
+    nsamples = chains.shape[1]
+    centered = chains - chains.mean(axis=1)[:, np.newaxis]
+    # pad with zeros to avoid the circular correlation, up to a fast size for the fft
+    nfft = 2 ** int(np.ceil(np.log2(2 * nsamples)))
+    transform = np.fft.rfft(centered, n=nfft, axis=1)
+    acov = np.fft.irfft(transform.real ** 2 + transform.imag ** 2, n=nfft, axis=1)[:, :nsamples]
+    return acov / nsamples
+
+
+def autocorrelation(chains, maxlag=None):
+    """
+    Compute the autocorrelation function of each variable in each chain, using the fast fourier transform.
+
+    :param chains: The samples, an array of shape (nchains, nsamples, ...), or (nsamples,) for a single chain.
+    :param maxlag: The largest lag to return. If None then all lags are returned.
+    :return: The autocorrelations at lags 0, ..., maxlag, an array of shape (nchains, maxlag + 1, nvariables).
+    """
+    acov = autocovariance(chains)
+    if maxlag is not None:
+        acov = acov[:, :maxlag + 1]
+    variance = acov[:, :1]
+    return acov / np.where(variance > 0, variance, 1.0)
+
+
+def autocorr_timescale(chains):
+    """
+    Compute the integrated autocorrelation time of each variable, combining the information of all chains. The
+    autocorrelations are summed with Geyer's initial monotone sequence estimator: the sums of pairs of consecutive
+    autocorrelations are truncated at the first negative pair, and forced to be decreasing. See Vehtari et al. (2021),
+    Bayesian Analysis, 16, 667.
+
+    :param chains: The samples, an array of shape (nchains, nsamples, ...), or (nsamples,) for a single chain.
+    :return: The autocorrelation time of each variable, an array of size nvariables.
+    """
+    chains = _as_chains(chains)
+    nchains, nsamples = chains.shape[:2]
+    acov = autocovariance(chains)
+    within = acov[:, 0].mean(axis=0) * nsamples / (nsamples - 1.0)  # mean of the within-chain variances
+    var_plus = within * (nsamples - 1.0) / nsamples
+    if nchains > 1:
+        var_plus += chains.mean(axis=1).var(axis=0, ddof=1)
+    var_plus[var_plus == 0] = 1.0  # constant variables have no autocorrelation
+    rho = 1.0 - (within - acov.mean(axis=0)) / var_plus
+    rho[0] = 1.0
+
+    # sums of pairs of autocorrelations at lags (0, 1), (2, 3), ...
+    npairs = nsamples // 2
+    pairs = rho[:2 * npairs:2] + rho[1:2 * npairs:2]
+    positive = np.cumprod(pairs > 0, axis=0).astype(bool)  # truncate at the first negative pair
+    pairs = np.minimum.accumulate(np.where(positive, pairs, 0.0), axis=0)
+    tau = -1.0 + 2.0 * pairs.sum(axis=0)
+    # the estimate is at least 1 / log10(nsamples), as in the reference
+    return np.maximum(tau, 1.0 / np.log10(max(nchains * nsamples, 10)))
+
+
+def effective_samples(chains):
+    """
+    Compute the effective number of independent samples of each variable, combining the information of all chains.
+
+    :param chains: The samples, an array of shape (nchains, nsamples, ...), or (nsamples,) for a single chain.
+    :return: The effective number of samples of each variable, an array of size nvariables.
+    """
+    chains = _as_chains(chains)
+    return chains.shape[0] * chains.shape[1] / autocorr_timescale(chains)
+
+
+def _rank_normalize(chains):
+    # replace the samples by the normal quantiles of their ranks among the samples of all chains. tied samples, e.g.,
+    # from rejected Metropolis-Hastings proposals, get their average rank.
+    nchains, nsamples, nvariables = chains.shape
+    ntotal = nchains * nsamples
+    samples = chains.reshape(ntotal, nvariables)
+    order = np.argsort(samples, axis=0, kind='mergesort')
+    columns = np.arange(nvariables)
+    ordered = samples[order, columns]
+    position = np.arange(ntotal)[:, np.newaxis]
+    starts = np.ones(ordered.shape, dtype=bool)
+    starts[1:] = ordered[1:] != ordered[:-1]
+    ends = np.ones(ordered.shape, dtype=bool)
+    ends[:-1] = starts[1:]
+    first = np.maximum.accumulate(np.where(starts, position, 0), axis=0)
+    last = np.minimum.accumulate(np.where(ends, position, ntotal - 1)[::-1], axis=0)[::-1]
+    ranks = np.empty(samples.shape)
+    ranks[order, columns] = 0.5 * (first + last) + 1.0
+    return ndtri((ranks - 0.375) / (ntotal + 0.25)).reshape(chains.shape)
+
+
+def _rhat(chains):
+    nsamples = chains.shape[1]
+    within = chains.var(axis=1, ddof=1).mean(axis=0)
+    between = nsamples * chains.mean(axis=1).var(axis=0, ddof=1)
+    var_plus = (nsamples - 1.0) / nsamples * within + between / nsamples
+    return np.sqrt(var_plus / within)
+
+
+def split_rhat(chains):
+    """
+    Compute the rank-normalized split-R-hat convergence diagnostic of each variable. Each chain is split in half, and
+    the potential scale reduction factor is computed from the rank-normalized samples and from the rank-normalized
+    absolute deviations from the median, and the larger of the two is returned. Values larger than about 1.01 indicate
+    that the chains have not converged. See Vehtari et al. (2021), Bayesian Analysis, 16, 667.
+
+    :param chains: The samples, an array of shape (nchains, nsamples, ...), or (nsamples,) for a single chain.
+    :return: The split-R-hat of each variable, an array of size nvariables.
+    """
+    chains = _as_chains(chains)
+    half = chains.shape[1] // 2
+    if half < 2:
+        raise ValueError("Need at least 4 samples per chain to compute split-R-hat.")
+    split = np.concatenate([chains[:, :half], chains[:, -half:]])
+    folded = np.abs(split - np.median(split.reshape(-1, split.shape[2]), axis=0))
+    return np.maximum(_rhat(_rank_normalize(split)), _rhat(_rank_normalize(folded)))
+
+
+class RunningSummary(object):
+    """
+    Online summaries of a set of random variables, e.g., the predicted values at a set of data points, computed from
+    blocks of MCMC samples so that the samples never need to be stored. The mean and variance of each variable are
+    updated with Welford's algorithm, merged one block at a time. The percentiles are estimated from a histogram of
+    each variable with a fixed number of bins, placed using the first few samples, plus one bin on either side for
+    the samples outside of this range.
+
+    The memory used for each variable is nbins + 2 int32 counts plus six float64 values, e.g., 312 bytes with the
+    default 64 bins. This is the size of 39 samples stored as float64, compared with the 8 kB needed to store 1000
+    samples.
+    """
+    __slots__ = ["count", "mean", "_m2", "percentiles", "nbins", "_ninit", "_first", "_lower", "_width", "_counts",
+                 "_min", "_max"]
+
+    def __init__(self, size, percentiles=(5.0, 50.0, 95.0), nbins=64, ninit=50):
+        """
+        Constructor for the online summaries.
+
+        :param size: The number of variables to summarize.
+        :param percentiles: The percentiles to estimate, between 0 and 100.
+        :param nbins: The number of histogram bins for each variable.
+        :param ninit: The number of samples used to place the histogram bins.
+        """
+        self.count = 0
+        self.mean = np.zeros(size)
+        self._m2 = np.zeros(size)  # sum of squared deviations from the mean
+        self.percentiles = np.asarray(percentiles, dtype=float)
+        self.nbins = nbins
+        self._ninit = max(ninit, 2)
+        self._first = []  # the first few samples, used to place the histogram bins
+        self._lower = None  # lower edge of the histogram for each variable
+        self._width = None  # width of the histogram bins for each variable
+        self._counts = None  # counts in the histogram bins, including the two outer bins
+        self._min = np.empty(size)
+        self._min[:] = np.inf
+        self._max = np.empty(size)
+        self._max[:] = -np.inf
+
+    @property
+    def variance(self):
+        """
+        The sample variance of each variable.
+        """
+        if self.count < 2:
+            return np.zeros_like(self.mean)
+        return self._m2 / (self.count - 1)
+
+    def update(self, values):
+        """
+        Add new samples of the variables to the summaries.
+
+        :param values: The new samples, either an array of size self.mean.size for a single sample, or an array of
+            shape (self.mean.size, nsamples).
+        """
+        values = np.asarray(values, dtype=float)
+        if values.ndim == 1:
+            values = values[:, np.newaxis]
+
+        # merge the mean and sum of squared deviations of the new samples with the current ones
+        nnew = values.shape[1]
+        total = self.count + nnew
+        new_mean = values.mean(axis=1)
+        delta = new_mean - self.mean
+        self.mean += delta * (nnew / float(total))
+        self._m2 += ((values - new_mean[:, np.newaxis]) ** 2).sum(axis=1)
+        self._m2 += delta ** 2 * (self.count * nnew / float(total))
+        self.count = total
+        np.minimum(self._min, values.min(axis=1), out=self._min)
+        np.maximum(self._max, values.max(axis=1), out=self._max)
+
+        if self._counts is None:
+            self._first.append(values)
+            if sum(block.shape[1] for block in self._first) < self._ninit:
+                return
+            values = np.hstack(self._first)
+            self._first = []
+            self._place_bins(values)
+
+        self._add_to_histogram(values)
+
+    def _place_bins(self, values):
+        # cover the range of the first samples, extended by half of this range on either side
+        lower = values.min(axis=1)
+        span = values.max(axis=1) - lower
+        span = np.maximum(span, 1e-12 * np.maximum(np.abs(lower), 1.0))  # in case all samples are equal
+        self._lower = lower - 0.5 * span
+        self._width = 2.0 * span / self.nbins
+        self._counts = np.zeros((self.mean.size, self.nbins + 2), dtype=np.int32)
+
+    def _add_to_histogram(self, values):
+        nvars = self.mean.size
+        bins = np.floor((values - self._lower[:, np.newaxis]) / self._width[:, np.newaxis])
+        bins = np.clip(bins, -1, self.nbins).astype(np.int64) + 1  # the outer bins are 0 and nbins + 1
+        bins += (self.nbins + 2) * np.arange(nvars)[:, np.newaxis]
+        self._counts += np.bincount(bins.ravel(), minlength=nvars * (self.nbins + 2)).reshape(self._counts.shape)
+
+    def quantiles(self):
+        """
+        Return the current estimates of the requested percentiles of each variable.
+
+        :return: An array of shape (self.mean.size, number of percentiles).
+        """
+        if self._counts is None:
+            if len(self._first) == 0:
+                return np.zeros((self.mean.size, self.percentiles.size))
+            return np.percentile(np.hstack(self._first), self.percentiles, axis=1).T
+
+        # edges of the bins, using the smallest and largest samples as the outer edges of the outer bins
+        edges = self._lower[:, np.newaxis] + self._width[:, np.newaxis] * np.arange(self.nbins + 1.0)
+        edges = np.column_stack((np.minimum(self._min, edges[:, 0]), edges, np.maximum(self._max, edges[:, -1])))
+        cumulative = np.zeros((self.mean.size, self.nbins + 3))
+        cumulative[:, 1:] = np.cumsum(self._counts, axis=1)
+
+        # interpolate the cumulative counts linearly within the bin containing each percentile
+        quantiles = np.empty((self.mean.size, self.percentiles.size))
+        rows = np.arange(self.mean.size)
+        for j, target in enumerate(self.percentiles / 100.0 * self.count):
+            k = np.sum(cumulative[:, 1:-1] < target, axis=1)  # the bin containing the percentile
+            below = cumulative[rows, k]
+            inside = np.maximum(cumulative[rows, k + 1] - below, 1.0)
+            fraction = np.clip((target - below) / inside, 0.0, 1.0)
+            quantiles[:, j] = edges[rows, k] + fraction * (edges[rows, k + 1] - edges[rows, k])
+
+        return quantiles
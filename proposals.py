@@ -35,6 +35,24 @@ class Proposal(object):
         """
         pass
 
+    def commit(self, proposed_value):
+        """
+        Method called by a Metropolis-Hastings step when the proposed value is accepted. Proposals that modify the
+        current value in place can use this to discard their record of the change.
+
+        :param proposed_value: The proposed value of the parameter, as returned by draw.
+        """
+        pass
+
+    def rollback(self, proposed_value):
+        """
+        Method called by a Metropolis-Hastings step when the proposed value is rejected. Proposals that modify the
+        current value in place must override this to undo the change.
+
+        :param proposed_value: The proposed value of the parameter, as returned by draw.
+        """
+        pass
+
 
 class NormalProposal(Proposal):
     """
@@ -4,10 +4,22 @@ This file contains the class definition for the sampler MCMCSample classes.
 
 __author__ = 'Brandon C. Kelly'
 
+import os
+import time
+import json
+import cPickle
+import ctypes
+import traceback
+import tempfile
+import threading
+import Queue
+import multiprocessing
 import numpy as np
+import scipy.stats
+import scipy.optimize
 import progressbar
 from matplotlib import pyplot as plt
-import acor
+import misc
 
 
 class MCMCSample(object):
@@ -22,10 +34,19 @@ class MCMCSample(object):
 
     Alternatively, one can load the parameters and their values from a file. This is done through the method
     generate_from_file. This is helpful if one has a set of MCMC samples generated by a different program.
+
+    If a directory is supplied, then the trace of each parameter is stored in a memory-mapped .npy file in this
+    directory instead of in memory. The traces are written as the sampler runs, and a background thread flushes them to
+    disk every flush_every samples, together with the number of samples saved so far, so the samples generated before
+    a crash can be recovered with MCMCSample.load().
+
+    The samples of several chains, e.g., from run_chains(), are stored one chain after the other along the first axis of
+    each trace, so the methods summarizing the samples use the pooled samples of all chains. The samples of each chain
+    are available from get_chains().
     """
-    __slots__ = ["samples", "logpost"]
+    __slots__ = ["samples", "logpost", "directory", "flush_every", "nsaved", "nchains", "_writer", "_journal"]
 
-    def __init__(self, filename=None, logpost=None, trace=None):
+    def __init__(self, filename=None, logpost=None, trace=None, directory=None, flush_every=1000):
         """
         Constructor for an MCMCSample object. If no arguments are supplied, then this just creates an empty dictionary
         that will contain the MCMC samples. In this case parameters are added to the dictionary through the addstep
@@ -33,8 +54,18 @@ class MCMCSample(object):
         filename is supplied then the parameter names and MCMC samples are read in from that file.
 
         :param filename: A string giving the name of an asciifile containing the MCMC samples.
+        :param directory: If not None, the directory where the traces are stored as memory-mapped .npy files.
+        :param flush_every: The number of samples between flushes of the memory-mapped traces to disk.
         """
         self.samples = dict()  # Empty dictionary. We will place the samples for each tracked parameter here.
+        self.directory = directory
+        self.flush_every = flush_every
+        self.nsaved = 0  # Number of samples saved so far by a Sampler object
+        self.nchains = 1  # Number of chains the samples are pooled from
+        self._writer = None  # Background thread flushing the memory-mapped traces
+        self._journal = None  # (file name, number of samples, size in bytes) of the journal of in-memory samples
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
 
         if logpost is not None:
             self.logpost = logpost
@@ -50,27 +81,225 @@ class MCMCSample(object):
 
     def get_samples(self, name):
         """
-        Returns a copy of the numpy array containing the samples for a parameter. This is safer then directly
+        Returns a read-only view of the numpy array containing the samples for a parameter. This is safer then directly
         accessing the dictionary object containing the samples to prevent one from inadvertently changes the values of
-        the samples output from an MCMC sampler.
+        the samples output from an MCMC sampler. The samples are not copied, so call copy() on the output if you need
+        to modify it.
+
+        :param name: The name of the parameter for which the samples are desired.
+        """
+        trace = self.samples[name].view(np.ndarray)
+        trace.flags.writeable = False
+        return trace
+
+    def get_chains(self, name):
+        """
+        Returns a read-only view of the samples for a parameter, with an additional first axis indexing the chain.
 
         :param name: The name of the parameter for which the samples are desired.
+        :return: The array of samples, of shape (nchains, nsamples) + the shape of the parameter value.
+        """
+        trace = self.get_samples(name)
+        return trace.reshape((self.nchains, trace.shape[0] // self.nchains) + trace.shape[1:])
+
+    @staticmethod
+    def merge_chains(chains):
+        """
+        Merge the samples of several chains, generated by independent runs of the same sampler, into a single object.
+
+        :param chains: The list of MCMCSample objects, one for each chain. They must have the same number of samples.
+        :return: A new MCMCSample object, holding the samples of all chains in memory.
+        """
+        nsaved = chains[0].nsaved
+        if any(mcmc_samples.nsaved != nsaved for mcmc_samples in chains):
+            raise ValueError("All chains must have the same number of samples.")
+        merged = MCMCSample()
+        for name in chains[0].samples:
+            merged.samples[name] = np.concatenate([mcmc_samples.samples[name][:nsaved] for mcmc_samples in chains])
+        merged.nsaved = nsaved * len(chains)
+        merged.nchains = sum(mcmc_samples.nchains for mcmc_samples in chains)
+        return merged
+
+    @staticmethod
+    def merge_replicas(replicas, indices):
+        """
+        Merge the samples of the untempered chain saved by the replicas of a ParallelTempering sampler.
+
+        :param replicas: The list of MCMCSample objects of each replica.
+        :param indices: The list of the indices of the samples saved by each replica.
+        :return: A new MCMCSample object, holding the samples in memory.
+        """
+        nsamples = sum(len(replica_indices) for replica_indices in indices)
+        merged = MCMCSample()
+        for name, trace in replicas[0].samples.items():
+            merged.samples[name] = np.empty((nsamples,) + trace.shape[1:])
+            for mcmc_samples, replica_indices in zip(replicas, indices):
+                merged.samples[name][replica_indices] = mcmc_samples.samples[name][:len(replica_indices)]
+        merged.nsaved = nsamples
+        return merged
+
+    def allocate(self, name, shape):
+        """
+        Create the array that will hold the trace of a parameter, and add it to the dictionary of samples. The array is
+        memory-mapped onto the file name.npy if this object has a directory.
+
+        :param name: The name of the parameter.
+        :param shape: The shape of the trace, (sample_size,) + the shape of the parameter value.
+        :return: The array holding the trace.
+        """
+        self._journal = None  # the traces are new, so the samples in the journal are no longer valid
+        if self.directory is None:
+            trace = np.empty(shape)
+        else:
+            trace = np.lib.format.open_memmap(os.path.join(self.directory, name + '.npy'), mode='w+', dtype=float,
+                                              shape=shape)
+            if self._writer is None:
+                # the traces are new, so there are no samples on disk until the first flush. write this now, so that
+                # the traces can be loaded even if the sampler crashes before then.
+                _write_nsaved(self.directory, 0)
+                self._writer = TraceWriter(self)
+                self._writer.start()
+        self.samples[name] = trace
+        return trace
+
+    def mark_saved(self, nsaved):
+        """
+        Record the number of samples saved so far, flushing the memory-mapped traces to disk every flush_every samples.
+
+        :param nsaved: The number of samples saved.
+        """
+        previous = self.nsaved
+        self.nsaved = nsaved
+        if self._writer is not None and nsaved // self.flush_every > previous // self.flush_every:
+            self._writer.request(nsaved)
+
+    def close(self):
+        """
+        Flush the memory-mapped traces to disk and stop the background thread. This is called by Sampler.run() when it
+        is done.
+        """
+        if self._writer is not None:
+            self._writer.request(self.nsaved)
+            self._writer.stop()
+            self._writer = None
+
+    def get_state(self, journal=None):
+        """
+        Return the samples saved so far as a dictionary, e.g., for saving them in a checkpoint. If the traces are
+        memory-mapped then they are flushed to disk and only their location is returned.
+
+        :param journal: If not None, the name of a file where the samples held in memory are journaled. Only the
+                        samples saved since the last call with the same journal are appended to it, and the returned
+                        dictionary holds the size of the journal instead of the samples. This way the cost of regular
+                        checkpoints does not grow with the number of samples.
+        """
+        state = {'nsaved': self.nsaved, 'nchains': self.nchains, 'directory': self.directory,
+                 'shapes': dict((name, trace.shape) for name, trace in self.samples.items())}
+        if self.directory is None:
+            if journal is None:
+                state['samples'] = dict((name, trace[:self.nsaved].copy()) for name, trace in self.samples.items())
+            else:
+                state['journal'] = self._write_journal(journal)
+        elif self._writer is not None:
+            self._writer.request(self.nsaved)
+            self._writer.wait()
+        return state
+
+    def set_state(self, state):
+        """
+        Restore the samples from the output of get_state. Memory-mapped traces are reopened for writing, so that a
+        sampler can continue to fill them.
+
+        :param state: A dictionary returned by get_state.
+        """
+        self.close()
+        self.directory = state['directory']
+        self.nsaved = state['nsaved']
+        self.nchains = state['nchains']
+        self._journal = state.get('journal')
+        if self._journal is not None:
+            chunks = _read_journal(self._journal[0], self._journal[2])
+            samples = dict((name, np.concatenate([chunk[name] for chunk in chunks])) for name in chunks[0])
+        elif self.directory is None:
+            samples = state['samples']
+        self.samples = dict()
+        for name, shape in state['shapes'].items():
+            if self.directory is None:
+                trace = np.empty(shape)
+                trace[:self.nsaved] = samples[name]
+            else:
+                trace = np.load(os.path.join(self.directory, name + '.npy'), mmap_mode='r+')
+                if self._writer is None:
+                    self._writer = TraceWriter(self)
+                    self._writer.start()
+            self.samples[name] = trace
+        if self._writer is not None:
+            # the files may hold samples generated after the state was saved, so reset the number of samples on disk
+            self._writer.request(self.nsaved)
+
+    def _write_journal(self, filename):
+        """
+        Append the samples saved since the last call to the journal file, see _append_journal().
+
+        :param filename: The name of the journal file. A different name than in the last call starts a new journal.
+        :return: The file name, and the number of samples and size in bytes of the journal.
+        """
+        first, offset = 0, 0
+        if self._journal is not None and self._journal[0] == filename:
+            first, offset = self._journal[1:]
+        chunk = dict((name, trace[first:self.nsaved]) for name, trace in self.samples.items())
+        self._journal = (filename, self.nsaved, _append_journal(filename, offset, chunk))
+        return self._journal
+
+    @staticmethod
+    def load(directory):
         """
-        return self.samples[name].copy()
+        Load the memory-mapped traces written to a directory by an MCMCSample object. Only the samples that were
+        flushed to disk are included, and the traces are opened read-only and not read into memory.
 
-    def generate_from_file(self, filename):
+        :param directory: The directory containing the traces.
+        :return: A new MCMCSample object.
         """
-        Build the dictionary of parameter samples from an ascii file of MCMC samples. The first line of this file
-        should contain the parameter names.
+        with open(os.path.join(directory, 'nsaved'), 'r') as f:
+            nsaved = int(f.read())
+        mcmc_samples = MCMCSample()
+        mcmc_samples.nsaved = nsaved
+        for fname in os.listdir(directory):
+            if fname.endswith('.npy'):
+                trace = np.load(os.path.join(directory, fname), mmap_mode='r')
+                mcmc_samples.samples[fname[:-len('.npy')]] = trace[:nsaved]
+        return mcmc_samples
+
+    def generate_from_file(self, filename, processes=None, cache=True):
+        """
+        Build the dictionary of parameter samples from ascii files of MCMC samples. The first line of each file
+        should contain the parameter name, followed by one row of values per sample.
+
+        The files are parsed in parallel worker processes. Unless cache is False, the parsed samples are saved to a .npy
+        file next to each ascii file, and later loads memory-map this cache instead of parsing the ascii file again. The
+        cache is rebuilt when the ascii file is newer than it.
 
-        :param filename: The name of the file containing the MCMC samples.
+        :param filename: The list of names of the files containing the MCMC samples.
+        :param processes: The number of worker processes. The default is the number of CPUs.
+        :param cache: If true, cache the parsed samples as .npy files.
         """
-        # TODO: put in exceptions to make sure files are ready correctly
-        for fname in filename:
-            file = open(fname, 'r')
-            name = file.readline()
-            # Grab the MCMC output
-            trace = np.genfromtxt(fname, skip_header=1)
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = min(processes, len(filename))
+        tasks = [(fname, cache) for fname in filename]
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                traces = pool.map(_read_trace_file, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            traces = map(_read_trace_file, tasks)
+
+        for name, trace in traces:
+            if cache:
+                trace = np.load(trace, mmap_mode='r')  # the workers return the name of the cache
             if name not in self.samples:
                 # Parameter is not already in the dictionary, so add it. Otherwise do nothing.
                 self.samples[name] = trace
@@ -78,19 +307,17 @@ class MCMCSample(object):
 
     def autocorr_timescale(self, trace):
         """
-        Compute the autocorrelation time scale as estimated by the `acor` module.
+        Compute the autocorrelation time scale of each element of a parameter trace, using the FFT-based estimator in
+        misc.autocorr_timescale().
 
-        :param trace: The parameter trace, a numpy array.
+        :param trace: The parameter trace, a numpy array of shape (nsamples, ...).
         """
-        acors = []
-        for i in range(trace.shape[1]):
-            tau, mean, sigma = acor.acor(trace[:, i].real)  # Warning, does not work with numpy.complex
-            acors.append(tau)
-        return np.array(acors)
+        return misc.autocorr_timescale(trace.real[np.newaxis])  # Warning, does not work with numpy.complex
 
     def effective_samples(self, name):
         """
-        Return the effective number of independent samples of the MCMC sampler.
+        Return the effective number of independent samples of the MCMC sampler for each element of a parameter,
+        combining the information of all chains.
 
         :param name: The name of the parameter to compute the effective number of independent samples for.
         """
@@ -100,10 +327,16 @@ class MCMCSample(object):
         else:
             print "Calculating effective number of samples"
 
-        traces = self.samples[name]  # Get the sampled parameter values
-        npts = traces.shape[0]
-        timescale = self.autocorr_timescale(traces)
-        return npts / timescale
+        return misc.effective_samples(self.get_chains(name))
+
+    def split_rhat(self, name):
+        """
+        Return the rank-normalized split-R-hat convergence diagnostic for each element of a parameter, see
+        misc.split_rhat(). Values larger than about 1.01 indicate that the chains have not converged.
+
+        :param name: The name of the parameter to compute the diagnostic for.
+        """
+        return misc.split_rhat(self.get_chains(name))
 
     def plot_trace(self, name, doShow=False):
         """
@@ -205,7 +438,7 @@ class MCMCSample(object):
             plt.show()
 
     def plot_2dkde(self, name1, name2, pindex1=0, pindex2=0,
-                   nbins=100, doPlotStragglers=True, doShow=False):
+                   nbins=100, doPlotStragglers=True, doShow=False, nkde=None, resolution=500):
         """
         Plot joint distribution of the parameter values generated by the MCMC sampler using a kernel density estimate.
 
@@ -216,6 +449,10 @@ class MCMCSample(object):
         :param doShow: Call plt.show()
         :param nbins: Number of bins along each axis for KDE
         :param doPlotStragglers: Plot individual data points outside KDE contours.  Works poorly for small samples.
+        :param nkde: If not None, the maximum number of samples used to build the KDE. Longer traces are thinned, which
+                     makes the KDE cheaper to evaluate but noisier. By default all of the samples are used.
+        :param resolution: The number of pixels along each axis of the plot. Only one straggler is plotted for each
+                           pixel.
         """
         if (not self.samples.has_key(name1)) or (not self.samples.has_key(name2)) :
             print "WARNING: sampler does not have", name1, name2
@@ -233,7 +470,9 @@ class MCMCSample(object):
         trace1 = self.samples[name1][:,pindex1].real # JIC we get something imaginary?
         trace2 = self.samples[name2][:,pindex2].real
         npts = trace1.shape[0]
-        kde = scipy.stats.gaussian_kde((trace1, trace2))
+        # the cost of evaluating the KDE grows with the number of samples, so optionally thin long traces
+        kde_step = 1 if nkde is None else max(1, int(np.ceil(npts / float(nkde))))
+        kde = scipy.stats.gaussian_kde((trace1[::kde_step], trace2[::kde_step]))
         bins1 = np.linspace(trace1.min(), trace1.max(), nbins)
         bins2 = np.linspace(trace2.min(), trace2.max(), nbins)
         mesh1, mesh2 = np.meshgrid(bins1, bins2)
@@ -265,15 +504,16 @@ class MCMCSample(object):
         # Also a note: this does not work if the outer contour is not
         # fully connected.
         if doPlotStragglers:
-            outer = cont.collections[0]._paths
-            sx = []
-            sy = []
-            for i in range(npts):
-                found = [o.contains_point((trace1[i], trace2[i])) for o in outer]
-                if not (True in found):
-                    sx.append(trace1[i])
-                    sy.append(trace2[i])
-            axJ.plot(sx, sy, 'k.', ms = 1, alpha = 0.1)
+            # points that fall on the same pixel look the same, so only keep one of them
+            pixel1 = np.round((trace1 - bins1[0]) / (bins1[-1] - bins1[0] + 1e-300) * (resolution - 1)).astype(int)
+            pixel2 = np.round((trace2 - bins2[0]) / (bins2[-1] - bins2[0] + 1e-300) * (resolution - 1)).astype(int)
+            unused, shown = np.unique(pixel1 * resolution + pixel2, return_index=True)
+            points = np.column_stack((trace1[shown], trace2[shown]))
+            # test all points against each of the outer contour paths at once
+            inside = np.zeros(points.shape[0], dtype=bool)
+            for path in cont.collections[0].get_paths():
+                inside |= path.contains_points(points)
+            axJ.plot(points[~inside, 0], points[~inside, 1], 'k.', ms = 1, alpha = 0.1)
         if doShow:
             plt.show()
 
@@ -288,17 +528,23 @@ class MCMCSample(object):
             print "WARNING: sampler does not have", name
             return
         else:
-            print "Plotting autocorrelation function (this make take a while)"
+            print "Plotting autocorrelation function"
             fig = plt.figure()
 
         traces = self.samples[name]  # Get the sampled parameter values
-        mtrace = np.mean(traces, axis=0)
+        traces = traces.reshape(traces.shape[0], -1)
         ntrace = traces.shape[1]
         acorr  = self.autocorr_timescale(traces)
 
+        # only compute the autocorrelations at the lags that are shown, all elements at once
+        maxlag = int(min(traces.shape[0] - 1, np.ceil(acorrFac * acorr.max())))
+        acf = misc.autocorrelation(traces[np.newaxis], maxlag)[0]
+        lags = np.arange(maxlag + 1)
+
         for i in range(ntrace):
             sp = plt.subplot(ntrace, 1, i+1)
-            lags, acf, not_needed1, not_needed2 = plt.acorr(traces[:, i] - mtrace[i], maxlags=traces.shape[0]-1, lw=2)
+            sp.vlines(lags, 0.0, acf[:, i], lw=2)
+            sp.axhline(y=0.0, c='k')
             sp.set_xlim(-0.5, acorrFac * acorr[i])
             sp.set_ylim(-0.01, 1.01)
             sp.axhline(y=0.5, c='k', linestyle='--')
@@ -355,61 +601,94 @@ class MCMCSample(object):
 
         # Finally, plot the autocorrelation function of the trace
         plt.subplot(212)
-        centered_trace = traces - traces.mean()
-        lags, acf, not_needed1, not_needed2 = plt.acorr(centered_trace, maxlags=traces.size - 1, lw=2)
-        acf = acf[acf.size / 2:]
+        maxlag = traces.size // 10  # only the first tenth of the lags are shown
+        acf = misc.autocorrelation(traces, maxlag)[0, :, 0]
+        plt.vlines(np.arange(maxlag + 1), 0.0, acf, lw=2)
+        plt.axhline(y=0.0, c='k')
         plt.ylabel("ACF")
         plt.xlabel("Lag")
 
-        # Compute the autocorrelation timescale, and then reset the x-axis limits accordingly
-        # acf_timescale = self.autocorr_timescale(traces)
         plt.xlim(0, traces.size / 10.0)
         if doShow:
             plt.show()
 
-    def posterior_summaries(self, name):
+    def summarize(self, name, percentiles=(0.5, 2.5, 16.0, 50.0, 84.0, 97.5, 99.5)):
         """
-        Print out the posterior medians, standard deviations, and 68th, 95th, and 99th credibility intervals.
+        Compute the posterior summaries of each element of a parameter. The traces of all elements are sorted once, and
+        the moments and percentiles of all elements are computed together.
 
         :param name: The name of the parameter for which the summaries are desired.
+        :param percentiles: The percentiles to compute, between 0 and 100.
+        :return: A numpy structured array with the shape of the parameter value, with fields 'mean', 'std' (the
+                 standard deviation), 'median', 'neffective' (the effective number of independent samples), and
+                 'percentiles' (an array holding the requested percentiles). The requested percentiles are stored in
+                 the metadata of the dtype, as summaries.dtype.metadata['percentiles'].
+        """
+        traces = self.get_samples(name)
+        nsamples = traces.shape[0]
+        flat = traces.reshape(nsamples, -1)
+        percentiles = np.asarray(percentiles, dtype=float)
+
+        # percentiles by linear interpolation between the order statistics, as done by np.percentile
+        ordered = np.sort(flat, axis=0)
+        position = np.concatenate((percentiles, [50.0])) / 100.0 * (nsamples - 1)
+        lower = np.floor(position).astype(int)
+        upper = np.minimum(lower + 1, nsamples - 1)
+        weight = (position - lower)[:, np.newaxis]
+        quantiles = (1.0 - weight) * ordered[lower] + weight * ordered[upper]
+
+        dtype = np.dtype([('mean', float), ('std', float), ('median', float), ('neffective', float),
+                          ('percentiles', float, (percentiles.size,))],
+                         metadata={'percentiles': tuple(percentiles)})
+        summaries = np.empty(flat.shape[1], dtype=dtype)
+        summaries['mean'] = flat.mean(axis=0)
+        summaries['std'] = flat.std(axis=0)
+        summaries['median'] = quantiles[-1]
+        summaries['neffective'] = misc.effective_samples(self.get_chains(name))
+        summaries['percentiles'] = quantiles[:-1].T
+
+        return summaries.reshape(traces.shape[1:])
+
+    @staticmethod
+    def format_summaries(name, summaries, percentiles=None):
+        """
+        Format the output of MCMCSample.summarize() as a human-readable table, one row per element of the parameter.
+
+        :param name: The name of the parameter.
+        :param summaries: The structured array returned by MCMCSample.summarize().
+        :param percentiles: The percentiles that were passed to MCMCSample.summarize(). If None, they are read from
+                            the metadata of the dtype of summaries.
+        :return: A string.
+        """
+        if percentiles is None:
+            if summaries.dtype.metadata is None or 'percentiles' not in summaries.dtype.metadata:
+                raise ValueError("The percentiles are not stored with the summaries, so they must be given.")
+            percentiles = summaries.dtype.metadata['percentiles']
+        header = ["element", "neffective", "mean", "std", "median"] + ["%g%%" % p for p in percentiles]
+        lines = ["Posterior summary for parameter " + str(name),
+                 "".join("%14s" % column for column in header)]
+        flat = summaries.reshape(-1)
+        for i in xrange(flat.size):
+            values = [flat['neffective'][i], flat['mean'][i], flat['std'][i], flat['median'][i]] + \
+                list(flat['percentiles'][i].reshape(-1))
+            lines.append("%14d" % i + "".join("%14.6g" % value for value in values))
+        return "\n".join(lines)
+
+    def posterior_summaries(self, name):
+        """
+        Print out the posterior medians, standard deviations, and 68th, 95th, and 99th credibility intervals. Use
+        MCMCSample.summarize() to get the summaries as an array instead.
 
-        See the documentation for MCMCSample.plot_trace for further information.
+        :param name: The name of the parameter for which the summaries are desired.
+        :return: The structured array returned by MCMCSample.summarize().
         """
         if not self.samples.has_key(name):
             print "WARNING: sampler does not have", name
             return
-        else:
-            print "Plotting parameter summary"
-            fig = plt.figure()
-
-        traces = self.samples[name]  # Get the sampled parameter values
-        effective_nsamples = self.effective_samples(name)  # Get the effective number of independent samples
-        if traces.ndim == 1:
-            # Parameter is scalar valued, so this is easy
-            print "Posterior summary for parameter", name
-            print "----------------------------------------------"
-            print "Effective number of independent samples:", effective_nsamples
-            print "Median:", np.median(traces)
-            print "Standard deviation:", np.std(traces)
-            print "68% credibility interval:", np.percentile(traces, (16.0, 84.0))
-            print "95% credibility interval:", np.percentile(traces, (2.5, 97.5))
-            print "99% credibility interval:", np.percentile(traces, (0.5, 99.5))
-        else:
-            if traces.ndim > 2:
-                # Parameter values are at least matrix-valued, reshape to a vector.
-                traces = traces.reshape(traces.shape[0], np.prod(traces.shape[1:]))
 
-            for i in xrange(traces.shape[1]):
-                # give summary for each element of this parameter separately
-                # Parameter is scalar valued, so this is easy
-                print "Posterior summary for parameter", name, " element", i
-                print "----------------------------------------------"
-                print "Effective number of independent samples:", effective_nsamples[i]
-                print "Median:", np.median(traces[:, i])
-                print "Standard deviation:", np.std(traces[:, i])
-                print "68% credibility interval:", np.percentile(traces[:, i], (16.0, 84.0))
-                print "95% credibility interval:", np.percentile(traces[:, i], (2.5, 97.5))
-                print "99% credibility interval:", np.percentile(traces[:, i], (0.5, 99.5))
+        summaries = self.summarize(name)
+        print self.format_summaries(name, summaries)
+        return summaries
 
     def newaxis(self):
         for key in self.samples.keys():
@@ -417,20 +696,229 @@ class MCMCSample(object):
                 self.samples[key] = self.samples[key][:, np.newaxis]
 
 
+class TraceWriter(threading.Thread):
+    """
+    Background thread that flushes the memory-mapped traces of an MCMCSample object to disk, so that the sampler does
+    not wait on the disk. After each flush the number of samples on disk is written to the file 'nsaved'.
+    """
+
+    def __init__(self, mcmc_samples):
+        """
+        Constructor for the thread flushing the traces.
+
+        :param mcmc_samples: The MCMCSample object with the memory-mapped traces.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.mcmc_samples = mcmc_samples
+        self._requests = Queue.Queue()
+
+    def request(self, nsaved):
+        """
+        Ask the thread to flush the traces, which hold nsaved samples.
+        """
+        self._requests.put(nsaved)
+
+    def wait(self):
+        """
+        Wait for the pending flushes to finish.
+        """
+        self._requests.join()
+
+    def stop(self):
+        """
+        Wait for the pending flushes to finish, and stop the thread.
+        """
+        self._requests.put(None)
+        self.join()
+
+    def run(self):
+        directory = self.mcmc_samples.directory
+        while True:
+            nsaved = self._requests.get()
+            if nsaved is None:
+                self._requests.task_done()
+                return
+            for trace in self.mcmc_samples.samples.values():
+                if isinstance(trace, np.memmap):
+                    trace.flush()
+            _write_nsaved(directory, nsaved)
+            self._requests.task_done()
+
+
+def _append_journal(filename, offset, chunk):
+    """
+    Append a chunk of samples to a journal file, as a pickled object. The file is truncated to offset bytes first,
+    dropping anything written after the state of the samples was last saved, and is synced to disk afterwards.
+
+    :param filename: The name of the journal file. It is created if offset is zero.
+    :param offset: The size in bytes of the valid part of the journal.
+    :param chunk: The samples to append.
+    :return: The new size in bytes of the journal.
+    """
+    with open(filename, 'r+b' if offset > 0 else 'wb') as f:
+        f.seek(offset)
+        f.truncate()
+        cPickle.dump(chunk, f, protocol=cPickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+def _read_journal(filename, nbytes):
+    """
+    Read the chunks of samples from the first nbytes bytes of a journal file written by _append_journal().
+    """
+    chunks = []
+    with open(filename, 'rb') as f:
+        while f.tell() < nbytes:
+            chunks.append(cPickle.load(f))
+    return chunks
+
+
+def _write_nsaved(directory, nsaved):
+    """
+    Write the number of samples on disk to the file 'nsaved' in the directory of the memory-mapped traces. The number is
+    written to a temporary file first, so that the file is always complete.
+    """
+    tmpname = os.path.join(directory, 'nsaved.tmp')
+    with open(tmpname, 'w') as f:
+        f.write(str(nsaved))
+    os.rename(tmpname, os.path.join(directory, 'nsaved'))
+
+
+class StepProfiler(object):
+    """
+    Opt-in profiler of the steps of a Sampler. Attach it with Sampler.set_profiler(). It records the wall time, the
+    number of calls, and the acceptance rate of each step, and steps may record their own sub-timers with record(),
+    e.g., BartStep records the time spent growing and pruning the trees. Only two calls to time.time() are added per
+    step, so the profiler can be used on production runs. If snapshot_file is given then a snapshot of the counters is
+    appended to it as a line of JSON every snapshot_every iterations.
+    """
+    __slots__ = ["timers", "niter", "total_time", "snapshot_file", "snapshot_every", "_start_time"]
+
+    def __init__(self, snapshot_file=None, snapshot_every=1000):
+        """
+        Constructor for StepProfiler object.
+
+        :param snapshot_file: The name of the file where the snapshots are written. If None, no snapshots are written.
+        :param snapshot_every: The number of iterations between snapshots.
+        """
+        # timer name -> [calls, seconds, accepted calls (None if not a Metropolis-Hastings update), failed calls]
+        self.timers = dict()
+        self.niter = 0  # the number of iterations of the sampler
+        self.total_time = 0.0  # the total time spent in the steps of the sampler
+        self.snapshot_file = snapshot_file
+        self.snapshot_every = snapshot_every
+        self._start_time = time.time()
+
+    def record(self, name, seconds, accepted=None, failed=False):
+        """
+        Add a call to a timer.
+
+        :param name: The name of the timer.
+        :param seconds: The wall time of the call.
+        :param accepted: Whether a proposal was accepted in this call. None if the timer does not count acceptances.
+        :param failed: Whether the call failed, e.g., because the proposed move was not possible.
+        """
+        try:
+            timer = self.timers[name]
+        except KeyError:
+            timer = self.timers[name] = [0, 0.0, None if accepted is None else 0, 0]
+        timer[0] += 1
+        timer[1] += seconds
+        if accepted:
+            timer[2] += 1
+        if failed:
+            timer[3] += 1
+
+    @staticmethod
+    def step_name(step):
+        """
+        Return the name of the timer of a step: the name of its parameter, or the name of its class if it does not
+        have one.
+        """
+        parameter = getattr(step, '_parameter', None)
+        return type(step).__name__ if parameter is None else parameter.name
+
+    def time_step(self, step):
+        """
+        Do one update of a step, and record its wall time and whether it accepted the proposal.
+
+        :param step: The step object.
+        """
+        naccept = getattr(step, 'naccept', None)
+        start = time.time()
+        step.do_step()
+        seconds = time.time() - start
+        self.total_time += seconds
+        self.record(self.step_name(step), seconds, None if naccept is None else step.naccept > naccept)
+
+    def tick(self):
+        """
+        Count one iteration of the sampler, and write a snapshot if one is due.
+        """
+        self.niter += 1
+        if self.snapshot_file is not None and self.niter % self.snapshot_every == 0:
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        """
+        Append the current values of the counters to the snapshot file, as a single line of JSON.
+        """
+        snapshot = {'iteration': self.niter, 'elapsed': time.time() - self._start_time, 'total_time': self.total_time,
+                    'timers': dict((name, {'calls': calls, 'seconds': seconds, 'accepted': accepted, 'failed': failed})
+                                   for name, (calls, seconds, accepted, failed) in self.timers.items())}
+        with open(self.snapshot_file, 'a') as f:
+            f.write(json.dumps(snapshot, sort_keys=True) + '\n')
+
+    def summary(self):
+        """
+        Return the counters as a structured numpy array, with one entry per timer sorted by decreasing time. The
+        fields are the timer name, the number of calls, the total and mean time, the fraction of the total time spent
+        in the steps, the acceptance rate, and the failure rate. The acceptance rate is NaN for timers that do not count
+        acceptances. Note that the sub-timers recorded by a step are included in the time of the step itself.
+        """
+        dtype = [('name', 'S40'), ('calls', np.int64), ('seconds', float), ('seconds_per_call', float),
+                 ('fraction', float), ('acceptance', float), ('failure', float)]
+        names = sorted(self.timers, key=lambda name: -self.timers[name][1])
+        summary = np.zeros(len(names), dtype=dtype)
+        for i, name in enumerate(names):
+            calls, seconds, accepted, failed = self.timers[name]
+            summary[i] = (name, calls, seconds, seconds / calls, seconds / max(self.total_time, 1e-300),
+                          np.nan if accepted is None else float(accepted) / calls, float(failed) / calls)
+        return summary
+
+    def report(self):
+        """
+        Print a table of the counters and return them, see summary().
+        """
+        summary = self.summary()
+        print "Profile of", self.niter, "iterations,", self.total_time, "seconds in the steps:"
+        print "%-24s %10s %12s %12s %9s %11s %9s" % ("Timer", "Calls", "Seconds", "Per call", "Fraction",
+                                                      "Acceptance", "Failure")
+        for entry in summary:
+            print "%-24s %10d %12.4g %12.4g %9.3f %11.3f %9.3f" % tuple(entry)
+        return summary
+
+
 class Sampler(object):
     """
     A class to generate samples of parameter from their probability distribution. Samplers consist of a series of
     steps, where each step updates the value of the parameter(s) associated with it. The samples for the tracked
     parameters are saved to a MCMCSample object.
     """
-    __slots__ = ["sample_size", "burnin", "thin", "_steps", "_burnin_bar", "_sampler_bar", "mcmc_samples"]
+    __slots__ = ["sample_size", "burnin", "thin", "_steps", "_burnin_bar", "_sampler_bar", "_bar_time", "_save_plan",
+                 "profiler", "mcmc_samples"]
+    bar_interval = 0.25  # minimum number of seconds between updates of the progress bars
 
-    def __init__(self, steps=None):
+    def __init__(self, steps=None, mcmc_samples=None):
         """
         Constructor for Sampler object.
 
         :param steps: A list of step objects to iterate over in one MCMC iteration.
-        :param mcmc_samples: An MCMCSample object. The generated samples are added to this object.
+        :param mcmc_samples: An MCMCSample object. The generated samples are added to this object. If None, the samples
+                             are stored in memory.
         """
         self.sample_size = 0
         self.burnin = 0
@@ -443,8 +931,13 @@ class Sampler(object):
         # Construct progress bar objects
         self._burnin_bar = progressbar.ProgressBar()
         self._sampler_bar = progressbar.ProgressBar()
+        self._bar_time = 0.0  # time of the last update of a progress bar
+        self._save_plan = None  # list of the tracked parameters and their traces, built by _compile_save_plan()
+        self.profiler = None  # StepProfiler object, see set_profiler()
 
-        self.mcmc_samples = MCMCSample()  # MCMCSample class object. This is where the sampled values are stored.
+        if mcmc_samples is None:
+            mcmc_samples = MCMCSample()
+        self.mcmc_samples = mcmc_samples  # MCMCSample class object. This is where the sampled values are stored.
 
     def add_step(self, step):
         """
@@ -461,15 +954,60 @@ class Sampler(object):
                 # We are saving this parameter's values, so add to dictionary of samples.
                 if np.isscalar(step._parameter.value):
                     # Parameter is scalar-valued, so this is easy
-                    value_array = np.empty(self.sample_size)
+                    trace_shape = (self.sample_size,)
                 else:
                     # Parameter is array-like, so get shape of parameter array first
                     pshape = step._parameter.value.shape
                     trace_shape = (self.sample_size,) + pshape
-                    # Get numpy array that will store the samples values for this parameter
-                    value_array = np.empty(trace_shape)
-                    # Add the array that will hold the sampled parameter values to the dictionary of samples.
-                self.mcmc_samples.samples[step._parameter.name] = value_array
+                # Add the array that will hold the sampled parameter values to the dictionary of samples.
+                self.mcmc_samples.allocate(step._parameter.name, trace_shape)
+        self.mcmc_samples.mark_saved(0)
+        self._save_plan = self._compile_save_plan()
+
+    def _compile_save_plan(self):
+        """
+        Build the list of (parameter, trace) pairs of the tracked parameters, so that save_values() does not need to
+        look up the traces or check the parameter types every time it is called.
+        """
+        return [(step._parameter, self.mcmc_samples.samples[step._parameter.name]) for step in self._steps
+                if step._parameter.track]
+
+    def set_profiler(self, profiler):
+        """
+        Attach a profiler to the sampler and its steps. The profiler records the time spent in each step, see
+        StepProfiler. Steps that record their own sub-timers must have a set_profiler method.
+
+        :param profiler: A StepProfiler object, or None to stop profiling.
+        """
+        self.profiler = profiler
+        for step in self._steps:
+            if hasattr(step, 'set_profiler'):
+                step.set_profiler(profiler)
+
+    def _do_steps(self):
+        """
+        Perform one iteration of the sampler, i.e., do each of the steps once.
+        """
+        profiler = self.profiler
+        if profiler is None:
+            for step in self._steps:
+                step.do_step()
+        else:
+            for step in self._steps:
+                profiler.time_step(step)
+            profiler.tick()
+
+    def _update_bar(self, bar, value):
+        """
+        Update a progress bar, at most once every bar_interval seconds unless it is finished.
+
+        :param bar: The progress bar.
+        :param value: The number of iterations done.
+        """
+        now = time.time()
+        if now - self._bar_time >= self.bar_interval or value == bar.maxval:
+            bar.update(value)
+            self._bar_time = now
 
     def start(self):
         for step in self._steps:
@@ -486,29 +1024,135 @@ class Sampler(object):
         :param burnin_stage: Are we in the burn-in stage? A boolean.
         """
         for i in xrange(niter):
-            for step in self._steps:
-                step.do_step()
+            self._do_steps()
 
             if burnin_stage:
                 # Update the burn-in progress bar
-                self._burnin_bar.update(i + 1)
+                self._update_bar(self._burnin_bar, i + 1)
 
     def save_values(self):
         """
         Save the parameter values. These values are saved in a dictionary of numpy arrays, indexed according to the
-        parameter names. The dictionary of samples is accessed as Sampler.samples.
+        parameter names. The dictionary of samples is accessed as Sampler.samples. The values are saved after the
+        mcmc_samples.nsaved samples saved so far.
+        """
+        if self._save_plan is None:
+            # the traces were replaced, e.g., by set_state()
+            self._save_plan = self._compile_save_plan()
+        current_sample = self.mcmc_samples.nsaved
+        for parameter, trace in self._save_plan:
+            trace[current_sample] = parameter.value
+
+    def set_temperature(self, temperature):
+        """
+        Set the temperature of the parameters. The parameters must use their temperature to temper their posterior
+        distributions, see ParallelTempering.
+
+        :param temperature: The temperature.
         """
-        current_iteration = self._sampler_bar.currval  # Progress bar keeps track of how many iterations we have run
         for step in self._steps:
-            # Save the parameter value associated with each step.
-            if np.isscalar(step._parameter.value):
-                # Need to treat scalar case separately
-                self.mcmc_samples.samples[step._parameter.name][current_iteration] = step._parameter.value
+            step._parameter._temperature = temperature
+
+    def get_state(self, journal=None):
+        """
+        Return the state of the sampler as a dictionary: the state of the steps and their parameters, the samples saved
+        so far, and the state of the random number generator. Continuing from this state with set_state() reproduces
+        the samples of an uninterrupted run exactly.
+
+        :param journal: If not None, the name of a file where the samples held in memory are journaled, see
+                        MCMCSample.get_state().
+        """
+        return {'burnin': self.burnin, 'sample_size': self.sample_size, 'thin': self.thin,
+                'random_state': np.random.get_state(), 'steps': [step.get_state() for step in self._steps],
+                'samples': self.mcmc_samples.get_state(journal)}
+
+    def set_state(self, state):
+        """
+        Restore the state of the sampler from the output of get_state.
+
+        :param state: A dictionary returned by get_state.
+        """
+        self.burnin = state['burnin']
+        self.sample_size = state['sample_size']
+        self.thin = state['thin']
+        for step, step_state in zip(self._steps, state['steps']):
+            step.set_state(step_state)
+        self.mcmc_samples.set_state(state['samples'])
+        self._save_plan = None
+        np.random.set_state(state['random_state'])
+        self._burnin_bar.maxval = self.burnin
+        self._sampler_bar.maxval = self.sample_size
+
+    def checkpoint(self, filename):
+        """
+        Save the state of the sampler to a file, so that the run can be continued with resume(). The state is a
+        dictionary of numpy arrays, and is written to a temporary file first so that a crash while writing does not
+        destroy the previous checkpoint. Samples held in memory are appended to the journal file filename + '.samples'
+        and the checkpoint only records its size, so each checkpoint only writes the samples saved since the last one.
+
+        :param filename: The name of the checkpoint file.
+        """
+        state = self.get_state(journal=filename + '.samples')
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'wb') as f:
+            cPickle.dump(state, f, protocol=cPickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmpname, filename)
+
+    def resume(self, filename, checkpoint_every=1000):
+        """
+        Continue a run from a checkpoint file written by run(), e.g., after a crash. The sampler must be constructed
+        in the same way as the one that wrote the checkpoint.
+
+        :param filename: The name of the checkpoint file. It is updated as the run continues.
+        :param checkpoint_every: The number of samples between checkpoints.
+        """
+        with open(filename, 'rb') as f:
+            state = cPickle.load(f)
+        self.set_state(state)
+
+        nsaved = state['samples']['nsaved']
+        print "Resuming from sample", nsaved, "of", self.sample_size
+        return self._sample(nsaved, filename, checkpoint_every)
+
+    def _sample(self, first, checkpoint, checkpoint_every):
+        """
+        Generate the samples, starting after the first saved samples.
+
+        :param first: The number of samples already saved.
+        :param checkpoint: The name of the checkpoint file. If None then no checkpoints are written.
+        :param checkpoint_every: The number of samples between checkpoints.
+        """
+        print "Sampling..."
+        self._sampler_bar.start()
+        self._sampler_bar.update(first)
+
+        for i in xrange(first, self.sample_size):
+            if self.thin == 1:
+                # No thinning is performed, so don't waste time calling self.Iterate.
+                self._do_steps()
+
             else:
-                # Have a vector- or matrix-valued parameter
-                self.mcmc_samples.samples[step._parameter.name][current_iteration, :] = step._parameter.value
+                # Need to thin the samples, so do thin iterations.
+                self.iterate(self.thin, False)
 
-    def run(self, burnin, nsamples, thin=1):
+            # Now save the tracked parameter values to the samples dictionary object
+            self.save_values()
+            self.mcmc_samples.mark_saved(i + 1)
+
+            self._update_bar(self._sampler_bar, i + 1)  # Update the progress bar
+
+            if checkpoint is not None and (i + 1) % checkpoint_every == 0 and i + 1 < self.sample_size:
+                self.checkpoint(checkpoint)
+
+        self.mcmc_samples.close()
+        if checkpoint is not None:
+            self.checkpoint(checkpoint)
+
+        return self.mcmc_samples
+
+    def run(self, burnin, nsamples, thin=1, checkpoint=None, checkpoint_every=1000):
         """
         Run the sampler.
 
@@ -516,6 +1160,9 @@ class Sampler(object):
                         be performed.
         :param burnin: The number of burnin iterations to run.
         :param thin: The thinning interval. Every thin iterations will be kept.
+        :param checkpoint: If not None, the name of a file where the state of the sampler is saved every
+                           checkpoint_every samples. The run can be continued from this file with resume().
+        :param checkpoint_every: The number of samples between checkpoints.
         """
         self.burnin = burnin
         self.sample_size = nsamples
@@ -532,28 +1179,395 @@ class Sampler(object):
         self.iterate(self.burnin, True)  # Perform the burn-in iterations
 
         # Now run the sampler.
-        print "Sampling..."
-        self._sampler_bar.start()
+        return self._sample(0, checkpoint, checkpoint_every)
 
-        for i in xrange(self.sample_size):
-            if self.thin == 1:
-                # No thinning is performed, so don't waste time calling self.Iterate.
-                for step in self._steps:
-                    step.do_step()
+    def restart(self, sample_size, thin=1, checkpoint=None, checkpoint_every=1000):
+        """
+        Restart the MCMC sampler at the current value. No burn-in stage will be performed, and the parameters are not
+        reset to their starting values. The samples from the previous run are replaced.
 
-            else:
-                # Need to thin the samples, so do thin iterations.
-                self.iterate(self.thin, False)
+        :param sample_size: The sample size to generate.
+        :param thin: The thinning interval. Every thin iterations will be kept.
+        :param checkpoint: If not None, the name of a file where the state of the sampler is saved every
+                           checkpoint_every samples.
+        :param checkpoint_every: The number of samples between checkpoints.
+        """
+        self.burnin = 0
+        self.sample_size = sample_size
+        self.thin = thin
+        self._allocate_arrays()
+        self._sampler_bar.maxval = self.sample_size
 
-            # Now save the tracked parameter values to the samples dictionary object
-            self.save_values()
+        return self._sample(0, checkpoint, checkpoint_every)
 
-            self._sampler_bar.update(i + 1)  # Update the progress bar
 
-        return self.mcmc_samples
+def _parse_trace(fname, block_size=2 ** 26):
+    """
+    Parse the rows of values in an ascii file of MCMC samples, after the header line. The file is read in blocks of
+    lines, and each block is parsed by numpy in a single call. Blank lines and comment lines starting with '#' are
+    skipped. A ValueError is raised if a value can not be parsed, or if the number of values in a block is not the
+    number of lines times the number of values on the first line.
+    """
+    blocks = []
+    ncolumns = None
+    with open(fname, 'r') as f:
+        f.readline()  # the parameter name
+        while True:
+            lines = f.readlines(block_size)
+            if len(lines) == 0:
+                break
+            lines = [line for line in lines if line.strip() and not line.lstrip().startswith('#')]
+            if len(lines) == 0:
+                continue
+            if ncolumns is None:
+                ncolumns = len(lines[0].split())
+            text = ''.join(lines)
+            # numpy stops parsing at the first bad value without an error, so check the number of values
+            ntokens = len(text.split())
+            block = np.fromstring(text, sep=' ')
+            if ntokens != len(lines) * ncolumns or block.size != ntokens:
+                raise ValueError("Could not parse the MCMC samples in " + fname + ": expected " + str(ncolumns) +
+                                 " numerical values on each line.")
+            blocks.append(block)
+    if ncolumns is None:
+        return np.empty(0)
+    trace = np.concatenate(blocks)
+    if ncolumns > 1:
+        trace = trace.reshape(-1, ncolumns)
+    return trace
+
+
+def _read_trace_file(args):
+    """
+    Read an ascii file of MCMC samples, in a worker process of MCMCSample.generate_from_file(). Returns the parameter
+    name, and the samples or the name of the .npy file caching them.
+    """
+    fname, cache = args
+    with open(fname, 'r') as f:
+        name = f.readline().strip()
+    if not cache:
+        return name, _parse_trace(fname)
+
+    cache_name = fname + '.npy'
+    if not os.path.exists(cache_name) or os.path.getmtime(cache_name) < os.path.getmtime(fname):
+        trace = _parse_trace(fname)  # parse before creating any file, so that a bad file is never cached
+        # write the cache to a unique temporary file first, so that an interrupted write does not leave a broken cache
+        # and two processes caching the same file do not write to the same temporary file
+        fd, tmpname = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(os.path.abspath(fname)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, trace)
+            os.rename(tmpname, cache_name)
+        except Exception:
+            os.remove(tmpname)
+            raise
+    return name, cache_name
+
+
+# The training data shared by the worker processes of run_chains(), set by _init_chain_worker()
+_shared_arrays = dict()
+
+
+def _share_arrays(shared):
+    """
+    Copy a dictionary of numpy arrays into shared memory, returning the buffers with the dtype and shape of the arrays.
+    """
+    shared_raw = dict()
+    if shared is not None:
+        for name, array in shared.items():
+            array = np.ascontiguousarray(array)
+            raw = multiprocessing.RawArray(ctypes.c_char, max(array.nbytes, 1))
+            np.frombuffer(raw, dtype=array.dtype, count=array.size)[:] = array.ravel()
+            shared_raw[name] = (raw, array.dtype, array.shape)
+    return shared_raw
+
+
+def _blas_library():
+    """
+    Return the BLAS library used by numpy as a ctypes library, or None if it can not be found. The library is looked
+    up through numpy's compiled core module, since the symbols of the libraries it is linked to can be found from it.
+    """
+    core = getattr(np.core, '_multiarray_umath', np.core.multiarray)
+    try:
+        return ctypes.CDLL(core.__file__)
+    except OSError:
+        return None
+
+
+def _set_blas_threads(nthreads):
+    """
+    Set the number of threads used by numpy's BLAS library, if it is OpenBLAS or MKL. Returns False if the number of
+    threads could not be set.
+    """
+    library = _blas_library()
+    for function in ('openblas_set_num_threads', 'mkl_set_num_threads'):
+        if library is not None and hasattr(library, function):
+            getattr(library, function)(ctypes.c_int(nthreads))
+            return True
+    return False
+
+
+def _get_blas_threads():
+    """
+    Return the number of threads used by numpy's BLAS library, or None if it is not OpenBLAS or MKL.
+    """
+    library = _blas_library()
+    for function in ('openblas_get_num_threads', 'mkl_get_max_threads'):
+        if library is not None and hasattr(library, function):
+            return getattr(library, function)()
+    return None
+
+
+def _init_chain_worker(shared, blas_threads):
+    """
+    Initialize a worker process of run_chains(): limit the number of BLAS threads, and view the shared training data
+    as numpy arrays.
+    """
+    # the worker is forked after numpy loaded its BLAS library, which only reads the environment variables when it is
+    # loaded, so set the number of threads of the loaded library directly. the variables still apply to any library
+    # loaded later, e.g., by the sampler.
+    for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[variable] = str(blas_threads)
+    _set_blas_threads(blas_threads)
+
+    _shared_arrays.clear()
+    for name, (raw, dtype, shape) in shared.items():
+        _shared_arrays[name] = np.frombuffer(raw, dtype=dtype).reshape(shape)
+
 
-    def restart(self, sample_size, thin=1):
+def _run_chain(args):
+    """
+    Run one chain in a worker process of run_chains().
+    """
+    build_sampler, seed, burnin, nsamples, thin = args
+    np.random.seed(seed)
+    sampler = build_sampler(**_shared_arrays)
+    return sampler.run(burnin, nsamples, thin)
+
+
+def run_chains(build_sampler, nchains, burnin, nsamples, thin=1, seed=None, shared=None, processes=None,
+               blas_threads=1):
+    """
+    Run several independent chains of an MCMC sampler in parallel on a pool of worker processes, and merge their
+    samples. Each chain is seeded with its own seed drawn from seed. The arrays in shared, e.g., the training data, are
+    copied once into shared memory, and every worker views the same copy.
+
+    The samplers are built in the workers by calling build_sampler with the shared arrays as keyword arguments, so
+    build_sampler must be picklable, e.g., a module-level function, a class, or a functools.partial of one. For
+    example, run_chains(functools.partial(BartModel, m=50), 8, 1000, 1000, shared={'X': X, 'y': y}) runs 8 chains of
+    a BART model.
+
+    :param build_sampler: A callable returning a Sampler object, given the shared arrays as keyword arguments.
+    :param nchains: The number of chains to run.
+    :param burnin: The number of burnin iterations of each chain.
+    :param nsamples: The number of samples to generate in each chain.
+    :param thin: The thinning interval.
+    :param seed: The seed used to draw the seeds of each chain. If None then the seeds are drawn from the global
+                 numpy random number generator.
+    :param shared: A dictionary of numpy arrays placed in shared memory.
+    :param processes: The number of worker processes. The default is the number of CPUs.
+    :param blas_threads: The number of BLAS threads used by each worker process. This is set on numpy's BLAS library
+                         if it is OpenBLAS or MKL. For other libraries, export OMP_NUM_THREADS before importing numpy.
+    :return: The merged samples of all chains, e.g., an MCMCSample object. See MCMCSample.get_chains().
+    """
+    if seed is None:
+        seeds = np.random.randint(0, 2 ** 31 - 1, size=nchains)
+    else:
+        seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, size=nchains)
+
+    shared_raw = _share_arrays(shared)
+    if processes is None:
+        processes = min(nchains, multiprocessing.cpu_count())
+    pool = multiprocessing.Pool(processes, initializer=_init_chain_worker, initargs=(shared_raw, blas_threads))
+    try:
+        chains = pool.map(_run_chain, [(build_sampler, chain_seed, burnin, nsamples, thin) for chain_seed in seeds])
+    finally:
+        pool.close()
+        pool.join()
+
+    return type(chains[0]).merge_chains(chains)
+
+
+def _no_loglik_message(sampler_class):
+    # the error raised for a sampler that can not be used for parallel tempering
+    return "The sampler class " + sampler_class.__name__ + " does not have a loglik() method, which is needed for " \
+        "parallel tempering."
+
+
+def _tempering_worker(connection, build_sampler, shared, blas_threads, seed):
+    """
+    Run one replica of a ParallelTempering sampler in a worker process, following the commands sent by the parent.
+    """
+    try:
+        _init_chain_worker(shared, blas_threads)
+        np.random.seed(seed)
+        sampler = build_sampler(**_shared_arrays)
+        if not hasattr(sampler, 'loglik'):
+            connection.send(ValueError(_no_loglik_message(sampler.__class__)))
+            return
+        connection.send('ready')  # the parent waits for this before sending commands, so it sees the errors above
+        indices = []  # the indices of the samples of the untempered chain saved by this replica
+        niter = 0
+        while True:
+            command = connection.recv()
+            if command[0] == 'start':
+                sampler.burnin, sampler.sample_size, sampler.thin = command[1:]
+                sampler.start()
+            elif command[0] == 'advance':
+                nadvance, temperature, untempered = command[1:]
+                sampler.set_temperature(temperature)
+                for i in xrange(nadvance):
+                    sampler._do_steps()
+                    niter += 1
+                    if untempered and niter > sampler.burnin and (niter - sampler.burnin) % sampler.thin == 0:
+                        # save the samples of this replica in the order they are generated
+                        sampler.save_values()
+                        indices.append((niter - sampler.burnin) // sampler.thin - 1)
+                        sampler.mcmc_samples.mark_saved(len(indices))
+                connection.send(sampler.loglik())
+            elif command[0] == 'finish':
+                sampler.mcmc_samples.close()
+                connection.send((sampler.mcmc_samples, indices))
+                return
+    except Exception:
+        connection.send(RuntimeError("Error in parallel tempering replica:\n" + traceback.format_exc()))
+
+
+class ParallelTempering(object):
+    """
+    Replica exchange (parallel tempering) sampler. A copy of the sampler is run at each of a ladder of temperatures in
+    its own worker process, where a replica at temperature T samples the posterior with the likelihood raised to the
+    power 1 / T. The hotter replicas move between the modes of the posterior more easily. Every swap_every iterations
+    a swap of the temperatures of neighbouring replicas is proposed, and accepted with the Metropolis-Hastings
+    probability
+
+        min(1, exp((1 / T_i - 1 / T_j) * (loglik_j - loglik_i))),
+
+    so that the samples of the replica at temperature 1.0 are samples from the untempered posterior. The replicas swap
+    temperatures rather than parameter values, so only the log-likelihoods are sent between the processes while
+    sampling. Each replica saves the samples generated while it is at temperature 1.0, and these are merged at the end.
+
+    The samplers are built by calling build_sampler in the worker processes, as for run_chains(). They must have a
+    loglik() method returning the log-likelihood of the data for the current parameter values, and their parameters
+    must temper their posteriors according to the temperature set by Sampler.set_temperature(), as the parameters of a
+    BartModel do.
+    """
+    __slots__ = ["build_sampler", "temperatures", "swap_every", "shared", "seed", "blas_threads", "naccept",
+                 "nswaps"]
+
+    def __init__(self, build_sampler, temperatures, swap_every=10, shared=None, seed=None, blas_threads=1):
         """
-        Restart the MCMC sampler at the current value. No burn-in stage will be performed.
+        Constructor for the parallel tempering sampler.
+
+        :param build_sampler: A callable returning a Sampler object, given the shared arrays as keyword arguments.
+        :param temperatures: The increasing ladder of temperatures. The first temperature must be 1.0.
+        :param swap_every: The number of iterations between proposed swaps.
+        :param shared: A dictionary of numpy arrays placed in shared memory, see run_chains().
+        :param seed: The seed of the random number generators. If None then the seeds are drawn from the global numpy
+                     random number generator.
+        :param blas_threads: The number of BLAS threads used by each worker process.
         """
-        pass
+        temperatures = np.asarray(temperatures, dtype=float)
+        if temperatures[0] != 1.0 or np.any(np.diff(temperatures) <= 0):
+            raise ValueError("Temperatures must be increasing, starting at 1.0.")
+        # the samplers are built in the worker processes, but a sampler class, or a functools.partial of one, can be
+        # checked now
+        sampler_class = getattr(build_sampler, 'func', build_sampler)
+        if isinstance(sampler_class, type) and not hasattr(sampler_class, 'loglik'):
+            raise ValueError(_no_loglik_message(sampler_class))
+        self.build_sampler = build_sampler
+        self.temperatures = temperatures
+        self.swap_every = swap_every
+        self.shared = shared
+        self.seed = seed
+        self.blas_threads = blas_threads
+        self.naccept = np.zeros(temperatures.size - 1, dtype=int)  # accepted swaps between neighbouring temperatures
+        self.nswaps = np.zeros(temperatures.size - 1, dtype=int)  # proposed swaps between neighbouring temperatures
+
+    @property
+    def swap_rates(self):
+        """
+        The acceptance rates of the swaps between each pair of neighbouring temperatures.
+        """
+        return self.naccept / np.maximum(self.nswaps, 1).astype(float)
+
+    def report(self):
+        """
+        Method to report the acceptance rates of the swaps between neighbouring temperatures.
+        """
+        for k in xrange(self.temperatures.size - 1):
+            print 'Swap acceptance rate between temperatures', self.temperatures[k], 'and', \
+                self.temperatures[k + 1], 'is:', self.swap_rates[k]
+
+    def run(self, burnin, nsamples, thin=1):
+        """
+        Run the sampler.
+
+        :param burnin: The number of burnin iterations to run.
+        :param nsamples: The sample size to generate.
+        :param thin: The thinning interval. Every thin iterations will be kept.
+        :return: The merged samples of the untempered replica, e.g., an MCMCSample object.
+        """
+        ntemps = self.temperatures.size
+        random_state = np.random.RandomState(self.seed) if self.seed is not None else np.random.RandomState(
+            np.random.randint(0, 2 ** 31 - 1))
+        seeds = random_state.randint(0, 2 ** 31 - 1, size=ntemps)
+        shared_raw = _share_arrays(self.shared)
+
+        connections = []
+        workers = []
+        try:
+            for seed in seeds:
+                connection, child_connection = multiprocessing.Pipe()
+                worker = multiprocessing.Process(target=_tempering_worker, args=(
+                    child_connection, self.build_sampler, shared_raw, self.blas_threads, seed))
+                worker.daemon = True
+                worker.start()
+                connections.append(connection)
+                workers.append(worker)
+                self._receive(connection)
+                connection.send(('start', burnin, nsamples, thin))
+
+            replica_at = np.arange(ntemps)  # the replica at each temperature
+            niter = burnin + nsamples * thin
+            nrounds = 0
+            print "Running", ntemps, "replicas..."
+            sampler_bar = progressbar.ProgressBar(maxval=niter)
+            sampler_bar.start()
+            for first in xrange(0, niter, self.swap_every):
+                nadvance = min(self.swap_every, niter - first)
+                for k in xrange(ntemps):
+                    connections[replica_at[k]].send(('advance', nadvance, self.temperatures[k], k == 0))
+                loglik = np.array([self._receive(connection) for connection in connections])
+
+                # propose swaps between the even or odd pairs of neighbouring temperatures, in turn
+                for k in xrange(nrounds % 2, ntemps - 1, 2):
+                    i, j = replica_at[k], replica_at[k + 1]
+                    log_ratio = (1.0 / self.temperatures[k] - 1.0 / self.temperatures[k + 1]) * (loglik[j] - loglik[i])
+                    self.nswaps[k] += 1
+                    if np.log(random_state.uniform()) < log_ratio:
+                        replica_at[k], replica_at[k + 1] = j, i
+                        self.naccept[k] += 1
+                nrounds += 1
+                sampler_bar.update(first + nadvance)
+
+            for connection in connections:
+                connection.send(('finish',))
+            replicas, indices = zip(*[self._receive(connection) for connection in connections])
+            for worker in workers:
+                worker.join()
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+
+        self.report()
+        return type(replicas[0]).merge_replicas(replicas, indices)
+
+    @staticmethod
+    def _receive(connection):
+        # get the reply of a worker process, raising the errors in the worker
+        reply = connection.recv()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
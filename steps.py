@@ -61,6 +61,24 @@ class Parameter(object):
         """
         return 0.0
 
+    def get_state(self):
+        """
+        Method to return the state of the parameter as a dictionary, e.g., for saving it in a checkpoint. Derived
+        classes holding additional state should override this method together with set_state.
+        """
+        value = self.value if np.isscalar(self.value) else np.copy(self.value)
+        return {'value': value, 'log_posterior': self._log_posterior}
+
+    def set_state(self, state):
+        """
+        Method to restore the state of the parameter from the output of get_state.
+
+        :param state: A dictionary returned by get_state.
+        """
+        value = state['value']
+        self.value = value if np.isscalar(value) else np.copy(value)
+        self._log_posterior = state['log_posterior']
+
 
 class Step(object):
     """
@@ -85,6 +103,20 @@ class Step(object):
         """
         pass
 
+    def get_state(self):
+        """
+        Method to return the state of the step and its parameter as a dictionary, e.g., for saving it in a checkpoint.
+        """
+        return {'parameter': self._parameter.get_state()}
+
+    def set_state(self, state):
+        """
+        Method to restore the state of the step and its parameter from the output of get_state.
+
+        :param state: A dictionary returned by get_state.
+        """
+        self._parameter.set_state(state['parameter'])
+
 
 class GibbStep(Step):
     """
@@ -136,6 +168,29 @@ class MetroStep(Step):
         arate = float(self.naccept) / self.niter
         print 'Average acceptance rate is:', arate
 
+    def get_state(self):
+        state = Step.get_state(self)
+        state.update(naccept=self.naccept, niter=self.niter, alpha=self._alpha)
+        return state
+
+    def set_state(self, state):
+        Step.set_state(self, state)
+        self.naccept = state['naccept']
+        self.niter = state['niter']
+        self._alpha = state['alpha']
+
+    def log_ratio(self, proposed_value, current_value):
+        """
+        Method to compute the logarithm of the Metropolis-Hastings ratio.
+
+        :param proposed_value: The proposed parameter value.
+        :param current_value: The current parameter value.
+        """
+        return self._parameter.logdensity(proposed_value) - \
+            self._proposal.logdensity(current_value, proposed_value, forward=True) \
+            - (self._parameter.logdensity(current_value) -
+               self._proposal.logdensity(proposed_value, current_value, forward=False))
+
     def accept(self, proposed_value, current_value):
         """
         Method to generate a boolean random variable describing whether the proposed parameter value
@@ -146,10 +201,7 @@ class MetroStep(Step):
         """
 
         ## Accept the proposed value with min(1.0, exp(alpha)).
-        alpha = self._parameter.logdensity(proposed_value) - \
-            self._proposal.logdensity(current_value, proposed_value, forward=True) \
-            - (self._parameter.logdensity(current_value) -
-               self._proposal.logdensity(proposed_value, current_value, forward=False))
+        alpha = self.log_ratio(proposed_value, current_value)
 
         self._alpha = np.exp(min(0.0, alpha))
 
@@ -166,9 +218,13 @@ class MetroStep(Step):
         proposed_value = self._proposal.draw(self._parameter.value)
 
         if self.accept(proposed_value, self._parameter.value):
+            self._proposal.commit(proposed_value)
             self._parameter.value = proposed_value
             self._parameter._log_posterior = self._parameter.logdensity(proposed_value)
             self.naccept += 1
+        else:
+            # proposals that work in place need to restore the current value
+            self._proposal.rollback(proposed_value)
 
         self.niter += 1
 
@@ -210,6 +266,18 @@ class AdaptiveMetro(MetroStep):
         else:
             self._cholesky_factor = cholesky(covar)  # Cholesky factor is upper triangular, needed for the rank 1 update
 
+    def get_state(self):
+        state = MetroStep.get_state(self)
+        # the adapted scale of the proposals
+        cholesky_factor = self._cholesky_factor
+        state['cholesky_factor'] = cholesky_factor if np.isscalar(self._covar) else np.copy(cholesky_factor)
+        return state
+
+    def set_state(self, state):
+        MetroStep.set_state(self, state)
+        cholesky_factor = state['cholesky_factor']
+        self._cholesky_factor = cholesky_factor if np.isscalar(self._covar) else np.copy(cholesky_factor)
+
     def update_covar(self, proposed_value, unit_proposal, centered_proposal):
         """
         Method to update the covariance matrix (actually, its Cholesky decomposition), based on the
@@ -0,0 +1,367 @@
+"""
+Scaling benchmarks for the BART trees, steps and predictions. Each benchmark case is run in its own worker process,
+so that the peak memory used by one case does not hide the peak memory of the next one. The results are written as
+one line of JSON per case, tagged with the git commit, so that the results of different commits can be compared with
+the --compare option. The memory of a case is the peak of the current resident set size of the worker while the case
+runs, less its resident set size before the case, polled by a thread.
+
+The benchmarks only use the parts of the tree API that are common to the older commits, so that they can be run on
+both sides of a comparison. Where a newer commit can undo a split or a move in place, that is used to restore the
+tree, otherwise the tree is copied before each call (not timed).
+
+Examples:
+
+    python benchmark_bart.py --output results.jsonl
+    python benchmark_bart.py --n 1000,10000,100000 --m 50,200 --benchmarks step,predict --output results.jsonl
+    python benchmark_bart.py --output new.jsonl --compare results.jsonl
+
+The benchmarks are:
+
+    filter: BaseTree.filter() on every terminal node of a tree of the given depth.
+    split: BaseTree.split() of a random terminal node of a tree of the given depth, collapsing it afterwards or
+        splitting a copy of the tree (not timed).
+    prune: BaseTree.prune() of a tree of the given depth, regrowing the pruned node afterwards (not timed).
+    draw: BartProposal.draw() on a tree of the given depth, rolling back the move afterwards when the proposal can
+        (not timed).
+    step: BartStep.do_step() for a BART model with m trees.
+    run: BartModel.run() for a BART model with m trees, including the burn-in.
+    predict: BartSample.predict() on the training data after running a BART model with m trees.
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import resource
+import platform
+import itertools
+import threading
+import subprocess
+import cPickle
+import multiprocessing
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from tree import BaseTree, BartProposal, BartModel
+
+TREE_BENCHMARKS = ('filter', 'split', 'prune', 'draw')
+MODEL_BENCHMARKS = ('step', 'run', 'predict')
+
+
+def build_friedman_data(nsamples, nfeatures, sigma=1.0):
+    # build Friedman's five dimensional test function, the other features are noise
+    X = np.random.uniform(0.0, 1.0, (nsamples, nfeatures))
+    ymean = 10.0 * np.sin(np.pi * X[:, 0] * X[:, 1]) + 20.0 * (X[:, 2] - 0.5) ** 2 + 10.0 * X[:, 3] + 4.0 * X[:, 4]
+    return X, ymean + sigma * np.random.standard_normal(nsamples)
+
+
+def load_cher_data():
+    # the training set of the CHER data used by Rbart.py
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CHER.pickle'), 'rb') as f:
+        feattr, featcv, fluxtr, fluxcv = cPickle.load(f)
+    return np.asarray(feattr, dtype=float), np.asarray(fluxtr, dtype=float).ravel()
+
+
+def build_tree(X, y, depth, ntries=10):
+    """
+    Grow a tree by splitting every terminal node with a random rule until all terminal nodes are at the input depth,
+    or could not be split in ntries attempts.
+    """
+    tree = BaseTree(X, y)
+    for level in xrange(depth):
+        for node in list(tree.terminalNodes):
+            if node.depth != level:
+                continue
+            for i in xrange(ntries):
+                # older commits return three values from prule() for a node without data
+                rule = tree.prule(node)
+                if rule[0] is not None and tree.split(node, rule[0], rule[1])[0] is not None:
+                    break
+    return tree
+
+
+def best_time(func, repeat, number):
+    """
+    Return the best time per call of func over repeat runs of number calls. If func returns a number, then that is
+    taken as the time of the call instead, so that func can leave its setup or cleanup out of the timing.
+    """
+    best = np.inf
+    for i in xrange(repeat):
+        total = 0.0
+        for j in xrange(number):
+            start = time.time()
+            seconds = func()
+            total += time.time() - start if seconds is None else seconds
+        best = min(best, total / number)
+    return best
+
+
+def bench_filter(tree):
+    def filter_leaves():
+        for node in tree.terminalNodes:
+            tree.filter(node)
+    return filter_leaves
+
+
+def bench_split(tree):
+    collapse = getattr(tree, 'collapse', None)
+
+    def split():
+        # without collapse() the split can not be undone, so split a copy of the tree instead
+        work = tree if collapse is not None else copy.deepcopy(tree)
+        rule = (None,)
+        while rule[0] is None:
+            node = work.terminalNodes[np.random.randint(len(work.terminalNodes))]
+            rule = work.prule(node)
+        start = time.time()
+        work.split(node, rule[0], rule[1])
+        seconds = time.time() - start
+        if collapse is not None and node.Left is not None:
+            collapse(node)
+        return seconds
+    return split
+
+
+def bench_prune(tree):
+    def prune():
+        start = time.time()
+        node = tree.prune()
+        seconds = time.time() - start
+        if node is not None:
+            # prune() keeps the splitting rule of the node, so regrow the same children
+            tree.split(node, node.feature, node.threshold)
+        return seconds
+    return prune
+
+
+def bench_draw(tree):
+    proposal = BartProposal()
+    # older commits draw the move on a copy of the tree, leaving the input tree as it was
+    rollback = getattr(proposal, 'rollback', None)
+
+    def draw():
+        start = time.time()
+        proposal.draw(tree)
+        seconds = time.time() - start
+        if rollback is not None:
+            rollback(tree)
+        return seconds
+    return draw
+
+
+def time_tree_benchmark(name, X, y, depth, repeat, number):
+    tree = build_tree(X, y, depth)
+    func = {'filter': bench_filter, 'split': bench_split, 'prune': bench_prune, 'draw': bench_draw}[name](tree)
+    return best_time(func, repeat, number), {'nleaves': len(tree.terminalNodes)}
+
+
+def time_model_benchmark(name, X, y, m, repeat, number, nsamples):
+    model = BartModel(X, y.copy(), m=m)
+    if name == 'step':
+        model.start()
+        step = model._steps[1]
+        step.do_step()  # the first call also computes the fit of the sum of trees
+        return best_time(step.do_step, repeat, number), {}
+    if name == 'run':
+        def run():
+            model.run(nsamples, nsamples)
+        return best_time(run, repeat, 1), {'nsamples': nsamples}
+
+    samples = model.run(nsamples, nsamples)
+
+    def predict():
+        samples.predict(X)
+    return best_time(predict, repeat, number), {'nsamples': nsamples}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, and in bytes on Mac OS X
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024.0 ** (2 if sys.platform == 'darwin' else 1)
+
+
+def current_rss_mb():
+    """
+    Return the current resident set size of the process in MB, or the peak resident set size where the current one is
+    not available (i.e., without /proc).
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            resident = int(f.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return peak_rss_mb()
+    return resident * os.sysconf('SC_PAGE_SIZE') / 1024.0 ** 2
+
+
+class RSSMonitor(threading.Thread):
+    """
+    Thread that polls the current resident set size of the process, keeping the largest value seen since it started.
+    """
+    def __init__(self, interval=0.005):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.start_rss = current_rss_mb()
+        self.peak_rss = self.start_rss
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak_rss = max(self.peak_rss, current_rss_mb())
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak_rss = max(self.peak_rss, current_rss_mb())
+        return self.peak_rss - self.start_rss
+
+
+def run_case(case):
+    """
+    Run one benchmark case in a worker process, returning its result as a dictionary.
+    """
+    devnull = open(os.devnull, 'w')
+    sys.stdout = sys.stderr = devnull  # silence the progress bars of the sampler
+    np.random.seed(case['seed'])
+    if case['dataset'] == 'cher':
+        X, y = load_cher_data()
+    else:
+        X, y = build_friedman_data(case['n'], case['p'])
+    monitor = RSSMonitor()
+    monitor.start()
+    try:
+        if case['benchmark'] in TREE_BENCHMARKS:
+            seconds, extra = time_tree_benchmark(case['benchmark'], X, y, case['depth'], case['repeat'],
+                                                 case['number'])
+        else:
+            seconds, extra = time_model_benchmark(case['benchmark'], X, y, case['m'], case['repeat'], case['number'],
+                                                  case['nsamples'])
+    finally:
+        rss_increase = monitor.stop()
+
+    result = dict(case)
+    result.update(extra)
+    result.update(n=X.shape[0], p=X.shape[1], seconds=seconds, peak_rss_mb=peak_rss_mb(),
+                  rss_increase_mb=rss_increase)
+    return result
+
+
+def build_cases(args):
+    """
+    Build the list of benchmark cases for the sweep over the datasets, n, p, m and the tree depth.
+    """
+    cases = []
+    for benchmark in args.benchmarks:
+        for dataset in args.datasets:
+            if dataset == 'cher':
+                sizes = [(None, None)]  # the size of the CHER data is fixed
+            else:
+                sizes = itertools.product(args.n, args.p)
+            for n, p in sizes:
+                if benchmark in TREE_BENCHMARKS:
+                    configs = [{'depth': depth, 'm': None} for depth in args.depth]
+                else:
+                    configs = [{'depth': None, 'm': m} for m in args.m]
+                for config in configs:
+                    case = {'benchmark': benchmark, 'dataset': dataset, 'n': n, 'p': p, 'repeat': args.repeat,
+                            'number': args.number, 'nsamples': args.nsamples, 'seed': args.seed}
+                    case.update(config)
+                    cases.append(case)
+    return cases
+
+
+def git_commit():
+    try:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def case_key(result):
+    return tuple(result[key] for key in ('benchmark', 'dataset', 'n', 'p', 'm', 'depth'))
+
+
+def compare(results, baseline_file):
+    """
+    Print the ratio of the time and peak memory of each benchmark case to the same case in a previous set of results.
+    The memory ratio is not printed when the memory of the previous case is below the resolution of the polling.
+    """
+    with open(baseline_file, 'r') as f:
+        baseline = dict((case_key(result), result) for result in (json.loads(line) for line in f))
+    print "%-8s %-9s %8s %4s %5s %6s %12s %12s %9s %9s" % ("Bench", "Data", "n", "p", "m", "depth", "Seconds",
+                                                          "Baseline", "Speedup", "Memory")
+    for result in results:
+        old = baseline.get(case_key(result))
+        if old is None:
+            continue
+        if old['rss_increase_mb'] >= 0.1:
+            memory = "%9.2f" % (result['rss_increase_mb'] / old['rss_increase_mb'])
+        else:
+            memory = "%9s" % "n/a"
+        print "%-8s %-9s %8s %4s %5s %6s %12.4g %12.4g %9.2f %s" % \
+            (result['benchmark'], result['dataset'], result['n'], result['p'], result['m'], result['depth'],
+             result['seconds'], old['seconds'], old['seconds'] / result['seconds'], memory)
+
+
+def parse_list(values, dtype=int):
+    return [dtype(value) for value in values.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scaling benchmarks for the BART trees, steps and predictions.")
+    parser.add_argument('--benchmarks', type=lambda s: parse_list(s, str),
+                        default=list(TREE_BENCHMARKS + MODEL_BENCHMARKS))
+    parser.add_argument('--datasets', type=lambda s: parse_list(s, str), default=['friedman', 'cher'])
+    parser.add_argument('--n', type=parse_list, default=[1000, 10000], help="numbers of data points")
+    parser.add_argument('--p', type=parse_list, default=[10], help="numbers of features")
+    parser.add_argument('--m', type=parse_list, default=[20, 200], help="numbers of trees")
+    parser.add_argument('--depth', type=parse_list, default=[2, 6], help="depths of the trees")
+    parser.add_argument('--repeat', type=int, default=3, help="the best of this many repeats is reported")
+    parser.add_argument('--number', type=int, default=20, help="number of calls per repeat")
+    parser.add_argument('--nsamples', type=int, default=20, help="burn-in and sample size of the run benchmark")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="file where the results are appended as lines of JSON")
+    parser.add_argument('--compare', help="file of results of a previous commit to compare with")
+    args = parser.parse_args(argv)
+
+    for benchmark in args.benchmarks:
+        if benchmark not in TREE_BENCHMARKS + MODEL_BENCHMARKS:
+            parser.error("Unknown benchmark: " + benchmark)
+
+    commit = git_commit()
+    environment = {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+                   'machine': platform.node(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+    results = []
+    # one worker process per case, so the peak memory is measured separately for each one
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for result in pool.imap(run_case, build_cases(args)):
+            result.update(environment)
+            results.append(result)
+            line = json.dumps(result, sort_keys=True)
+            if args.output is None:
+                print line
+            else:
+                with open(args.output, 'a') as f:
+                    f.write(line + '\n')
+                print "%-8s %-9s n=%-8s p=%-4s m=%-5s depth=%-4s %12.4g s %10.1f MB" % \
+                    (result['benchmark'], result['dataset'], result['n'], result['p'], result['m'], result['depth'],
+                     result['seconds'], result['rss_increase_mb'])
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
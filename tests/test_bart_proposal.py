@@ -60,9 +60,12 @@ class ProposalTestCase(unittest.TestCase):
         current_tree = self.tree.value
         ntrials = 1000
         for i in xrange(ntrials):
+            nleafs_old = len(current_tree.terminalNodes)
+            leaf_of_old = current_tree.leaf_of.copy()
+            version_old = current_tree.version
             new_tree = self.tree_proposal.draw(current_tree)
+            self.assertTrue(new_tree is current_tree)  # moves are done in place
             nleafs_new = len(new_tree.terminalNodes)
-            nleafs_old = len(current_tree.terminalNodes)
             if self.tree_proposal._node is None or self.tree_proposal._node.feature is None:
                 # make sure tree configuration is not updated
                 self.assertEqual(nleafs_new, nleafs_old)
@@ -73,22 +76,34 @@ class ProposalTestCase(unittest.TestCase):
                 # make sure there is one less terminal node
                 self.assertEqual(nleafs_new, nleafs_old - 1)
 
-            current_tree = new_tree
+            if np.random.uniform() < 0.5:
+                # make sure rolling back the move restores the tree configuration
+                self.tree_proposal.rollback(new_tree)
+                self.assertEqual(len(current_tree.terminalNodes), nleafs_old)
+                self.assertTrue(np.all(current_tree.leaf_of == leaf_of_old))
+                self.assertEqual(current_tree.version, version_old)
+            else:
+                self.tree_proposal.commit(new_tree)
+            self.assertTrue(np.all(current_tree.leaf_of == current_tree.apply(self.X)))
 
     def test_logdensity(self):
         # make sure ratio of transition kernels matches the values computed directly
         current_tree = self.tree.value
         ntrials = 1000
         for i in xrange(ntrials):
+            # moves are done in place, so get the values for the current tree before drawing the proposal
+            nleafs_old = len(current_tree.terminalNodes)
+            nparents_old = len(current_tree.get_terminal_parents())
+            logprior_old = self.tree.logprior(current_tree)
             new_tree = self.tree_proposal.draw(current_tree)
             logratio = self.tree_proposal.logdensity(current_tree, new_tree, True)
             logratio = -logratio  # sign of output agrees with MetroStep.accept, reverse for convention of this test
             nleafs_new = len(new_tree.terminalNodes)
-            nleafs_old = len(current_tree.terminalNodes)
 
             if self.tree_proposal._node is None or self.tree_proposal._node.feature is None:
                 # tree configuration is not updated
                 self.assertAlmostEqual(logratio, 0.0)
+                self.tree_proposal.rollback(new_tree)
                 continue
 
             elif self.tree_proposal._operation == 'grow':
@@ -98,15 +113,33 @@ class ProposalTestCase(unittest.TestCase):
                 log_backward = -np.log(len(new_tree.get_terminal_parents()))
 
             else:
-                log_forward = -np.log(len(current_tree.get_terminal_parents()))
+                log_forward = -np.log(nparents_old)
                 # reverse mode is grow update
                 log_backward = -np.log(nleafs_new) - np.log(new_tree.n_features) - np.log(self.tree_proposal._node.npts)
 
-            logratio_direct = self.tree.logprior(new_tree) - log_forward - \
-                (self.tree.logprior(current_tree) - log_backward)
+            logratio_direct = self.tree.logprior(new_tree) - log_forward - (logprior_old - log_backward)
             self.assertAlmostEqual(logratio, logratio_direct)
 
-            current_tree = new_tree
+            self.tree_proposal.commit(new_tree)
+
+    def test_log_ratio(self):
+        # make sure the Metropolis-Hastings ratio computed from the nodes changed by the move agrees with the one
+        # computed from the log-likelihood of the entire tree
+        metro_step = BartTreeStep(self.tree, self.tree_proposal)
+        current_tree = self.tree.value
+        ntrials = 1000
+        for i in xrange(ntrials):
+            loglik_old = self.tree.loglik(current_tree)
+            new_tree = self.tree_proposal.draw(current_tree)
+            loglik_new = self.tree.loglik(new_tree)
+            log_transition = self.tree_proposal.logdensity(current_tree, new_tree, True)
+            logratio = metro_step.log_ratio(new_tree, current_tree)
+            self.assertAlmostEqual(logratio, loglik_new - loglik_old - log_transition)
+            if np.random.uniform() < 0.5:
+                self.tree_proposal.rollback(new_tree)
+                self.assertAlmostEqual(self.tree.loglik(current_tree), loglik_old)
+            else:
+                self.tree_proposal.commit(new_tree)
 
     def test_mcmc(self):
         # run a simple MCMC sampler for the tree configuration to make sure that we correctly constrain the number of
@@ -115,7 +148,7 @@ class ProposalTestCase(unittest.TestCase):
         niter = 5000
         true_nleaves = len(self.tree.value.terminalNodes)
         true_ninodes = len(self.tree.value.internalNodes)
-        metro_step = steps.MetroStep(self.tree, self.tree_proposal, niter)
+        metro_step = BartTreeStep(self.tree, self.tree_proposal, niter)
         nleaves = np.zeros(niter)
         ninodes = np.zeros(niter)
 
@@ -1,11 +1,16 @@
 __author__ = 'brandonkelly'
 
+import os
+import functools
 import unittest
+import shutil
+import tempfile
 import numpy as np
 from scipy import stats, integrate
 from tree import *
 import matplotlib.pyplot as plt
 from test_tree_parameters import build_test_data
+from test_samplers import CrashStep
 
 
 def build_friedman_data(nsamples, nfeatures):
@@ -82,11 +87,36 @@ class SamplerTestCase(unittest.TestCase):
         self.assertTrue(mcmc_samples.samples[self.model.sigsqr.name][0] == self.model.sigsqr.value)
         for tree in self.model.trees:
             self.assertEqual(len(mcmc_samples.samples[tree.name]), 1)
-            self.assertTrue(mcmc_samples.samples[tree.name][0] == tree.value)
+            # trees are updated in place, so the saved value is a copy of the tree configuration
+            saved_tree = mcmc_samples.samples[tree.name][0]
+            self.assertFalse(saved_tree is tree.value)
+            self.assertEqual(len(saved_tree.terminalNodes), len(tree.value.terminalNodes))
+            self.assertTrue(np.all(saved_tree.apply(self.X) == tree.value.leaf_of))
         for mu in self.model.mus:
             self.assertEqual(len(mcmc_samples.samples[mu.name]), 1)
             self.assertTrue(np.all(mcmc_samples.samples[mu.name][0] == mu.value))
 
+    def test_shared_trees(self):
+        # make sure unchanged tree configurations are shared between samples, and that the samples still predict the
+        # fitted values of the model
+        model = BartModel(self.X, self.y.copy(), m=10, alpha=self.alpha, beta=self.beta)
+        model.start()
+        fits = []
+        for i in range(20):
+            model._steps[1].do_step()
+            model.save_values()
+            fit = np.zeros(self.y.size)
+            for tree, mu in zip(model.trees, model.mus):
+                fit += BartStep.node_mu(tree.value, mu)
+            fits.append(model.ymin + (model.ymax - model.ymin) * (fit + 0.5))
+
+        nshared = 0
+        for tree in model.trees:
+            saved_trees = model.mcmc_samples.samples[tree.name]
+            nshared += sum(saved_trees[i] is saved_trees[i-1] for i in range(1, len(saved_trees)))
+        self.assertGreater(nshared, 0)
+        self.assertTrue(np.allclose(model.mcmc_samples.predict(self.X), np.column_stack(fits)))
+
     def test_predict(self):
         # generate a single tree
         tree, mu = build_test_data(self.X, self.true_sigsqr)
@@ -103,6 +133,241 @@ class SamplerTestCase(unittest.TestCase):
         for i in xrange(self.X.shape[0]):
             self.assertAlmostEqual(ypredict[i], mu_map[i])
 
+    def test_predict_draws(self):
+        # make sure each MCMC sample is evaluated separately, and agrees with dropping the data down the trees one-by-one
+        nmcmc = 3
+        bart_sample = BartSample(self.y, 2, {}, Xtrain=self.X)
+        bart_sample.samples['sigsqr'] = [1.0] * nmcmc
+        for m in range(2):
+            bart_sample.samples['BART ' + str(m+1)] = []
+            bart_sample.samples['Mu ' + str(m+1)] = []
+            for i in range(nmcmc):
+                tree = BaseTree(self.X, self.y, min_samples_leaf=1)
+                for j in range(5 * i):
+                    tree.grow()
+                mu = np.random.standard_normal(len(tree.terminalNodes))
+                bart_sample.samples['BART ' + str(m+1)].append(tree.snapshot())
+                bart_sample.samples['Mu ' + str(m+1)].append(mu)
+
+        ypredict = bart_sample.predict(self.X)
+        self.assertEqual(ypredict.shape, (self.X.shape[0], nmcmc))
+        for i in range(nmcmc):
+            yi = np.zeros(self.X.shape[0])
+            for m in range(2):
+                tree = bart_sample.samples['BART ' + str(m+1)][i]
+                mu = bart_sample.samples['Mu ' + str(m+1)][i]
+                yi += mu[tree.leaf_positions()[tree.apply(self.X)]]
+            yi = bart_sample.ymin + (bart_sample.ymax - bart_sample.ymin) * (yi + 0.5)
+            self.assertTrue(np.allclose(ypredict[:, i], yi))
+
+        # the compiled trees are rebuilt when a list of samples is replaced by another one of the same length
+        bart_sample.samples['Mu 1'] = [2.0 * mu for mu in bart_sample.samples['Mu 1']]
+        self.assertFalse(np.allclose(bart_sample.predict(self.X), ypredict))
+
+    def test_predict_chunks(self):
+        tree, mu = build_test_data(self.X, self.true_sigsqr)
+        bart_sample = BartSample(tree.y, 1, {}, Xtrain=self.X)
+        nmcmc = 4
+        bart_sample.samples['sigsqr'] = [0.0] * nmcmc
+        bart_sample.samples['BART 1'] = [tree] * nmcmc
+        bart_sample.samples['Mu 1'] = [mu + np.random.standard_normal(mu.size) for i in range(nmcmc)]
+        ypredict = bart_sample.predict(self.X)
+
+        # make sure the chunks add up to the predictions for all of the rows at once
+        chunks = list(bart_sample.predict_chunks(self.X, chunk_size=30))
+        self.assertEqual(len(chunks), 4)
+        self.assertTrue(np.allclose(np.vstack(chunks), ypredict))
+        ymean = np.concatenate(list(bart_sample.predict_chunks(self.X, chunk_size=30, summary='mean')))
+        self.assertTrue(np.allclose(ymean, ypredict.mean(axis=1)))
+        yquant = np.vstack(list(bart_sample.predict_chunks(self.X, chunk_size=30, summary='quantiles',
+                                                           quantiles=(10.0, 90.0))))
+        self.assertEqual(yquant.shape, (self.X.shape[0], 2))
+        self.assertTrue(np.allclose(yquant, np.percentile(ypredict, (10.0, 90.0), axis=1).T))
+
+        self.assertRaises(ValueError, lambda: list(bart_sample.predict_chunks(self.X, summary='median')))
+
+    def test_predict_summary(self):
+        tree, mu = build_test_data(self.X, self.true_sigsqr)
+        bart_sample = BartSample(tree.y, 1, {}, Xtrain=self.X)
+        nmcmc = 500
+        bart_sample.samples['sigsqr'] = [0.0] * nmcmc
+        bart_sample.samples['BART 1'] = [tree] * nmcmc
+        bart_sample.samples['Mu 1'] = [mu + np.random.standard_normal(mu.size) for i in range(nmcmc)]
+        ypredict = bart_sample.predict(self.X)
+
+        summary = bart_sample.predict_summary(self.X, percentiles=(5.0, 95.0), draw_block=64)
+        self.assertEqual(summary.count, nmcmc)
+        self.assertTrue(np.allclose(summary.mean, ypredict.mean(axis=1)))
+        self.assertTrue(np.allclose(summary.variance, ypredict.var(axis=1, ddof=1)))
+        ysigma = ypredict.std(axis=1)
+        yquant = np.percentile(ypredict, (5.0, 95.0), axis=1).T
+        self.assertTrue(np.all(np.abs(summary.quantiles() - yquant) < 0.1 * ysigma[:, np.newaxis]))
+
+    def test_archive(self):
+        # make sure the archived MCMC samples give the same predictions as the ones in memory
+        nmcmc = 4
+        cutpoints = CutpointGrid(self.X, 20)
+        Xcodes = cutpoints.transform(self.X)
+        bart_sample = BartSample(self.y, 2, {}, Xtrain=self.X, cutpoints=cutpoints)
+        bart_sample.samples['sigsqr'] = list(np.random.chisquare(4, nmcmc))
+        for m in range(2):
+            bart_sample.samples['BART ' + str(m+1)] = []
+            bart_sample.samples['Mu ' + str(m+1)] = []
+            for i in range(nmcmc):
+                tree = BaseTree(Xcodes, self.y, min_samples_leaf=1, cutpoints=cutpoints)
+                for j in range(4 * i):
+                    tree.grow()
+                for j in range(i):
+                    tree.prune()
+                mu = np.random.standard_normal(len(tree.terminalNodes))
+                bart_sample.samples['BART ' + str(m+1)].append(tree.snapshot())
+                bart_sample.samples['Mu ' + str(m+1)].append(mu)
+        ypredict = bart_sample.predict(self.X)
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            for compress in (False, True):
+                path = os.path.join(tempdir, 'archive' + str(compress))
+                bart_sample.save_archive(path, compress=compress)
+                archive = ForestArchive(path)
+                self.assertEqual(archive.ndraws, nmcmc)
+                self.assertEqual(archive.compress, compress)
+                self.assertTrue(np.allclose(archive.sigsqr, bart_sample.samples['sigsqr']))
+                self.assertTrue(np.allclose(archive.predict(self.X), ypredict))
+                self.assertTrue(np.allclose(archive.predict(self.X, draws=[3, 1]), ypredict[:, [3, 1]]))
+                self.assertTrue(np.allclose(archive.predict(self.X, draws=slice(1, 3)), ypredict[:, 1:3]))
+                records, sizes = archive.read_draw(2)
+                self.assertEqual(sizes.size, 2)
+                self.assertEqual(records.size, sizes.sum())
+
+            # now make sure the samples are archived as they are generated
+            path = os.path.join(tempdir, 'model')
+            model = BartModel(self.X, self.y.copy(), m=10, alpha=self.alpha, beta=self.beta, numcut=20, archive=path)
+            # only the codes of the features are kept
+            self.assertTrue(np.all(model.X == model.cutpoints.transform(self.X)))
+            self.assertTrue(model.mcmc_samples.Xtrain is model.X)
+            self.assertTrue(model.trees[0].value.X is model.X)
+            model.start()
+            for i in range(3):
+                model._steps[1].do_step()
+                model.save_values()
+            archive = ForestArchive(path)
+            self.assertEqual(archive.ndraws, 3)
+            self.assertTrue(np.allclose(archive.predict(self.X), model.mcmc_samples.predict(self.X)))
+
+            # a restart replaces the archived samples, as it does the samples in memory
+            restarted = model.restart(4)
+            archive = ForestArchive(path)
+            self.assertEqual(len(restarted.samples['sigsqr']), 4)
+            self.assertEqual(archive.ndraws, 4)
+            self.assertEqual(archive.sigsqr.size, 4)
+            self.assertEqual(len(model._logliks), 4)
+            self.assertTrue(np.allclose(archive.predict(self.X), restarted.predict(self.X)))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_checkpoint_resume(self):
+        # make sure that a run resumed from a checkpoint gives the same samples as an uninterrupted run
+        tempdir = tempfile.mkdtemp()
+        try:
+            checkpoint = os.path.join(tempdir, 'checkpoint')
+            path = os.path.join(tempdir, 'archive')
+
+            model = BartModel(self.X, self.y.copy(), m=10, alpha=self.alpha, beta=self.beta, numcut=20)
+            np.random.seed(42)
+            expected = model.run(10, 30)
+
+            model = BartModel(self.X, self.y.copy(), m=10, alpha=self.alpha, beta=self.beta, numcut=20, archive=path)
+            model.add_step(CrashStep(10 + 25))
+            np.random.seed(42)
+            self.assertRaises(RuntimeError, model.run, 10, 30, checkpoint=checkpoint, checkpoint_every=10)
+
+            model = BartModel(self.X, self.y.copy(), m=10, alpha=self.alpha, beta=self.beta, numcut=20, archive=path)
+            model.add_step(CrashStep())
+            resumed = model.resume(checkpoint, checkpoint_every=10)
+            self.assertEqual(len(resumed.samples['sigsqr']), 30)
+            self.assertTrue(np.all(np.array(resumed.samples['sigsqr']) == np.array(expected.samples['sigsqr'])))
+            for m in range(10):
+                mname = 'Mu ' + str(m + 1)
+                for mu, expected_mu in zip(resumed.samples[mname], expected.samples[mname]):
+                    self.assertTrue(np.all(mu == expected_mu))
+            self.assertTrue(np.all(resumed.predict(self.X) == expected.predict(self.X)))
+            self.assertEqual(len(model._logliks), 30)
+            # the journaled tree configurations are shared between samples in the same way
+            for m in range(10):
+                bname = 'BART ' + str(m + 1)
+                self.assertEqual(len(set(id(tree) for tree in resumed.samples[bname])),
+                                 len(set(id(tree) for tree in expected.samples[bname])))
+
+            # the samples generated after the checkpoint and before the crash are not archived twice
+            self.assertTrue(model.archive._files is None)  # the archive is closed when the run is done
+            archive = ForestArchive(path)
+            self.assertEqual(archive.ndraws, 30)
+            self.assertTrue(np.allclose(archive.predict(self.X), expected.predict(self.X)))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_run_chains(self):
+        # make sure the MCMC samples of several chains are merged
+        build_model = functools.partial(BartModel, m=10, alpha=self.alpha, beta=self.beta, numcut=20)
+        merged = samplers.run_chains(build_model, 2, 10, 15, seed=1, shared={'X': self.X, 'y': self.y}, processes=2)
+        self.assertEqual(merged.nchains, 2)
+        self.assertEqual(len(merged.samples['sigsqr']), 30)
+        sigsqr_chains = merged.get_chains('sigsqr')
+        self.assertEqual(len(sigsqr_chains), 2)
+        self.assertEqual(sigsqr_chains[1], merged.samples['sigsqr'][15:])
+        self.assertNotEqual(sigsqr_chains[0], sigsqr_chains[1])
+        self.assertEqual(merged.predict(self.X).shape, (self.X.shape[0], 30))
+
+    def test_profiler(self):
+        # make sure the time spent in the tree updates is split by the type of move
+        model = BartModel(self.X, self.y.copy(), m=10, alpha=self.alpha, beta=self.beta)
+        profiler = samplers.StepProfiler()
+        model.set_profiler(profiler)
+        self.assertTrue(model._steps[1].profiler is profiler)
+        model.run(20, 30)
+
+        summary = dict((entry['name'], entry) for entry in profiler.summary())
+        niter = 20 + 30
+        self.assertEqual(profiler.niter, niter)
+        self.assertEqual(summary['sigsqr']['calls'], niter)
+        self.assertEqual(summary['BartStep']['calls'], niter)
+        self.assertEqual(summary['tree moments']['calls'], 10 * niter)
+        self.assertEqual(summary['tree mu']['calls'], 10 * niter)
+        self.assertEqual(summary['tree grow']['calls'] + summary['tree prune']['calls'], 10 * niter)
+        naccept = sum(tree_step.naccept for tree_step in model._steps[1].tree_steps)
+        nmoves = summary['tree grow']['calls'] * summary['tree grow']['acceptance'] + \
+            summary['tree prune']['calls'] * summary['tree prune']['acceptance']
+        self.assertAlmostEqual(nmoves, naccept)
+        for name in ('tree grow', 'tree prune'):
+            self.assertTrue(0.0 <= summary[name]['failure'] <= 1.0)
+        # the sub-timers of the tree updates are part of the time of the BART step
+        self.assertLess(sum(summary[name]['seconds'] for name in ('tree moments', 'tree grow', 'tree prune', 'tree mu')),
+                        summary['BartStep']['seconds'])
+
+    def test_parallel_tempering(self):
+        build_model = functools.partial(BartModel, m=10, alpha=self.alpha, beta=self.beta, numcut=20)
+        model = build_model(X=self.X, y=self.y)
+        model.set_temperature(2.0)
+        self.assertEqual(model.sigsqr._temperature, 2.0)
+        self.assertTrue(all(tree._temperature == 2.0 and mu._temperature == 2.0
+                            for tree, mu in zip(model.trees, model.mus)))
+
+        sampler = samplers.ParallelTempering(build_model, [1.0, 1.5, 2.25], swap_every=2, seed=1,
+                                             shared={'X': self.X, 'y': self.y})
+        bart_sample = sampler.run(10, 20, thin=2)
+        self.assertEqual(len(bart_sample.samples['sigsqr']), 20)
+        for name, values in bart_sample.samples.items():
+            self.assertEqual(len(values), 20)
+            self.assertTrue(all(value is not None for value in values))
+        # swaps are proposed between the even and odd pairs of neighbouring temperatures in turn
+        nrounds = (10 + 20 * 2) // 2
+        self.assertEqual(list(sampler.nswaps), [(nrounds + 1) // 2, nrounds // 2])
+        self.assertTrue(np.all(sampler.swap_rates >= 0.0) and np.all(sampler.swap_rates <= 1.0))
+        self.assertEqual(bart_sample.predict(self.X).shape, (self.X.shape[0], 20))
+
+        self.assertRaises(ValueError, samplers.ParallelTempering, build_model, [2.0, 1.0])
+
     def test_sampler(self):
         """
         Test the MCMC sampler for a BART model by comparing f(x) = E(y|x) from BART model with true value, generated
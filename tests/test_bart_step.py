@@ -111,6 +111,19 @@ class StepTestCase(unittest.TestCase):
             self.assertNotAlmostEqual(leaf.ybar, ybar_old)
             n_idx += 1
 
+    def test_fit(self):
+        # make sure the running sum of trees stays in sync with the trees and the y-values are restored
+        self.bart_step.compute_fit()
+        self.assertTrue(np.allclose(self.bart_step.fit, self.mu_map))
+        for i in xrange(20):
+            self.bart_step.do_step()
+            treesum = np.zeros(len(self.y))
+            for tree, mu in zip(self.forest, self.mu_list):
+                treesum += self.bart_step.node_mu(tree.value, mu)
+                self.assertTrue(np.all(tree.y == self.y))
+            self.assertTrue(np.allclose(self.bart_step.fit, treesum))
+            self.assertTrue(np.allclose(self.bart_step.resids, self.y - treesum))
+
     def test_step_mcmc(self):
         # Tests:
         # 1) Make sure that the y-values are updated, i.e., tree.y != resids
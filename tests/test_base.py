@@ -1,6 +1,6 @@
 import unittest
 import numpy as np
-from tree import BaseTree
+from tree import BaseTree, CutpointGrid
 
 class BaseTreeTestCases(unittest.TestCase):
     def setUp(self):
@@ -247,6 +247,114 @@ class BaseTreeTestCases(unittest.TestCase):
                 else:
                     self.assertTrue(False not in plinko[:,idxA])
 
+    def testApply(self):
+        # Set up a tree that looks like
+        #         0
+        #        / \
+        #       1   2
+        #      / \
+        #     3   4
+        n1, n2 = self.tree.split(self.tree.head, 1, 0.0) # nodes 1=L, 2=R
+        n3, n4 = self.tree.split(self.tree.head.Left, 6, 0.25) # nodes 3=L, 4=R
+        leaf = self.tree.apply(self.X)
+        for node in self.tree.terminalNodes:
+            in_node = np.all(self.tree.plinko(node, self.X), axis=1)
+            self.assertTrue(np.all((leaf == node._index) == in_node))
+
+        positions = self.tree.leaf_positions()
+        for n_idx, node in enumerate(self.tree.terminalNodes):
+            self.assertTrue(positions[node._index] == n_idx)
+        self.assertTrue(positions[self.tree.head._index] == -1)
+        self.assertTrue(positions[n1._index] == -1)
+
+    def testLeafIndex(self):
+        # Grow and prune a random tree, and make sure the data points tracked in each node agree with the ones
+        # obtained by dropping the data down the tree
+        for i in range(50):
+            if np.random.uniform() < 0.6:
+                self.tree.grow()
+            else:
+                self.tree.prune()
+            self.assertTrue(np.all(self.tree.leaf_of == self.tree.apply(self.X)))
+            for node in self.tree.terminalNodes + self.tree.internalNodes:
+                in_node = np.all(self.tree.plinko(node, self.X), axis=1)
+                rows = self.tree.node_rows(node)
+                self.assertTrue(len(rows) == node.npts)
+                self.assertTrue(np.all(np.sort(rows) == np.where(in_node)[0]))
+
+    def testCutpoints(self):
+        grid = CutpointGrid(self.X, numcut=20)
+        codes = grid.transform(self.X)
+        self.assertTrue(codes.dtype == np.uint8)
+        self.assertTrue(codes.shape == self.X.shape)
+        self.assertTrue(CutpointGrid(self.X, numcut=1000).transform(self.X).dtype == np.uint16)
+        # the split rules on the codes must be the same as the split rules on the feature values
+        for j in range(self.nfeatures):
+            self.assertTrue(len(grid.cutpoints[j]) <= 20)
+            for c in range(len(grid.cutpoints[j])):
+                self.assertTrue(np.all((codes[:, j] <= c) == (self.X[:, j] <= grid.threshold(j, c))))
+
+        # a tree built on the codes should put each data point in the same leaf as one built on the values
+        tree = BaseTree(codes, self.y, min_samples_leaf=1, cutpoints=grid)
+        for i in range(20):
+            tree.grow()
+        self.assertTrue(np.all(tree.leaf_of == tree.apply(grid.transform(self.X))))
+        for node in tree.internalNodes:
+            feature = node.feature
+            threshold = grid.threshold(feature, node.threshold)
+            rows = tree.node_rows(node)
+            nleft = np.count_nonzero(self.X[rows, feature] <= threshold)
+            self.assertTrue(nleft == node.Left.npts)
+
+    def testNodeLists(self):
+        # Grow and prune a random tree, and make sure the node lists that are updated in place agree with the ones
+        # computed from scratch
+        for i in range(50):
+            if np.random.uniform() < 0.6:
+                self.tree.grow()
+            else:
+                self.tree.prune()
+            nodes = self.tree.nodes
+            terminal = [x._index for x in self.tree.terminalNodes]
+            internal = [x._index for x in self.tree.internalNodes]
+            nog = [x._index for x in self.tree.get_terminal_parents()]
+            for n_idx, j in enumerate(terminal):
+                self.assertTrue(nodes.pos[j] == n_idx)
+            for n_idx, j in enumerate(internal):
+                self.assertTrue(nodes.pos[j] == n_idx)
+            for n_idx, j in enumerate(nog):
+                self.assertTrue(nodes.nogpos[j] == n_idx)
+
+            self.tree.calcTerminalNodes()
+            self.tree.calcInternalNodes()
+            self.assertTrue(sorted(terminal) == sorted([x._index for x in self.tree.terminalNodes]))
+            self.assertTrue(sorted(internal) == sorted([x._index for x in self.tree.internalNodes]))
+            self.assertTrue(sorted(nog) == sorted([x._index for x in self.tree.get_terminal_parents()]))
+
+    def testVersion(self):
+        # the version changes whenever the tree configuration changes, and snapshots keep the version
+        version = self.tree.version
+        left, right = self.tree.split(self.tree.head, 1, 0.0)
+        self.assertTrue(self.tree.version > version)
+        version = self.tree.version
+        self.assertTrue(self.tree.snapshot().version == version)
+        self.tree.split(left, 2, 10.0)  # leaves an empty node, so does not change the configuration
+        self.assertTrue(self.tree.version == version)
+        self.tree.prune()
+        self.assertTrue(self.tree.version > version)
+
+    def testUpdateMoments(self):
+        for i in range(10):
+            self.tree.grow()
+        # change the y-values, and make sure all terminal nodes are updated at once
+        self.tree.y = np.random.standard_normal(self.nsamples)
+        self.tree.update_moments()
+        for node in self.tree.terminalNodes:
+            idx = self.tree.plinko(node, self.X).all(axis=1)
+            self.assertTrue(np.sum(idx) == node.npts)
+            self.assertAlmostEqual(node.ybar, np.mean(self.tree.y[idx]))
+            self.assertAlmostEqual(node.yvar, np.var(self.tree.y[idx]))
+
     def testFilter(self):
         headId = self.tree.head.Id
         # Set up a tree that looks like
@@ -52,5 +52,72 @@ def test_CholUpdateR1():
     assert frac_diff.max() < 1e-8
     print "Testing of CholUpdateR1 passed."
 
+
+def test_RunningSummary():
+    """
+    Compare the online mean, variance and percentiles from misc.RunningSummary with the values computed from all of
+    the samples at once.
+    """
+    nvars = 20
+    nsamples = 2000
+    scale = np.arange(1.0, nvars + 1.0)
+    samples = 3.0 + scale[:, np.newaxis] * np.random.standard_normal((nvars, nsamples))
+
+    summary = misc.RunningSummary(nvars, (5.0, 50.0, 95.0))
+    for start in xrange(0, nsamples, 30):
+        summary.update(samples[:, start:start + 30])
+
+    assert summary.count == nsamples
+    assert np.allclose(summary.mean, samples.mean(axis=1))
+    assert np.allclose(summary.variance, samples.var(axis=1, ddof=1))
+    # the percentiles are only estimated, so compare with the spread of the samples
+    percentiles = np.percentile(samples, (5.0, 50.0, 95.0), axis=1).T
+    assert summary.quantiles().shape == (nvars, 3)
+    assert np.all(np.abs(summary.quantiles() - percentiles) < 0.1 * scale[:, np.newaxis])
+    print "Testing of RunningSummary passed."
+
+
+def test_effective_samples():
+    """
+    Compare the autocorrelation time and effective number of samples from the FFT-based estimators with the values
+    for an AR(1) process, and test the split-R-hat diagnostic.
+    """
+    phi = 0.8
+    nchains = 4
+    nsamples = 5000
+    noise = np.random.standard_normal((nchains, nsamples, 3))
+    chains = np.zeros(noise.shape)
+    chains[:, 0] = noise[:, 0] / np.sqrt(1.0 - phi ** 2)
+    for t in xrange(1, nsamples):
+        chains[:, t] = phi * chains[:, t - 1] + noise[:, t]
+
+    # the autocorrelation function of an AR(1) process is phi ** lag
+    acov = misc.autocovariance(chains)
+    assert acov.shape == (nchains, nsamples, 3)
+    assert np.allclose(acov[:, 0], chains.var(axis=1))
+    assert np.all(np.abs(acov[:, 1] / acov[:, 0] - phi) < 0.05)
+
+    # compare with the direct computation of the autocorrelation function
+    centered = chains[1, :, 2] - chains[1, :, 2].mean()
+    acf = np.correlate(centered, centered, 'full')[nsamples - 1:nsamples + 99]
+    assert np.allclose(misc.autocorrelation(chains, maxlag=99)[1, :, 2], acf / acf[0])
+
+    true_tau = (1.0 + phi) / (1.0 - phi)
+    tau = misc.autocorr_timescale(chains)
+    assert tau.shape == (3,)
+    # the estimates are noisy, so compare their average with the true value
+    assert np.abs(tau.mean() - true_tau) < 0.25 * true_tau
+    neffective = misc.effective_samples(chains)
+    assert np.allclose(neffective, nchains * nsamples / tau)
+    assert misc.effective_samples(chains[0, :, 0]).shape == (1,)
+
+    # chains sampling the same distribution have converged, but not when one of them is offset
+    assert np.all(misc.split_rhat(chains) < 1.01)
+    chains[0] += 2.0
+    assert np.all(misc.split_rhat(chains) > 1.05)
+    print "Testing of effective_samples and split_rhat passed."
+
 if __name__ == "__main__":
-    test_CholUpdateR1()
\ No newline at end of file
+    test_CholUpdateR1()
+    test_RunningSummary()
+    test_effective_samples()
\ No newline at end of file
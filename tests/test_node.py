@@ -1,6 +1,6 @@
 import unittest
 import numpy as np
-from tree import Node
+from tree import Node, TreeArrays
 
 class NodeTestCases(unittest.TestCase):
     def testSlots(self):
@@ -49,5 +49,37 @@ class NodeTestCases(unittest.TestCase):
         assert(left._yvar == 1.0)
         assert(left._npts == 100)
 
+    def testArrays(self):
+        arrays = TreeArrays(capacity=2)
+        head  = Node(None, None, arrays)
+        left  = Node(head, True)
+        right = Node(head, False)
+        # children share the storage of their parent, which grows as needed
+        self.assertTrue(left._arrays is arrays)
+        self.assertTrue(arrays.capacity >= 3)
+        self.assertTrue(arrays.left[head._index] == left._index)
+        self.assertTrue(arrays.right[head._index] == right._index)
+        self.assertTrue(arrays.parent[right._index] == head._index)
+
+        # node values are views of the arrays
+        right.ybar = 3.0
+        right.npts = 10
+        head.feature = 1
+        head.threshold = 0.5
+        self.assertTrue(arrays.ybar[right._index] == 3.0)
+        self.assertTrue(arrays.npts[right._index] == 10)
+        self.assertTrue(arrays.feature[head._index] == 1)
+        self.assertTrue(arrays.threshold[head._index] == 0.5)
+
+        # released rows are recycled
+        index = right._index
+        head.Right = None
+        arrays.release(index)
+        self.assertTrue(head.Right is None)
+        other = Node(head, False)
+        self.assertTrue(other._index == index)
+        self.assertTrue(other.ybar == 0.0)
+        self.assertTrue(head.Right is other)
+
 if __name__ == "__main__":
     unittest.main()
@@ -4,6 +4,12 @@ Test the classes in samplers.py. This will test the MCMC sampler by running vari
 
 __author__ = 'Brandon C. Kelly'
 
+import os
+import json
+import cPickle
+import shutil
+import tempfile
+import multiprocessing
 import numpy as np
 import tests.test_steps as tsteps
 import steps, samplers, priors, proposals
@@ -127,7 +133,388 @@ def test_generate_from_file():
     """
     Test the method of the MCMCSample class that construct a MCMCSample object from a asciifile.
     """
-    pass
+    tempdir = tempfile.mkdtemp()
+    try:
+        values = {"mu": np.random.standard_normal(1000), "theta": np.random.standard_normal((1000, 3))}
+        filenames = []
+        for name, trace in values.items():
+            fname = os.path.join(tempdir, name + ".txt")
+            np.savetxt(fname, trace, header=name, comments="")
+            filenames.append(fname)
+
+        for processes in (2, 1):
+            # the first load parses the files and caches them, the second one memory-maps the cache
+            mcmc_samples = samplers.MCMCSample()
+            mcmc_samples.generate_from_file(filenames, processes=processes)
+            assert sorted(mcmc_samples.samples.keys()) == ["mu", "theta"]
+            for fname in filenames:
+                assert os.path.exists(fname + ".npy")
+            assert isinstance(mcmc_samples.samples["theta"], np.memmap)
+            assert mcmc_samples.samples["mu"].shape == (1000, 1)
+            assert np.all(mcmc_samples.samples["mu"][:, 0] == values["mu"])
+            assert np.all(mcmc_samples.samples["theta"] == values["theta"])
+
+        # without the cache
+        mcmc_samples = samplers.MCMCSample()
+        mcmc_samples.generate_from_file(filenames, cache=False)
+        assert np.allclose(mcmc_samples.samples["theta"], values["theta"])
+        assert not isinstance(mcmc_samples.samples["theta"], np.memmap)
+
+        # comment and blank lines are skipped, bad values or ragged rows raise an error and are never cached
+        fname = os.path.join(tempdir, "comments.txt")
+        with open(fname, "w") as f:
+            f.write("mu\n# a comment\n1.0 2.0\n\n3.0 4.0\n")
+        mcmc_samples = samplers.MCMCSample()
+        mcmc_samples.generate_from_file([fname])
+        assert np.all(mcmc_samples.samples["mu"] == np.array([[1.0, 2.0], [3.0, 4.0]]))
+        for contents in ("mu\n1.0\n2.0\nbad\n3.0\n", "mu\n1.0 2.0\n3.0\n4.0 5.0\n"):
+            fname = os.path.join(tempdir, "bad.txt")
+            with open(fname, "w") as f:
+                f.write(contents)
+            mcmc_samples = samplers.MCMCSample()
+            try:
+                mcmc_samples.generate_from_file([fname])
+                assert False, "A malformed file of MCMC samples did not raise an error."
+            except ValueError as error:
+                assert fname in str(error)
+            assert not os.path.exists(fname + ".npy")
+        assert sorted(f for f in os.listdir(tempdir) if f.endswith(".npy")) == \
+            sorted(os.path.basename(fname) + ".npy" for fname in filenames + [os.path.join(tempdir, "comments.txt")])
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_memmap_traces():
+    """
+    Test the MCMCSample backend that stores the traces in memory-mapped files.
+    """
+    NormMean.SetVariance(NormVar)
+    NormVar.SetMean(NormMean)
+    tempdir = tempfile.mkdtemp()
+    try:
+        mcmc_samples = samplers.MCMCSample(directory=tempdir, flush_every=100)
+        BiNormRAM = steps.AdaptiveMetro(NormPar, UnitProp, np.identity(2), target_rate, 100)
+        NormSampler = samplers.Sampler([steps.GibbStep(NormMean), steps.GibbStep(NormVar), BiNormRAM],
+                                       mcmc_samples=mcmc_samples)
+        NormSamples = NormSampler.run(100, 250)
+        assert NormSamples is mcmc_samples
+        assert NormSamples.nsaved == 250
+
+        # the traces are read-only views of the memory-mapped arrays
+        mutrace = NormSamples.get_samples(NormMean.name)
+        assert not mutrace.flags.writeable
+        assert np.may_share_memory(mutrace, NormSamples.samples[NormMean.name])
+
+        # make sure the traces on disk are complete
+        loaded = samplers.MCMCSample.load(tempdir)
+        assert loaded.nsaved == 250
+        for name in (NormMean.name, NormVar.name, NormPar.name):
+            assert loaded.samples[name].shape == NormSamples.samples[name].shape
+            assert np.all(loaded.samples[name] == NormSamples.samples[name])
+
+        # traces that were never flushed, e.g., after a crash early in the run, can be loaded but hold no samples
+        mcmc_samples = samplers.MCMCSample(directory=os.path.join(tempdir, "crashed"), flush_every=100)
+        mcmc_samples.allocate("mu", (250, 1))
+        mcmc_samples.mark_saved(50)
+        loaded = samplers.MCMCSample.load(os.path.join(tempdir, "crashed"))
+        assert loaded.nsaved == 0
+        assert loaded.samples["mu"].shape == (0, 1)
+        mcmc_samples.close()
+    finally:
+        shutil.rmtree(tempdir)
+
+    print 'Test of memory-mapped traces was successful.'
+
+
+class CrashStep(steps.Step):
+    """
+    Step that raises an exception after a number of iterations, used to simulate a crash of the sampler.
+    """
+    def __init__(self, crash_iter=None):
+        steps.Step.__init__(self, steps.Parameter("crash", False))
+        self.crash_iter = crash_iter
+        self.niter = 0
+
+    def do_step(self):
+        self.niter += 1
+        if self.niter == self.crash_iter:
+            raise RuntimeError("Simulated crash of the sampler.")
+
+
+def test_checkpoint_resume():
+    """
+    Test that a run resumed from a checkpoint gives the same samples as an uninterrupted run.
+    """
+    def build_sampler(crash_iter, directory):
+        mean = tsteps.NormalMean(data, MuPrior, "mu", True, 1.0)
+        variance = tsteps.NormalVariance(data, VarPrior, "sigsqr", True, 1.0)
+        mean.SetVariance(variance)
+        variance.SetMean(mean)
+        binorm = tsteps.BivariateNormalMean(data2, np.identity(2), priors.Uninformative(), name="mu2")
+        ram = steps.AdaptiveMetro(binorm, proposals.MultiNormalProposal(np.identity(2)), np.identity(2), target_rate,
+                                  100)
+        return samplers.Sampler([steps.GibbStep(mean), steps.GibbStep(variance), ram, CrashStep(crash_iter)],
+                                mcmc_samples=samplers.MCMCSample(directory=directory, flush_every=20))
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        for directory in (None, os.path.join(tempdir, 'traces')):
+            checkpoint = os.path.join(tempdir, 'checkpoint')
+
+            np.random.seed(42)
+            expected = build_sampler(None, None).run(50, 100)
+
+            np.random.seed(42)
+            sampler = build_sampler(50 + 75, directory)
+            try:
+                sampler.run(50, 100, checkpoint=checkpoint, checkpoint_every=30)
+                assert False, "The sampler should have crashed."
+            except RuntimeError:
+                sampler.mcmc_samples.close()
+            with open(checkpoint, 'rb') as f:
+                state = cPickle.load(f)
+            # samples held in memory are journaled, so the checkpoint itself does not hold them
+            assert 'samples' not in state['samples']
+            assert ('journal' in state['samples']) == (directory is None)
+
+            np.random.seed(1)  # the random number generator is restored from the checkpoint
+            sampler = build_sampler(None, None)
+            resumed = sampler.resume(checkpoint, checkpoint_every=30)
+            assert resumed.nsaved == 100
+            assert resumed.directory == directory
+            for name in ("mu", "sigsqr", "mu2"):
+                assert np.all(resumed.samples[name] == expected.samples[name])
+
+            # the final state is saved in the checkpoint
+            sampler = build_sampler(None, None)
+            assert sampler.resume(checkpoint).nsaved == 100
+
+            # restart the sampler at the current values
+            restarted = sampler.restart(20)
+            assert restarted.nsaved == 20
+            assert restarted.samples["mu"].shape == (20,)
+    finally:
+        shutil.rmtree(tempdir)
+
+    print 'Test of checkpoint and resume was successful.'
+
+
+def build_normal_sampler(x):
+    """
+    Build a Gibbs sampler for the normal model of the data x. Used by the worker processes in test_run_chains.
+    """
+    mean = tsteps.NormalMean(x, MuPrior, "mu", True, 1.0)
+    variance = tsteps.NormalVariance(x, VarPrior, "sigsqr", True, 1.0)
+    mean.SetVariance(variance)
+    variance.SetMean(mean)
+    return samplers.Sampler([steps.GibbStep(mean), steps.GibbStep(variance)])
+
+
+def test_run_chains():
+    """
+    Test running several chains in parallel and merging their samples.
+    """
+    nchains = 3
+    merged = samplers.run_chains(build_normal_sampler, nchains, 100, 500, seed=1, shared={'x': data}, processes=2)
+    assert merged.nchains == nchains
+    assert merged.nsaved == nchains * 500
+    assert merged.samples["mu"].shape == (nchains * 500,)
+    mu_chains = merged.get_chains("mu")
+    assert mu_chains.shape == (nchains, 500)
+    assert np.all(mu_chains[1] == merged.samples["mu"][500:1000])
+
+    # the chains are independent, and each one samples the posterior
+    assert not np.any(mu_chains[0] == mu_chains[1])
+    for chain in mu_chains:
+        assert abs(chain.mean() - data.mean()) < 5.0 * chain.std()
+    assert merged.effective_samples("mu").shape == (1,)
+    assert np.all(merged.split_rhat("mu") < 1.05)
+
+    # the chains are reproducible from the seed
+    again = samplers.run_chains(build_normal_sampler, nchains, 100, 500, seed=1, shared={'x': data}, processes=2)
+    assert np.all(again.samples["mu"] == merged.samples["mu"])
+
+    print 'Test of running chains in parallel was successful.'
+
+
+def test_chain_worker_blas_threads():
+    """
+    Test that the worker processes of run_chains() use the requested number of BLAS threads.
+    """
+    if samplers._get_blas_threads() is None:
+        print 'Numpy is not linked to OpenBLAS or MKL, skipping the test of the number of BLAS threads.'
+        return
+    for blas_threads in (1, 3):
+        pool = multiprocessing.Pool(1, initializer=samplers._init_chain_worker, initargs=({}, blas_threads))
+        try:
+            assert pool.apply(samplers._get_blas_threads) == blas_threads
+        finally:
+            pool.close()
+            pool.join()
+
+
+def test_summarize():
+    """
+    Test the posterior summaries of an array-valued parameter against the values computed one element at a time.
+    """
+    mcmc_samples = samplers.MCMCSample()
+    traces = np.random.standard_normal((1001, 2, 3)) * np.arange(1.0, 7.0).reshape(2, 3)
+    mcmc_samples.samples["theta"] = traces
+    percentiles = (2.5, 50.0, 97.5)
+    summaries = mcmc_samples.summarize("theta", percentiles)
+    assert summaries.shape == (2, 3)
+    assert summaries['percentiles'].shape == (2, 3, 3)
+    for i in xrange(2):
+        for j in xrange(3):
+            assert np.allclose(summaries['percentiles'][i, j], np.percentile(traces[:, i, j], percentiles))
+            assert np.isclose(summaries['median'][i, j], np.median(traces[:, i, j]))
+            assert np.isclose(summaries['mean'][i, j], np.mean(traces[:, i, j]))
+            assert np.isclose(summaries['std'][i, j], np.std(traces[:, i, j]))
+    assert np.all(summaries['neffective'] > 0)
+    table = samplers.MCMCSample.format_summaries("theta", summaries)
+    assert len(table.splitlines()) == 2 + 6
+    assert table.splitlines()[1].split()[-3:] == ["2.5%", "50%", "97.5%"]
+
+    # a single percentile is still an array field
+    summaries = mcmc_samples.summarize("theta", (50.0,))
+    assert summaries['percentiles'].shape == (2, 3, 1)
+    assert np.allclose(summaries['percentiles'][..., 0], summaries['median'])
+    table = samplers.MCMCSample.format_summaries("theta", summaries)
+    assert table.splitlines()[1].split()[-1] == "50%"
+    assert len(table.splitlines()[2].split()) == 6
+
+
+def test_profiler():
+    """
+    Test the counters of a profiler attached to a sampler, and its snapshots.
+    """
+    mean = tsteps.NormalMean(data, MuPrior, "mu", True, 1.0)
+    variance = tsteps.NormalVariance(data, VarPrior, "sigsqr", True, 1.0)
+    mean.SetVariance(variance)
+    variance.SetMean(mean)
+    ram = steps.AdaptiveMetro(tsteps.BivariateNormalMean(data2, covar, priors.Uninformative(), "theta"),
+                              proposals.MultiNormalProposal(np.identity(2)), np.identity(2), 0.4, 100)
+    sampler = samplers.Sampler([steps.GibbStep(mean), steps.GibbStep(variance), ram])
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        snapshot_file = os.path.join(tempdir, 'profile.jsonl')
+        profiler = samplers.StepProfiler(snapshot_file, snapshot_every=50)
+        sampler.set_profiler(profiler)
+        sampler.run(100, 200, thin=2)
+
+        summary = profiler.report()
+        assert profiler.niter == 100 + 2 * 200
+        assert sorted(summary['name']) == ['mu', 'sigsqr', 'theta']
+        assert np.all(summary['calls'] == profiler.niter)
+        assert np.all(summary['seconds'] >= 0.0)
+        assert np.isclose(summary['fraction'].sum(), 1.0)
+        assert np.all(np.diff(summary['seconds']) <= 0.0)
+        ram_summary = summary[summary['name'] == 'theta'][0]
+        assert np.isclose(ram_summary['acceptance'], float(ram.naccept) / ram.niter)
+        assert np.all(np.isnan(summary[summary['name'] != 'theta']['acceptance']))
+        assert np.all(summary['failure'] == 0.0)
+
+        with open(snapshot_file, 'r') as f:
+            snapshots = [json.loads(line) for line in f]
+        assert [snapshot['iteration'] for snapshot in snapshots] == range(50, profiler.niter + 1, 50)
+        assert snapshots[-1]['timers']['theta']['calls'] == profiler.niter
+        assert snapshots[-1]['timers']['theta']['accepted'] == ram.naccept
+        assert snapshots[-1]['timers']['mu']['accepted'] is None
+
+        # without a profiler nothing is recorded
+        sampler.set_profiler(None)
+        sampler.restart(10)
+        assert profiler.niter == 100 + 2 * 200
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_merge_replicas():
+    """
+    Test merging the samples of the untempered chain saved by the replicas of a parallel tempering sampler.
+    """
+    replicas = [samplers.MCMCSample(), samplers.MCMCSample()]
+    replicas[0].samples["mu"] = np.array([0.0, 2.0, 3.0, -1.0])
+    replicas[1].samples["mu"] = np.array([1.0, 4.0, -1.0, -1.0])
+    merged = samplers.MCMCSample.merge_replicas(replicas, [[0, 2, 3], [1, 4]])
+    assert merged.nsaved == 5
+    assert np.all(merged.samples["mu"] == np.arange(5.0))
+
+
+def test_tempering_needs_loglik():
+    """
+    Test that parallel tempering refuses samplers without a loglik() method.
+    """
+    try:
+        samplers.ParallelTempering(samplers.Sampler, [1.0, 2.0])
+        assert False, "A sampler class without loglik() was accepted."
+    except ValueError as error:
+        assert "loglik" in str(error)
+
+    # a function building the sampler can only be checked in the worker processes
+    sampler = samplers.ParallelTempering(build_normal_sampler, [1.0, 2.0], shared={'x': data}, seed=1)
+    try:
+        sampler.run(10, 10)
+        assert False, "A sampler without loglik() was run."
+    except ValueError as error:
+        assert "loglik" in str(error)
+
+
+class TemperedNormalMean(tsteps.NormalMean):
+    """
+    Normal mean parameter with fixed variance, whose likelihood is tempered by its temperature.
+    """
+    def random_posterior(self):
+        post_var = 1.0 / (1.0 / self.prior.variance + self.ndata / (self.variance.value * self._temperature))
+        post_mean = post_var * (self.prior.mu / self.prior.variance +
+                                self.ndata * self.data_mean / (self.variance.value * self._temperature))
+
+        return np.random.normal(post_mean, np.sqrt(post_var))
+
+
+class NormalMeanSampler(samplers.Sampler):
+    """
+    Gibbs sampler for the mean of a normal model with known variance, with the log-likelihood needed for parallel
+    tempering.
+    """
+    def loglik(self):
+        mean = self._steps[0]._parameter
+        return -0.5 * mean.ndata * (mean.data_mean - mean.value) ** 2 / mean.variance.value
+
+
+def build_tempered_normal_sampler(x):
+    """
+    Build the sampler of the mean of the normal model of the data x with known variance. Used by the worker processes
+    in test_parallel_tempering.
+    """
+    mean = TemperedNormalMean(x, MuPrior, "mu", True, 1.0)
+    variance = steps.Parameter("sigsqr", False)
+    variance.value = np.var(x)
+    mean.SetVariance(variance)
+    return NormalMeanSampler([steps.GibbStep(mean)])
+
+
+def test_parallel_tempering():
+    """
+    Test that the untempered samples of a two replica parallel tempering sampler of the normal mean model follow the
+    untempered posterior.
+    """
+    nsamples = 4000
+    sampler = samplers.ParallelTempering(build_tempered_normal_sampler, [1.0, 4.0], swap_every=5,
+                                         shared={'x': data}, seed=1)
+    samples = sampler.run(200, nsamples)
+    assert samples.samples["mu"].shape == (nsamples,)
+    # the replicas swap temperatures, so the untempered samples come from both of them
+    assert np.all(sampler.naccept > 0)
+
+    data_mean = np.median(data)
+    post_var = 1.0 / (1.0 / MuPrior.variance + ndata / np.var(data))
+    post_mean = post_var * (MuPrior.mu / MuPrior.variance + ndata * data_mean / np.var(data))
+    mu_samples = samples.samples["mu"]
+    assert abs(mu_samples.mean() - post_mean) < 4.0 * np.sqrt(post_var / nsamples)
+    # the relative standard error of the variance of the samples is sqrt(2 / nsamples)
+    assert abs(mu_samples.var() / post_var - 1.0) < 4.0 * np.sqrt(2.0 / nsamples)
 
 
 def test_normal_mean_mha():
@@ -1,11 +1,14 @@
+import os
+import json
+import time
+import zlib
 import numpy as np
-import collections
 import scipy.stats as stats
 from scipy.special import gammaln
 import steps
 import samplers
 import proposals
-import copy
+import misc
 from sklearn import linear_model
 
 # Deprecation warnings
@@ -16,114 +19,346 @@ with warnings.catch_warnings():
     warnings.simplefilter("ignore")
     fxn()
 
+class TreeArrays(object):
+    """
+    Struct-of-arrays storage for the nodes of a binary tree. Each node occupies one row of a set of preallocated numpy
+    arrays holding its links (parent, left and right children), its splitting rule (feature and threshold), its depth,
+    the sufficient statistics of the data that end up in it, the segment [start, end) of the tree's row permutation
+    holding those data points, and its position in the tree's lists of terminal, internal and prunable nodes. Rows
+    freed by pruning are recycled, and the arrays double in size whenever they run out of room.
+    """
+    __slots__ = ["parent", "left", "right", "feature", "threshold", "depth", "npts", "ybar", "yvar", "start", "end",
+                 "pos", "nogpos", "views", "size", "_free"]
+    _fields = ("parent", "left", "right", "feature", "threshold", "depth", "npts", "ybar", "yvar", "start", "end",
+               "pos", "nogpos")
+
+    def __init__(self, capacity=16):
+        """
+        Constructor for the node storage of a binary tree.
+
+        @param capacity: The number of nodes to preallocate storage for.
+        """
+        self.parent = np.empty(0, dtype=np.int32)
+        self.left = np.empty(0, dtype=np.int32)
+        self.right = np.empty(0, dtype=np.int32)
+        self.feature = np.empty(0, dtype=np.int32)  # NOTE: the parent carries the feature and threshold to split upon
+        self.threshold = np.empty(0, dtype=np.float64)
+        self.depth = np.empty(0, dtype=np.int32)
+        self.npts = np.empty(0, dtype=np.int64)
+        self.ybar = np.empty(0, dtype=np.float64)
+        self.yvar = np.empty(0, dtype=np.float64)
+        self.start = np.empty(0, dtype=np.int64)
+        self.end = np.empty(0, dtype=np.int64)
+        self.pos = np.empty(0, dtype=np.int32)  # position in the list of terminal nodes, or of internal nodes
+        self.nogpos = np.empty(0, dtype=np.int32)  # position in the list of parents of two terminal nodes
+        self.views = []  # the Node object viewing each row, or None if the row is free
+        self.size = 0  # number of rows ever handed out
+        self._free = []  # rows released by pruning, available for reuse
+        self._resize(capacity)
+
+    @property
+    def capacity(self):
+        return self.parent.size
+
+    def _resize(self, capacity):
+        old = self.capacity
+        for name in self._fields:
+            values = getattr(self, name)
+            resized = np.empty(capacity, dtype=values.dtype)
+            resized[:old] = values
+            setattr(self, name, resized)
+        self.views.extend([None] * (capacity - old))
+        for i in xrange(old, capacity):
+            self._clear(i)
+
+    def _clear(self, i):
+        self.parent[i] = -1
+        self.left[i] = -1
+        self.right[i] = -1
+        self.feature[i] = -1
+        self.threshold[i] = 0.0
+        self.depth[i] = 0
+        self.npts[i] = 0
+        self.ybar[i] = 0.0
+        self.yvar[i] = 0.0
+        self.start[i] = 0
+        self.end[i] = 0
+        self.pos[i] = -1
+        self.nogpos[i] = -1
+
+    def allocate(self):
+        """
+        Reserve a row for a new node, growing the arrays if they are full.
+
+        @return: The index of the row.
+        """
+        if len(self._free) > 0:
+            i = self._free.pop()
+        else:
+            if self.size == self.capacity:
+                self._resize(2 * self.capacity)
+            i = self.size
+            self.size += 1
+        self._clear(i)
+        return i
+
+    def copy(self):
+        """
+        Return a copy of the node storage, with new Node objects viewing its rows.
+        """
+        arrays = TreeArrays.__new__(TreeArrays)
+        for name in self._fields:
+            setattr(arrays, name, getattr(self, name).copy())
+        arrays.views = [None if node is None else Node.view(arrays, node._index, node.Id) for node in self.views]
+        arrays.size = self.size
+        arrays._free = list(self._free)
+        return arrays
+
+    def release(self, i):
+        """
+        Return a row to the pool of free rows.
+
+        @param i: The index of the row.
+        """
+        self.views[i] = None
+        self._clear(i)
+        self._free.append(i)
+
+
 class Node(object):
+    """
+    A node in a binary tree. The node values are stored in a row of a TreeArrays object shared by all nodes in the
+    tree, so a Node is only a thin view onto that row.
+    """
     # Memory management tool: pre-define the class attributes.
     # Prevents the automatic creation of __dict__ and __weakref__ for each instance
-    __slots__ = ["Id", "Parent", "Left", "Right", "is_left", "depth", 
-                 "_ybar", "_yvar", "_npts", "_feature", "_threshold"]
+    __slots__ = ["Id", "_arrays", "_index"]
 
     # Incrementing Class variable
     NodeId = 0
 
-    def __init__(self, parent, is_left):
+    def __init__(self, parent, is_left, arrays=None):
         """
         Constructor for a node in a binary tree.
 
         @param parent: The parent node.
         @param is_left: If true, then this node is the left node in the binary split from the parent node.
+        @param arrays: The TreeArrays object storing the nodes of the tree. Only used for the head of the tree, since
+            children share the storage of their parent. A new one is created if this is not supplied.
         """
         self.Id        = Node.NodeId
         Node.NodeId   += 1
 
-        self.Parent    = parent # feature and threshold reside in the parent
-        self.Left      = None   # data[:, feature] <= threshold
-        self.Right     = None   # data[:, feature] > threshold
-
-        if self.Parent is not None:
-            self.is_left = is_left
-            if self.is_left:
-                parent.Left = self
+        if parent is not None:
+            arrays = parent._arrays
+        elif arrays is None:
+            arrays = TreeArrays()
+        self._arrays   = arrays
+        self._index    = arrays.allocate()
+        arrays.views[self._index] = self
+
+        if parent is not None:
+            arrays.parent[self._index] = parent._index  # feature and threshold reside in the parent
+            arrays.depth[self._index] = arrays.depth[parent._index] + 1
+            if is_left:
+                parent.Left = self   # data[:, feature] <= threshold
             else:
-                parent.Right = self
-            self.depth = self.Parent.depth + 1
-        else:
-            self.is_left = None
-            self.depth = 0
+                parent.Right = self  # data[:, feature] > threshold
 
-        self._ybar = 0.0
-        self._yvar = 0.0
-        self._npts = 0
+    @staticmethod
+    def view(arrays, index, Id):
+        """
+        Create a Node object viewing an existing row of a TreeArrays object.
+
+        @param arrays: The TreeArrays object.
+        @param index: The index of the row.
+        @param Id: The Id of the node.
+        """
+        node = Node.__new__(Node)
+        node.Id = Id
+        node._arrays = arrays
+        node._index = index
+        return node
+
+    def _view(self, i):
+        if i < 0:
+            return None
+        return self._arrays.views[i]
+
+    def getparent(self):
+        return self._view(self._arrays.parent[self._index])
+    Parent = property(getparent, None, None, "The parent node")
+
+    def getleft(self):
+        return self._view(self._arrays.left[self._index])
+    def setleft(self, node):
+        self._arrays.left[self._index] = -1 if node is None else node._index
+    Left = property(getleft, setleft, None, "The child node with data[:, feature] <= threshold")
+
+    def getright(self):
+        return self._view(self._arrays.right[self._index])
+    def setright(self, node):
+        self._arrays.right[self._index] = -1 if node is None else node._index
+    Right = property(getright, setright, None, "The child node with data[:, feature] > threshold")
+
+    def getisleft(self):
+        parent = self._arrays.parent[self._index]
+        if parent < 0:
+            return None
+        return bool(self._arrays.left[parent] == self._index)
+    is_left = property(getisleft, None, None, "Is this the left node in the binary split from the parent node?")
 
-        # NOTE: the parent carries the feature and threshold to split upon
-        self._feature = -1
-        self._threshold = 0.0
+    def getdepth(self):
+        return int(self._arrays.depth[self._index])
+    depth = property(getdepth, None, None, "The depth of this node in the tree")
 
     def getybar(self):
-        return self._ybar
+        return self._arrays.ybar[self._index]
     def setybar(self, value):
-        self._ybar = value
-    def delybar(self):
-        del self._ybar
-    ybar = property(getybar, setybar, delybar, "0th moment of data that end up in this node")
+        self._arrays.ybar[self._index] = value
+    ybar = property(getybar, setybar, None, "0th moment of data that end up in this node")
 
     def getyvar(self):
-        return self._yvar
+        return self._arrays.yvar[self._index]
     def setyvar(self, value):
-        self._yvar = value
-    def delyvar(self):
-        del self._yvar
-    yvar = property(getyvar, setyvar, delyvar, "Squared 1st moment of data that end up in this node")
+        self._arrays.yvar[self._index] = value
+    yvar = property(getyvar, setyvar, None, "Squared 1st moment of data that end up in this node")
 
     def getnpts(self):
-        return self._npts
+        return int(self._arrays.npts[self._index])
     def setnpts(self, value):
-        self._npts = value
-    def delnpts(self):
-        del self._npts
-    npts = property(getnpts, setnpts, delnpts, "Number of data points that end up in this node")
+        self._arrays.npts[self._index] = value
+    npts = property(getnpts, setnpts, None, "Number of data points that end up in this node")
 
     def getfeat(self):
-        return self._feature
+        feature = self._arrays.feature[self._index]
+        if feature < 0:
+            return None
+        return int(feature)
     def setfeat(self, value):
-        self._feature = value
-    def delfeat(self):
-        del self._feature
-    feature = property(getfeat, setfeat, delfeat, "The binary split will be on this feature")
+        self._arrays.feature[self._index] = -1 if value is None else value
+    feature = property(getfeat, setfeat, None, "The binary split will be on this feature")
 
     def getthresh(self):
-        return self._threshold
+        threshold = self._arrays.threshold[self._index]
+        if np.isnan(threshold):
+            return None
+        return threshold
     def setthresh(self, value):
-        self._threshold = value
-    def delthresh(self):
-        del self._threshold
-    threshold = property(getthresh, setthresh, delthresh, "The value of the feature seperating the left and right nodes")
+        self._arrays.threshold[self._index] = np.nan if value is None else value
+    threshold = property(getthresh, setthresh, None, "The value of the feature seperating the left and right nodes")
+
+    # Aliases for code written against the attributes of the old, linked, Node class
+    _ybar = ybar
+    _yvar = yvar
+    _npts = npts
+    _feature = feature
+    _threshold = threshold
+
+
+class CutpointGrid(object):
+    __slots__ = ["cutpoints", "dtype"]
+
+    def __init__(self, X, numcut=100):
+        """
+        Constructor for a grid of cutpoints on each feature. The feature values are quantized by the grid into small
+        integer codes, so that the split rules of the trees can be evaluated on a compact uint8 or uint16 matrix instead
+        of the float feature values. This is the same as the 'numcut' option of BayesTree.
+
+        If a feature has no more than numcut distinct values then these are used as the cutpoints, otherwise the
+        cutpoints are numcut quantiles of the feature values. A feature value x is coded as the index of the
+        smallest cutpoint that is >= x, so that x <= cutpoints[c] if and only if code <= c.
+
+        @param X: The array of feature values, shape (n_samples, n_features).
+        @param numcut: The maximum number of cutpoints for each feature, at most 65535. The codes are stored as uint8 if
+            numcut < 256, and as uint16 otherwise.
+        """
+        assert(0 < numcut <= np.iinfo(np.uint16).max)
+        self.dtype = np.uint8 if numcut <= np.iinfo(np.uint8).max else np.uint16
+        self.cutpoints = []
+        for j in xrange(X.shape[1]):
+            values = np.unique(X[:, j])
+            if values.size > numcut:
+                values = np.unique(np.percentile(X[:, j], np.linspace(0.0, 100.0, numcut)))
+            self.cutpoints.append(values)
+
+    def transform(self, X):
+        """
+        Quantize the input feature values using the cutpoint grid.
+
+        @param X: The array of feature values, shape (n, n_features).
+        @return: The array of codes, shape (n, n_features).
+        """
+        codes = np.empty(X.shape, dtype=self.dtype)
+        for j in xrange(X.shape[1]):
+            codes[:, j] = np.searchsorted(self.cutpoints[j], X[:, j], side='left')
+        return codes
+
+    def threshold(self, feature, code):
+        """
+        Return the feature value corresponding to a split rule on the codes, i.e., code <= c is the same as
+        x <= threshold(feature, c).
+
+        @param feature: The feature of the split rule.
+        @param code: The threshold of the split rule on the codes.
+        """
+        return self.cutpoints[feature][int(code)]
 
 
 class BaseTree(object):
-    __slots__ = ["X", "y", "n_features", "n_samples", "nmin", "head", "terminalNodes", "internalNodes"]
+    __slots__ = ["X", "y", "n_features", "n_samples", "nmin", "nodes", "head", "terminalNodes", "internalNodes",
+                 "nogNodes", "rows", "leaf_of", "cutpoints", "version"]
 
-    def __init__(self, X, y, min_samples_leaf=5):
+    def __init__(self, X, y, min_samples_leaf=5, cutpoints=None):
         """
         Constructor for the Base class for binary trees. This class contains methods that provide the functionality
-        needed for building and describing a binary tree configuration.
+        needed for building and describing a binary tree configuration. The nodes are stored in a TreeArrays object,
+        and all traversals of the tree work directly on these arrays.
+
+        The tree also keeps track of which data points end up in each node. The array of row indices self.rows is
+        partitioned so that the data points in each node occupy a contiguous segment of it, and self.leaf_of maps
+        each data point onto the terminal node it ends up in. Both are updated in place by split and prune, touching
+        only the data points in the affected node.
+
+        The lists of terminal nodes, internal nodes, and parents of two terminal nodes (the 'nog' nodes, which are the
+        ones that can be pruned) are also updated in place by split and prune. The position of each node in these lists
+        is stored in the node arrays, so a node is removed from a list by moving the last node of the list into its
+        place. The order of the nodes in these lists is therefore arbitrary.
+
+        The version counter is incremented whenever the tree configuration changes, so two copies of the tree with the
+        same version have the same nodes and splitting rules, although possibly listed in a different order.
+
+        If a CutpointGrid is supplied then X must contain the codes of the feature values, and the thresholds of the
+        split rules are codes as well. Any data dropped down the tree, e.g., by apply(), must then be coded with
+        cutpoints.transform() first.
 
         @param X: The array of feature values, shape (n_samples,n_features).
         @param y: The array of response values, size n_samples.
         @param min_samples_leaf: The minimum number of data points within a leaf (terminal node).
+        @param cutpoints: The CutpointGrid used to code the feature values, or None if X contains the feature values.
         """
         self.X = X
         self.y = y
         self.n_features = X.shape[1]
         self.n_samples  = X.shape[0]
         self.nmin       = min_samples_leaf
+        self.cutpoints  = cutpoints
 
         # Initialize the tree
-        self.head = Node(None, None)
+        self.nodes = TreeArrays()
+        self.head = Node(None, None, self.nodes)
         self.head.ybar = np.mean(y)
         self.head.yvar = np.var(y)
         self.head.npts = y.size
-        self.terminalNodes = [self.head]
+        self.nodes.end[self.head._index] = y.size
+        self.rows = np.arange(self.n_samples)
+        self.leaf_of = np.empty(self.n_samples, dtype=np.intp)
+        self.leaf_of[:] = self.head._index
+        self.terminalNodes = []
         self.internalNodes = []
+        self.nogNodes = []
+        self._add_node(self.terminalNodes, self.head, self.nodes.pos)
+        self.version = 0
 
     def buildUniform(self, node, alpha, beta, depth=0, verbose=False):
         """
@@ -172,12 +407,11 @@ class BaseTree(object):
         @param node: The node object on which to perform the split.
         """
         feature = np.random.randint(self.n_features)
-        idxX, idxY = self.filter(node)
-        data = self.X[:, feature][idxX[:, feature]]
-        if len(data) == 0:
-            return None, None, None
-        idxD = np.random.randint(len(data))
-        threshold = data[idxD]
+        rows = self.node_rows(node)
+        if len(rows) == 0:
+            return None, None
+        idxD = rows[np.random.randint(len(rows))]
+        threshold = self.X[idxD, feature]
         return feature, threshold
 
     def grow(self):
@@ -208,28 +442,37 @@ class BaseTree(object):
         if parent.Left is not None or parent.Right is not None:
             return None, None
 
-        nleft  = Node(parent, True)  # Add left node; it registers with parent
-        nright = Node(parent, False) # Add right node; it registers with parent
-        parent.feature = feature
-        parent.threshold = threshold
+        nodes = self.nodes
+        start = nodes.start[parent._index]
+        end = nodes.end[parent._index]
+        rows = self.rows[start:end]
+        go_left = self.X[rows, feature] <= threshold
+        nl = np.count_nonzero(go_left)
 
-        fxl, fyl = self.filter(nleft)
-        fxr, fyr = self.filter(nright)
-        
         # only split if it yields at least nmin points per child
-        if nleft.npts >= self.nmin and nright.npts >= self.nmin:
-            self.calcTerminalNodes()
-            self.calcInternalNodes()
-            return nleft, nright
-        else:
-            del nleft
-            del nright
+        if nl < self.nmin or rows.size - nl < self.nmin:
             parent.feature = None
             parent.threshold = None
-            parent.Left = None
-            parent.Right = None
             return None, None
 
+        # partition the parent's segment of the row indices between the two children
+        self.rows[start:end] = np.concatenate((rows[go_left], rows[~go_left]))
+
+        nleft  = Node(parent, True)  # Add left node; it registers with parent
+        nright = Node(parent, False) # Add right node; it registers with parent
+        parent.feature = feature
+        parent.threshold = threshold
+        nodes.start[nleft._index] = start
+        nodes.end[nleft._index] = start + nl
+        nodes.start[nright._index] = start + nl
+        nodes.end[nright._index] = end
+
+        for child in (nleft, nright):
+            self.leaf_of[self.refresh(child)] = child._index
+
+        self._attach(parent, nleft, nright)
+        return nleft, nright
+
     def prune(self):
         """
         Prune the tree by randomly picking a parent of two terminal nodes and then collapsing the terminal nodes into
@@ -241,30 +484,204 @@ class BaseTree(object):
         if len(dparents) == 0:
             return None
         parent   = dparents[np.random.randint(len(dparents))]
-        # collapse node
+        self.collapse(parent)
+
+        return parent
+
+    def collapse(self, parent, release=True):
+        """
+        Collapse the two terminal nodes below the input node into it, undoing split(parent, ...).
+
+        @param parent: The parent of the two terminal nodes, i.e., the new terminal node.
+        @param release: If false, the storage of the two terminal nodes is not freed, so that the collapse can be
+            undone by calling restore().
+        @return: The left and right node objects that were removed from the tree.
+        """
+        nleft = parent.Left
+        nright = parent.Right
         parent.Left = None
         parent.Right = None
-        self.calcTerminalNodes()
-        self.calcInternalNodes()
+        self._detach(parent, nleft, nright)
+        if release:
+            self.nodes.release(nleft._index)
+            self.nodes.release(nright._index)
+        # the segments of the children are adjacent, so together they form the parent's segment
+        self.leaf_of[self.refresh(parent)] = parent._index
 
-        return parent
+        return nleft, nright
+
+    def restore(self, parent, nleft, nright):
+        """
+        Undo collapse(parent, release=False) by reattaching the two terminal nodes below the input node.
+
+        @param parent: The node that the terminal nodes were collapsed into.
+        @param nleft: The left node object returned by collapse().
+        @param nright: The right node object returned by collapse().
+        """
+        parent.Left = nleft
+        parent.Right = nright
+        self.leaf_of[self.node_rows(nleft)] = nleft._index
+        self.leaf_of[self.node_rows(nright)] = nright._index
+        self._attach(parent, nleft, nright)
+
+    def _add_node(self, nodelist, node, positions):
+        """
+        Append a node to one of the node lists, saving its position in the input array of positions.
+        """
+        positions[node._index] = len(nodelist)
+        nodelist.append(node)
+
+    def _remove_node(self, nodelist, node, positions):
+        """
+        Remove a node from one of the node lists by moving the last node of the list into its place.
+        """
+        i = positions[node._index]
+        last = nodelist.pop()
+        if last is not node:
+            nodelist[i] = last
+            positions[last._index] = i
+        positions[node._index] = -1
+
+    def _attach(self, parent, nleft, nright):
+        """
+        Update the node lists after the terminal node parent is split into nleft and nright.
+        """
+        self.version += 1
+        pos = self.nodes.pos
+        self._remove_node(self.terminalNodes, parent, pos)
+        self._add_node(self.internalNodes, parent, pos)
+        self._add_node(self.terminalNodes, nleft, pos)
+        self._add_node(self.terminalNodes, nright, pos)
+        self._add_node(self.nogNodes, parent, self.nodes.nogpos)
+        grandparent = self.nodes.parent[parent._index]
+        if grandparent >= 0 and self.nodes.nogpos[grandparent] >= 0:
+            # the grandparent no longer has two terminal nodes below it
+            self._remove_node(self.nogNodes, self.nodes.views[grandparent], self.nodes.nogpos)
+
+    def _detach(self, parent, nleft, nright):
+        """
+        Update the node lists after the terminal nodes nleft and nright are collapsed into parent.
+        """
+        self.version += 1
+        pos = self.nodes.pos
+        self._remove_node(self.terminalNodes, nleft, pos)
+        self._remove_node(self.terminalNodes, nright, pos)
+        self._remove_node(self.internalNodes, parent, pos)
+        self._add_node(self.terminalNodes, parent, pos)
+        self._remove_node(self.nogNodes, parent, self.nodes.nogpos)
+        nodes = self.nodes
+        grandparent = nodes.parent[parent._index]
+        if grandparent >= 0 and nodes.left[nodes.left[grandparent]] < 0 and nodes.left[nodes.right[grandparent]] < 0:
+            # the grandparent now has two terminal nodes below it
+            self._add_node(self.nogNodes, nodes.views[grandparent], nodes.nogpos)
+
+    def snapshot(self):
+        """
+        Make a copy of the tree configuration, e.g., to save it as an MCMC sample. The copy shares the X and y arrays
+        with this tree, and does not keep track of which data points end up in each node.
+
+        @return: A copy of this tree, an instance of BaseTree.
+        """
+        tree = BaseTree.__new__(BaseTree)
+        tree.X = self.X
+        tree.y = self.y
+        tree.n_features = self.n_features
+        tree.n_samples = self.n_samples
+        tree.nmin = self.nmin
+        tree.cutpoints = self.cutpoints
+        tree.version = self.version
+        tree.nodes = self.nodes.copy()
+        tree.head = tree.nodes.views[self.head._index]
+        tree.terminalNodes = [tree.nodes.views[x._index] for x in self.terminalNodes]
+        tree.internalNodes = [tree.nodes.views[x._index] for x in self.internalNodes]
+        tree.nogNodes = [tree.nodes.views[x._index] for x in self.nogNodes]
+        tree.rows = None
+        tree.leaf_of = None
+
+        return tree
+
+    def get_state(self):
+        """
+        Return the tree configuration as a dictionary of numpy arrays, e.g., for saving it in a checkpoint. This
+        includes the rows of the node arrays, the lists of nodes, and which data points end up in each node, so that
+        set_state() restores the tree exactly.
+
+        @return: A dictionary describing the tree.
+        """
+        nodes = self.nodes
+        state = dict((name, getattr(nodes, name)[:nodes.size].copy()) for name in TreeArrays._fields)
+        state['Id'] = np.array([-1 if x is None else x.Id for x in nodes.views[:nodes.size]], dtype=np.int64)
+        state['free'] = np.array(nodes._free, dtype=np.intp)
+        state['head'] = self.head._index
+        state['terminal'] = self.leaf_indices()
+        state['internal'] = np.array([x._index for x in self.internalNodes], dtype=np.intp)
+        state['nog'] = np.array([x._index for x in self.nogNodes], dtype=np.intp)
+        state['rows'] = None if self.rows is None else self.rows.copy()
+        state['n_features'] = self.n_features
+        state['n_samples'] = self.n_samples
+        state['nmin'] = self.nmin
+        state['version'] = self.version
+        return state
+
+    def set_state(self, state):
+        """
+        Restore the tree configuration from the output of get_state(). The tree keeps its X and y arrays.
+
+        @param state: A dictionary returned by get_state().
+        """
+        size = state['parent'].size
+        nodes = TreeArrays(max(size, 16))
+        for name in TreeArrays._fields:
+            getattr(nodes, name)[:size] = state[name]
+        nodes.size = size
+        nodes._free = list(state['free'])
+        for i in np.flatnonzero(state['Id'] >= 0):
+            nodes.views[i] = Node.view(nodes, i, int(state['Id'][i]))
+
+        self.nodes = nodes
+        self.head = nodes.views[state['head']]
+        self.terminalNodes = [nodes.views[i] for i in state['terminal']]
+        self.internalNodes = [nodes.views[i] for i in state['internal']]
+        self.nogNodes = [nodes.views[i] for i in state['nog']]
+        self.n_features = state['n_features']
+        self.n_samples = state['n_samples']
+        self.nmin = state['nmin']
+        self.version = state['version']
+        if state['rows'] is None:
+            self.rows = None
+            self.leaf_of = None
+        else:
+            self.rows = state['rows'].copy()
+            self.leaf_of = np.empty(self.n_samples, dtype=np.intp)
+            for i in state['terminal']:
+                self.leaf_of[self.rows[nodes.start[i]:nodes.end[i]]] = i
+
+    @staticmethod
+    def from_state(state, cutpoints=None):
+        """
+        Make a tree from the output of get_state(), e.g., to restore an MCMC sample. Like the copies made by snapshot(),
+        the tree is only used to describe a tree configuration, so it does not hold any data.
+
+        @param state: A dictionary returned by get_state().
+        @param cutpoints: The CutpointGrid used to code the feature values when building the tree, if any.
+        @return: The tree, an instance of BaseTree.
+        """
+        tree = BaseTree.__new__(BaseTree)
+        tree.X = None
+        tree.y = None
+        tree.cutpoints = cutpoints
+        tree.set_state(state)
+
+        return tree
 
     def get_terminal_parents(self):
         """
         Find the parents of each pair of terminal nodes.
 
-        @return: The list of parent nodes of each pair of terminal nodes.
+        @return: The list of parent nodes of each pair of terminal nodes. This is the list maintained by the tree, so it
+            should not be modified.
         """
-        nodes = self.terminalNodes
-        if len(nodes) == 0:
-            return
-        parents = [x.Parent for x in nodes]
-        if len(parents) == 0:
-            return
-        # make sure there are 2 terminal children
-        dparents = [x for x, y in collections.Counter(parents).items() if y == 2]
-
-        return dparents
+        return self.nogNodes
 
     def printTree(self, node):
         if node is None:
@@ -275,33 +692,76 @@ class BaseTree(object):
 
     def calcTerminalNodes(self):
         """
-        Calculate the terminal nodes of the tree.
+        Calculate the terminal nodes of the tree from scratch. Not needed after split or prune, which keep the list of
+        terminal nodes up to date.
         """
-        self.terminalNodes = []
-        self.calcTerminalNodes_(self.head)
-
-    def calcTerminalNodes_(self, node):
-        if node.Right is None or node.Left is None:
-            self.terminalNodes.append(node)
-        if node.Right is not None:
-            self.calcTerminalNodes_(node.Right)
-        if node.Left is not None:
-            self.calcTerminalNodes_(node.Left)
+        self.terminalNodes = [self.nodes.views[i] for i in self._walk() if self.nodes.left[i] < 0]
+        self.nodes.pos[self.leaf_indices()] = np.arange(len(self.terminalNodes))
 
     def calcInternalNodes(self):
         """
-        Calculate the internal nodes of the tree.
+        Calculate the internal nodes, and the parents of two terminal nodes, of the tree from scratch. Not needed after
+        split or prune, which keep these lists up to date.
         """
-        self.internalNodes = []
-        self.calcInternalNodes_(self.head)
+        nodes = self.nodes
+        self.internalNodes = [nodes.views[i] for i in self._walk() if nodes.left[i] >= 0]
+        self.nogNodes = [x for x in self.internalNodes if nodes.left[nodes.left[x._index]] < 0 and
+                         nodes.left[nodes.right[x._index]] < 0]
+        for i, x in enumerate(self.internalNodes):
+            nodes.pos[x._index] = i
+        nodes.nogpos[:] = -1
+        for i, x in enumerate(self.nogNodes):
+            nodes.nogpos[x._index] = i
+
+    def _walk(self):
+        """
+        Iterate over the indices of the nodes in the tree, visiting the right branch of each node before the left one.
+        """
+        nodes = self.nodes
+        stack = [self.head._index]
+        while len(stack) > 0:
+            i = stack.pop()
+            yield i
+            if nodes.left[i] >= 0:
+                stack.append(nodes.left[i])
+                stack.append(nodes.right[i])
+
+    def leaf_indices(self):
+        """
+        Return the indices of the terminal nodes in the tree's node arrays, in the order of self.terminalNodes.
+        """
+        return np.array([x._index for x in self.terminalNodes], dtype=np.intp)
+
+    def update_moments(self):
+        """
+        Save the number of data points and the first and second moments of the y-values in every terminal node. This
+        is done in a single pass over the data by accumulating the sum and sum of squares of the y-values for each
+        terminal node, and must be called whenever self.y changes.
+        """
+        nodes = self.nodes
+        leaves = self.leaf_indices()
+        npts = np.bincount(self.leaf_of, minlength=nodes.capacity)[leaves]
+        ysum = np.bincount(self.leaf_of, weights=self.y, minlength=nodes.capacity)[leaves]
+        ysumsqr = np.bincount(self.leaf_of, weights=self.y * self.y, minlength=nodes.capacity)[leaves]
+
+        nonempty = npts > 0
+        leaves = leaves[nonempty]
+        npts = npts[nonempty]
+        ybar = ysum[nonempty] / npts
+        nodes.npts[leaves] = npts
+        nodes.ybar[leaves] = ybar
+        nodes.yvar[leaves] = np.maximum(ysumsqr[nonempty] / npts - ybar * ybar, 0.0)
+
+    def leaf_positions(self):
+        """
+        Map the index of each node in the tree's node arrays onto its position in the list of terminal nodes, i.e.,
+        onto the index of its mean value in a BartMeanParameter.
 
-    def calcInternalNodes_(self, node):
-        if node.Right is not None and node.Left is not None:
-            self.internalNodes.append(node)
-        if node.Right is not None:
-            self.calcInternalNodes_(node.Right)
-        if node.Left is not None:
-            self.calcInternalNodes_(node.Left)
+        @return: An array of size nodes.capacity, equal to -1 for nodes that are not terminal nodes.
+        """
+        positions = -np.ones(self.nodes.capacity, dtype=np.intp)
+        positions[self.leaf_indices()] = np.arange(len(self.terminalNodes))
+        return positions
 
     def plinko(self, node, data):
         """
@@ -311,42 +771,93 @@ class BaseTree(object):
         @param data: The array of predictors.
         @return: The indices of the predictors in this node.
         """
-        includeX = np.ones(data.shape, dtype=np.bool)
-        n = node
-        while n.Parent is not None:
-            if n.is_left:
-                includeX[:, n.Parent.feature] &= data[:, n.Parent.feature] <= n.Parent.threshold
+        nodes = self.nodes
+        includeX = np.ones(data.shape, dtype=bool)
+        n = node._index
+        parent = nodes.parent[n]
+        while parent >= 0:
+            feature = nodes.feature[parent]
+            if nodes.left[parent] == n:
+                includeX[:, feature] &= data[:, feature] <= nodes.threshold[parent]
             else:
-                includeX[:, n.Parent.feature] &= data[:, n.Parent.feature] > n.Parent.threshold
-            n = n.Parent
+                includeX[:, feature] &= data[:, feature] > nodes.threshold[parent]
+            n = parent
+            parent = nodes.parent[n]
 
         return includeX
 
+    def apply(self, data):
+        """
+        Drop each row of the input predictors down the tree and return the terminal node it ends up in. All rows are
+        moved down one level at a time.
+
+        @param data: The array of predictors, shape (n, n_features).
+        @return: The indices of the terminal nodes in the node arrays, an array of size n.
+        """
+        nodes = self.nodes
+        leaf = np.empty(data.shape[0], dtype=np.intp)
+        leaf[:] = self.head._index
+        active = np.arange(data.shape[0])
+        if nodes.left[self.head._index] < 0:
+            return leaf
+        while active.size > 0:
+            current = leaf[active]
+            go_left = data[active, nodes.feature[current]] <= nodes.threshold[current]
+            leaf[active] = np.where(go_left, nodes.left[current], nodes.right[current])
+            active = active[nodes.left[leaf[active]] >= 0]
+
+        return leaf
+
+    def node_rows(self, node):
+        """
+        Return the indices of the data points that end up in the input node. This is a view of the node's segment of
+        self.rows, so it should not be modified.
+
+        @param node: The node for which the data point indices are desired.
+        @return: The indices of the data points in this node.
+        """
+        return self.rows[self.nodes.start[node._index]:self.nodes.end[node._index]]
+
+    def refresh(self, node):
+        """
+        Save the number of data points and the first and second moments of the y-values in the input node. This must
+        be called whenever self.y changes.
+
+        @param node: The node for which the moments are desired.
+        @return: The indices of the data points in this node.
+        """
+        rows = self.node_rows(node)
+        if rows.size == 0:
+            return rows
+
+        ynode = self.y[rows]
+        node.ybar = np.mean(ynode)
+        node.yvar = np.var(ynode)
+        node.npts = rows.size
+
+        return rows
+
     def filter(self, node):
         """
-        Find the data points that end up in the input node by dropping them down the tree, and save the first and
-        second moments of the y-values in this node.
+        Find the data points that end up in the input node, and save the first and second moments of the y-values in
+        this node.
 
         @param node: The node for which the data points are desired.
-        @return: A tuple of two boolean arrays indicating whether the a data point ends up in the input node.
+        @return: A tuple containing the indices of the data points in the input node, and a boolean array indicating
+            whether a data point ends up in the input node.
         """
-        includeX = self.plinko(node, self.X)
-        includeY = np.all(includeX, axis=1)
-        if not True in includeY:
-            return includeX, includeY
-
-        # Set the node values
-        node.ybar = np.mean(self.y[includeY])
-        node.yvar = np.var(self.y[includeY])
-        node.npts = np.sum(includeY)
+        rows = self.refresh(node)
+        includeY = np.zeros(self.n_samples, dtype=bool)
+        includeY[rows] = True
 
-        return includeX, includeY  # TODO: do we really need to return includeX?
+        return rows, includeY
 
 
 class BartTreeParameter(steps.Parameter):
     __slots__ = ["X", "y", "value", "mtrees", "mubar", "prior_mu_var", "alpha", "beta", "sigsqr"]
 
-    def __init__(self, name, X, y, mtrees, alpha=0.95, beta=2.0, prior_mu=0.0, prior_var=2.0, track=True):
+    def __init__(self, name, X, y, mtrees, alpha=0.95, beta=2.0, prior_mu=0.0, prior_var=2.0, track=True,
+                 cutpoints=None):
         """
         Constructor for Bart tree configuration parameter class. The tree configuration is treated as a Parameter object
         to be sampled using a MCMC sampler. The 'value' of this parameter is an instance of BaseTree, which is updated
@@ -361,13 +872,14 @@ class BartTreeParameter(steps.Parameter):
         @param prior_mu: The prior mean for the terminal node mean parameters.
         @param prior_var: The prior variance for the terminal node mean parameters.
         @param track: When this parameter is tracked (i.e., whether the values are saved) in the MCMC sampler.
+        @param cutpoints: The CutpointGrid used to code the predictors, if X contains the codes instead of the values.
         """
         super(BartTreeParameter, self).__init__(name, track)
 
         self.X = X
         self.y = y
 
-        self.value = BaseTree(X, y)  # parameter 'value' is the tree configuration
+        self.value = BaseTree(X, y, cutpoints=cutpoints)  # parameter 'value' is the tree configuration
 
         # Setup up the prior distribution
         self.mtrees = mtrees  # the number of trees in the BART model
@@ -389,6 +901,13 @@ class BartTreeParameter(steps.Parameter):
         # draw initial tree configuration from the prior
         self.value.buildUniform(self.value.head, self.alpha, self.beta)
 
+    def get_state(self):
+        return {'value': self.value.get_state(), 'log_posterior': self._log_posterior}
+
+    def set_state(self, state):
+        self.value.set_state(state['value'])
+        self._log_posterior = state['log_posterior']
+
     def logprior(self, tree):
         """
         Compute the log-prior for a input tree configuration. This assumes that the only difference between the input
@@ -416,7 +935,31 @@ class BartTreeParameter(steps.Parameter):
 
         return logprior
 
-    # NOTE: This part would likely benefit from numba or cython
+    def node_loglik(self, tree, nodes):
+        """
+        Compute the contribution of a set of terminal nodes to the marginal log-likelihood, after marginalizing over
+        the mean value parameter in each node.
+
+        @param tree: The tree configuration object containing the nodes.
+        @param nodes: The indices of the nodes in the tree's node arrays.
+        @return: The sum of the marginal log-likelihoods of the nodes.
+        """
+        nodes = nodes[tree.nodes.npts[nodes] > 0]  # empty nodes do not contribute to the log-likelihood
+        npts = tree.nodes.npts[nodes].astype(float)
+        ymean = tree.nodes.ybar[nodes]
+        yvar = tree.nodes.yvar[nodes]
+        # raising the gaussian likelihood to the power 1 / temperature is the same as inflating its variance
+        sigsqr = self.sigsqr.value * self._temperature
+
+        # log-likelihood component after marginalizing over the mean value in each node, a gaussian distribution
+        post_var = self.prior_mu_var + sigsqr / npts
+        zsqr = (ymean - self.mubar) ** 2 / post_var
+
+        lnlike = -(npts - 1.0) / 2.0 * np.log(2.0 * np.pi * sigsqr) - 0.5 * np.log(npts) - \
+            0.5 * np.log(2.0 * np.pi * post_var) - 0.5 * zsqr - 0.5 * npts * yvar / sigsqr
+
+        return np.sum(lnlike)
+
     def loglik(self, tree):
         """
         Compute the marginal log-likelihood for an input tree configuration. This assumes that the only difference
@@ -427,26 +970,7 @@ class BartTreeParameter(steps.Parameter):
         @param tree: The input tree configuration object.
         @return: The marginal log-likelihood of the tree configuration.
         """
-        lnlike = 0.0
-
-        for node in tree.terminalNodes:
-
-            npts = node.npts
-            if npts == 0:
-                # empty nodes do not contribute to the log-likelihood
-                continue
-
-            ymean = node.ybar
-            yvar = node.yvar
-
-            # log-likelihood component after marginalizing over the mean value in each node, a gaussian distribution
-            post_var = self.prior_mu_var + self.sigsqr.value / npts
-            zsqr = (ymean - self.mubar) ** 2 / post_var
-
-            lnlike += -(npts - 1.0) / 2.0 * np.log(2.0 * np.pi * self.sigsqr.value) - 0.5 * np.log(npts) - \
-                0.5 * np.log(2.0 * np.pi * post_var) - 0.5 * zsqr - 0.5 * npts * yvar / self.sigsqr.value
-
-        return lnlike
+        return self.node_loglik(tree, tree.leaf_indices())
 
     def logdensity(self, tree):
         loglik = self.loglik(tree)
@@ -494,21 +1018,16 @@ class BartMeanParameter(steps.Parameter):
         Update the mean y parameter value for each terminal node by drawing from its distribution, conditional on the
         current tree configuration, variance (sigma ** 2), and data.
         """
-        mu = np.empty(len(self.treeparam.value.terminalNodes))
-        n_idx = 0
-        for node in self.treeparam.value.terminalNodes:
-            if node.npts == 0:
-                # Damn, this should not happen.
-                # DEBUG ME
-                continue
-            ny_in_node = node.npts
-            ymean_in_node = node.ybar
+        tree = self.treeparam.value
+        leaves = tree.leaf_indices()
+        ny_in_node = tree.nodes.npts[leaves].astype(float)  # empty nodes get a draw from the prior
+        ymean_in_node = tree.nodes.ybar[leaves]
+        sigsqr = self.sigsqr.value * self._temperature  # the tempered likelihood has an inflated variance
 
-            post_var = 1.0 / (1.0 / self.prior_var + ny_in_node / self.sigsqr.value)
-            post_mean = post_var * (self.mubar / self.prior_var + ny_in_node * ymean_in_node / self.sigsqr.value)
+        post_var = 1.0 / (1.0 / self.prior_var + ny_in_node / sigsqr)
+        post_mean = post_var * (self.mubar / self.prior_var + ny_in_node * ymean_in_node / sigsqr)
 
-            mu[n_idx] = np.random.normal(post_mean, np.sqrt(post_var))
-            n_idx += 1
+        mu = np.random.normal(post_mean, np.sqrt(post_var))
 
         return mu
 
@@ -566,8 +1085,9 @@ class BartVariance(steps.Parameter):
         resid = self.bart_step.resids
         ssqr = np.var(resid)
 
-        post_dof = self.nu + len(self.y)
-        post_ssqr = (len(self.y) * ssqr + self.nu * self.lamb) / post_dof
+        # the likelihood raised to the power 1 / temperature contributes len(y) / temperature degrees of freedom
+        post_dof = self.nu + len(self.y) / self._temperature
+        post_ssqr = (len(self.y) * ssqr / self._temperature + self.nu * self.lamb) / post_dof
 
         # new error variance is drawn from scaled inverse-chi-square distribution
         new_sigsqr = post_dof * post_ssqr / np.random.chisquare(post_dof)
@@ -576,41 +1096,111 @@ class BartVariance(steps.Parameter):
 
 
 class BartProposal(proposals.Proposal):
-    __slots__ = ["alpha", "beta", "pgrow", "_operation", "_node", "log_prior_ratio", "_prohibited_proposal"]
+    __slots__ = ["alpha", "beta", "pgrow", "_operation", "_node", "_children", "_ntnodes", "_ntparents",
+                 "_version", "log_prior_ratio", "_prohibited_proposal"]
     def __init__(self, alpha=0.95, beta=2.0):
         """
-        Constructor for object that generates proposed tree configurations, given the current one.
+        Constructor for object that generates proposed tree configurations, given the current one. The grow and prune
+        moves are performed on the tree in place, and an undo record of the move is kept until the proposal is either
+        committed or rolled back.
         """
         self.alpha = alpha
         self.beta = beta
         self.pgrow = 0.5  # probability of growing the tree instead of pruning the tree.
         self._operation = None  # Last tree operations performed (Grow/Prune)
         self._node = None  # Last node operated on
+        self._children = None  # The terminal nodes removed by the last prune, kept until the proposal is committed
+        self._ntnodes = (0, 0)  # Number of terminal nodes before and after the last move
+        self._ntparents = (0, 0)  # Number of parents of two terminal nodes before and after the last move
+        self._version = 0  # Version of the tree before the last move
         self.log_prior_ratio = 0.0
         self._prohibited_proposal = False
 
     def draw(self, current_tree):
         """
-        Generate a random proposed tree configuration from the input one.
+        Generate a random proposed tree configuration from the input one. The input tree is modified in place.
+
         @param current_tree: The current tree configuration, an instance of the BaseTree class.
-        @return: The proposed tree configuration, and instance of BaseTree.
+        @return: The proposed tree configuration, i.e., the input tree after the move.
         """
-        # make a copy since the grow/prune operations operate on the tree object in place
-        new_tree = copy.deepcopy(current_tree)
-
-        nleaves = len(new_tree.terminalNodes)
+        nleaves = len(current_tree.terminalNodes)
+        nparents = len(current_tree.nogNodes)
+        self._version = current_tree.version
         prop = np.random.uniform()
         if nleaves == 1:
             prop = 0.0  # can only grow a tree with one terminal node
 
+        self._children = None
         if prop < self.pgrow:
-            self._node = new_tree.grow()
+            self._node = current_tree.grow()
             self._operation = 'grow'
         else:
-            self._node = new_tree.prune()
+            # same as BaseTree.prune(), but keep the collapsed terminal nodes in case the move is rolled back
+            dparents = current_tree.nogNodes
+            self._node = None
+            if len(dparents) > 0:
+                self._node = dparents[np.random.randint(len(dparents))]
+                self._children = current_tree.collapse(self._node, release=False)
             self._operation = 'prune'
+        self._ntnodes = (nleaves, len(current_tree.terminalNodes))
+        self._ntparents = (nparents, len(current_tree.nogNodes))
+
+        return current_tree
+
+    @property
+    def last_move(self):
+        """
+        The type of the last move, 'grow' or 'prune', and whether it failed, i.e., could not be performed on the tree.
+        This is known once the Metropolis-Hastings ratio of the move has been computed.
+        """
+        return self._operation, self._prohibited_proposal
+
+    def changed_nodes(self):
+        """
+        Return the terminal nodes added to and removed from the tree by the last move. For a grow move these are the
+        two new terminal nodes and their parent, and the other way around for a prune move.
+
+        @return: A tuple containing two arrays of indices into the tree's node arrays, the first for the added terminal
+            nodes and the second for the removed terminal nodes.
+        """
+        if self._node is None or self._node.feature is None:
+            # tree configuration is unchanged since we could not perform the chosen move
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        parent = np.array([self._node._index], dtype=np.intp)
+        if self._operation == 'grow':
+            arrays = self._node._arrays
+            children = np.array([arrays.left[parent[0]], arrays.right[parent[0]]], dtype=np.intp)
+            return children, parent
+        else:
+            children = np.array([child._index for child in self._children], dtype=np.intp)
+            return parent, children
+
+    def commit(self, proposed_tree):
+        """
+        Accept the last move, freeing the storage of any terminal nodes removed by it.
+
+        @param proposed_tree: The tree configuration returned by draw().
+        """
+        if self._children is not None:
+            for child in self._children:
+                proposed_tree.nodes.release(child._index)
+        self._children = None
 
-        return new_tree
+    def rollback(self, proposed_tree):
+        """
+        Reject the last move, restoring the tree configuration that was input to draw().
+
+        @param proposed_tree: The tree configuration returned by draw().
+        """
+        if self._node is None or self._node.feature is None:
+            # the move could not be performed, so the tree configuration is unchanged
+            return
+        if self._operation == 'grow':
+            proposed_tree.collapse(self._node)
+        elif self._children is not None:
+            proposed_tree.restore(self._node, self._children[0], self._children[1])
+        self._children = None
+        proposed_tree.version = self._version  # the tree configuration is the same as before the move
 
     def logdensity(self, current_tree, proposed_tree, forward):
         """
@@ -643,15 +1233,16 @@ class BartProposal(proposals.Proposal):
             2.0 * np.log(1.0 - alpha / (2.0 + depth) ** beta)
         self.log_prior_ratio = log_prior_ratio
 
-        # get log ratio of transition kernels
+        # get log ratio of transition kernels. the move was done in place, so current_tree and proposed_tree are usually
+        # the same object: use the node counts saved by draw() for the configurations before and after the move.
         if self._operation == 'grow':
-            ntnodes = float(len(current_tree.terminalNodes))
-            ntparents = len(proposed_tree.get_terminal_parents())
+            ntnodes = float(self._ntnodes[0])
+            ntparents = self._ntparents[1]
             ntparents = max(ntparents, 1)  # if no parents, then make ntnodes / ntparents = 1 since we have to grow
             logdensity = np.log(ntnodes / ntparents) + log_prior_ratio
         elif self._operation == 'prune':
-            ntnodes = float(len(proposed_tree.terminalNodes))
-            ntparents = len(current_tree.get_terminal_parents())
+            ntnodes = float(self._ntnodes[1])
+            ntparents = self._ntparents[0]
             logdensity = np.log(ntparents / ntnodes) - log_prior_ratio
         else:
             self._prohibited_proposal = True
@@ -661,8 +1252,47 @@ class BartProposal(proposals.Proposal):
         return -logdensity  # make sure sign agrees with expectation from MetroStep.accept()
 
 
+class BartTreeStep(steps.MetroStep):
+
+    def __init__(self, parameter, proposal, report_iter=-1):
+        """
+        Constructor for the Metropolis-Hastings update of a tree configuration. The BartProposal object grows or prunes
+        the tree in place, so the proposed and current values are the same BaseTree object, and a rejected move is
+        rolled back by the proposal object. A grow or prune move only changes one parent node and its two children,
+        so the Metropolis-Hastings ratio is computed from the marginal log-likelihood of these nodes only, and the cost
+        of a proposal does not depend on the size of the tree.
+
+        @param parameter: The tree configuration parameter, an instance of BartTreeParameter.
+        @param proposal: The proposal object, an instance of BartProposal.
+        @param report_iter: Report on the acceptance rate after this many iterations.
+        """
+        super(BartTreeStep, self).__init__(parameter, proposal, report_iter)
+
+    def log_ratio(self, proposed_value, current_value):
+        added, removed = self._proposal.changed_nodes()
+        delta_loglik = self._parameter.node_loglik(proposed_value, added) - \
+            self._parameter.node_loglik(proposed_value, removed)
+        return delta_loglik - self._proposal.logdensity(current_value, proposed_value, forward=True)
+
+    def do_step(self):
+        tree = self._parameter.value
+        self._proposal.draw(tree)
+
+        if self.accept(tree, tree):
+            self._proposal.commit(tree)
+            self.naccept += 1
+        else:
+            self._proposal.rollback(tree)
+
+        self.niter += 1
+
+        if self.niter == self.report_iter:
+            self.report()
+
+
 class BartStep(object):
-    __slots__ = ["y", "m", "resids", "trees", "mus", "_report_iter", "tree_proposal", "tree_steps"]
+    __slots__ = ["y", "m", "resids", "fit", "_partial_resids", "trees", "mus", "_report_iter", "tree_proposal",
+                 "tree_steps", "profiler"]
 
     def __init__(self, y, trees, mus, report_iter=-1):
         """
@@ -670,6 +1300,9 @@ class BartStep(object):
         a-time by performing a scan through the individual trees, whereby each tree configuration is first updated using
         a Metropolis-Hastings step, and then the mean values in each terminal node are updated using a Gibbs step.
 
+        The sum of trees is kept in a single running fit vector, and the residuals for each tree are computed in a
+        single reusable buffer, so the memory used does not grow with the number of trees.
+
         @param y: The array of response values, an n_samples size array.
         @param trees: The list of tree parameters, instances of BartTreeParameter class..
         @param mus: The list of mean values for the terminal nodes of each tree, instances of the BartMeanParameter
@@ -684,12 +1317,15 @@ class BartStep(object):
             "Length of tree list must equal length of node means list."
 
         self.resids = y
+        self.fit = None  # the sum of the trees' predicted y-values, computed by compute_fit()
+        self._partial_resids = None  # buffer for the leave-one-out residuals
         self.trees = trees
         self.mus = mus
         self._report_iter = report_iter
         self.tree_proposal = BartProposal()  # object to generate a new tree configuration from the current one
         # Objects to perform a Metropolis-Hasting update of the tree configuration for each tree
-        self.tree_steps = [steps.MetroStep(tree, self.tree_proposal, self._report_iter) for tree in self.trees]
+        self.tree_steps = [BartTreeStep(tree, self.tree_proposal, self._report_iter) for tree in self.trees]
+        self.profiler = None  # StepProfiler object, see set_profiler()
 
     @staticmethod
     def node_mu(tree, mu):
@@ -707,64 +1343,120 @@ class BartStep(object):
         except ValueError:
             "Number of terminal nodes does not equal number of mu values."
 
-        mu_map = np.zeros(tree.n_samples)
-        n_idx = 0
-        for node in tree.terminalNodes:
-            y_in_node = tree.filter(node)[1]
-            assert(np.all(mu_map[y_in_node] == 0.0))
-            mu_map[y_in_node] = mu.value[n_idx]
-            n_idx += 1
+        mu_map = mu.value[tree.leaf_positions()[tree.leaf_of]]
 
         return mu_map
 
+    def compute_fit(self):
+        """
+        Compute the sum of the trees' predicted y-values from scratch. This must be called whenever the trees or mean
+        parameters are changed outside of do_step(), e.g., after setting their starting values.
+        """
+        self.fit = np.zeros(len(self.y))
+        for m in range(self.m):
+            self.fit += self.node_mu(self.trees[m].value, self.mus[m])
+        self._partial_resids = np.empty(len(self.y))
+        self.resids = self.y - self.fit
+
+    def get_state(self):
+        """
+        Return the state of the step as a dictionary, e.g., for saving it in a checkpoint. This includes the states of
+        the tree configurations and the mean parameters, and the running fit of the sum of trees.
+        """
+        return {'fit': None if self.fit is None else self.fit.copy(), 'resids': np.copy(self.resids),
+                'tree_steps': [tree_step.get_state() for tree_step in self.tree_steps],
+                'mus': [mu.get_state() for mu in self.mus]}
+
+    def set_state(self, state):
+        """
+        Restore the state of the step from the output of get_state().
+
+        @param state: A dictionary returned by get_state().
+        """
+        for tree_step, tree_step_state in zip(self.tree_steps, state['tree_steps']):
+            tree_step.set_state(tree_step_state)
+        for mu, mu_state in zip(self.mus, state['mus']):
+            mu.set_state(mu_state)
+        if state['fit'] is None:
+            self.fit = None
+            self.resids = self.y
+        else:
+            self.fit = state['fit'].copy()
+            self._partial_resids = np.empty(len(self.y))
+            self.resids = state['resids'].copy()
+
+    def set_profiler(self, profiler):
+        """
+        Record the time spent in the updates of each tree with a profiler, see samplers.StepProfiler. The timers are
+        'tree moments' for computing the moments of the leave-one-out residuals in the terminal nodes, 'tree grow' and
+        'tree prune' for the Metropolis-Hastings updates of the tree configurations, split by the type of move, and
+        'tree mu' for the Gibbs updates of the terminal node means. A failed grow or prune move is one that could not
+        be performed, e.g., because no split of the chosen node leaves nmin data points in each child.
+
+        @param profiler: A StepProfiler object, or None to stop profiling.
+        """
+        self.profiler = profiler
+
     def do_step(self):
         """
         Update of the configurations and mean parameters of the terminal nodes of each tree in the ensemble. Note that
         this is done in place.
         """
-        n_samples = len(self.y)
-        node_mus = np.zeros((n_samples, self.m))
-        for m in range(self.m):
-            node_mus[:, m] = self.node_mu(self.trees[m].value, self.mus[m])
+        if self.fit is None:
+            self.compute_fit()
+        resids = self._partial_resids
+        profiler = self.profiler  # timestamps are only taken when a profiler is attached
 
-        # predicted y is a sum of trees
-        treesum = np.sum(node_mus, axis=1)
         for m in range(self.m):
+            # contribution of this tree to the sum of trees
+            pred = self.node_mu(self.trees[m].value, self.mus[m])
+
             # leave-one-out residuals
-            resids = self.y - (treesum - node_mus[:, m])
+            np.subtract(self.y, self.fit, out=resids)
+            resids += pred
 
             # make leave-one-out resids the new response for the left-out tree
             self.trees[m].y = resids
             self.trees[m].value.y = resids
 
+            if profiler is not None:
+                naccept = self.tree_steps[m].naccept
+                start = time.time()
+
             # need to update ybar, yvar values for terminal nodes
-            for leaf in self.trees[m].value.terminalNodes:
-                in_node = self.trees[m].value.filter(leaf)[1]
+            self.trees[m].value.update_moments()
+            if profiler is not None:
+                moments_done = time.time()
 
             # First update the tree configuration using a Metropolis-Hastings step
             self.tree_steps[m].do_step()
+            if profiler is not None:
+                tree_done = time.time()
 
             # Now update the mu values in the terminal nodes for this tree, do a Gibbs update
             self.mus[m].value = self.mus[m].random_posterior()
+            if profiler is not None:
+                operation, failed = self.tree_proposal.last_move
+                profiler.record('tree moments', moments_done - start)
+                profiler.record('tree ' + operation, tree_done - moments_done, self.tree_steps[m].naccept > naccept,
+                                failed)
+                profiler.record('tree mu', time.time() - tree_done)
 
             # Updated tree sum
-            pred = self.node_mu(self.trees[m].value, self.mus[m])
-            treesum += (pred - node_mus[:, m])
-
-            # Make sure the node_mus matrix is updated along with the tree
-            node_mus[:, m] = pred
+            self.fit -= pred
+            self.fit += self.node_mu(self.trees[m].value, self.mus[m])
 
             self.trees[m].y = self.y  # restore original y-values
             self.trees[m].value.y = self.y
 
-        self.resids = self.y - treesum  # save residuals for use by variance parameter object
+        np.subtract(self.y, self.fit, out=self.resids)  # save residuals for use by variance parameter object
 
 
 class BartModel(samplers.Sampler):
     __slots__ = ["X", "y", "n_features", "n_samples", "m", "alpha", "beta", 
-                 "ymin", "ymax", "y", "trees", "mus", "sigsqr", "mcmc_samples", "_logliks"]
+                 "ymin", "ymax", "y", "trees", "mus", "sigsqr", "mcmc_samples", "_logliks", "cutpoints", "archive"]
 
-    def __init__(self, X, y, m=200, alpha=0.95, beta=2.0):
+    def __init__(self, X, y, m=200, alpha=0.95, beta=2.0, numcut=None, archive=None, compress=False):
         """
         Constructor for BART model class. This class will build the BART model and run the MCMC sampler based on this
         model, enabling Bayesian inference.
@@ -776,11 +1468,16 @@ class BartModel(samplers.Sampler):
             the notation of Chipman et al. (2010).
         @param beta: A tree configuration prior parameter, controlling the probability of a terminal node splitting
             given its depth. In the notation of Chipman et al. (2010).
+        @param numcut: If not None, the features are quantized onto a grid of at most this many cutpoints, and the
+            trees are built on the codes of the feature values. The model then stores the codes as self.X instead of
+            the features. See CutpointGrid.
+        @param archive: If not None, the name of a directory. The MCMC samples are then also written to a ForestArchive
+            in this directory as they are generated.
+        @param compress: If true, the MCMC samples in the archive are compressed.
         """
         super(BartModel, self).__init__()
         delattr(self, 'mcmc_samples')  # can't store values in instance of MCMCSample class for BART, so remove it
 
-        self.X = X
         self.y = y.copy()
         self.n_features = X.shape[1]
         self.n_samples = X.shape[0]
@@ -796,6 +1493,15 @@ class BartModel(samplers.Sampler):
         self.ymax = self.y.max()
         self.y = (self.y - self.ymin) / (self.ymax - self.ymin) - 0.5
 
+        # Optionally quantize the features, all of the trees share the matrix of codes. Only the codes are kept, so that
+        # the model does not hold on to the array of features as well.
+        if numcut is None:
+            self.cutpoints = None
+            self.X = X
+        else:
+            self.cutpoints = CutpointGrid(X, numcut)
+            self.X = self.cutpoints.transform(X)
+
         # Build the ensemble of tree configurations and mu values for the terminal nodes
         self.trees = []
         self.mus = []
@@ -804,20 +1510,26 @@ class BartModel(samplers.Sampler):
             mname = 'Mu ' + str(m + 1)
             self.mus.append(BartMeanParameter(mname, self.m))
             self.trees.append(BartTreeParameter(bname, self.X, self.y, self.m, alpha=self.alpha, beta=self.beta,
-                                                prior_mu=self.mus[m].mubar, prior_var=self.mus[m].prior_var))
+                                                prior_mu=self.mus[m].mubar, prior_var=self.mus[m].prior_var,
+                                                cutpoints=self.cutpoints))
 
-        # Create the variance parameter object
-        self.sigsqr = BartVariance(self.X, self.y)
+        # Create the variance parameter object, the features are only used to estimate the prior and are not stored
+        self.sigsqr = BartVariance(X, self.y)
 
         # now construct the MCMC sampler: a sequence of steps
         self._build_sampler()
 
         prior_info = {'alpha': self.alpha, 'beta': self.beta, 'prior_mean': self.mus[0].mubar,
                       'prior_var': self.mus[0].prior_var, 'lamb': self.sigsqr.lamb, 'nu': self.sigsqr.nu}
-        self.mcmc_samples = BartSample(y, m, prior_info, Xtrain=X)  # store MCMC samples in instance of BartSample class
+        # store MCMC samples in instance of BartSample class
+        self.mcmc_samples = BartSample(y, self.m, prior_info, Xtrain=self.X, cutpoints=self.cutpoints)
 
         self._logliks = []
 
+        self.archive = None
+        if archive is not None:
+            self.archive = ForestArchive.create(archive, self.m, self.n_features, self.ymin, self.ymax, compress)
+
     def _build_sampler(self):
         """
         Internal method for building the MCMC sampler. The MCMC sampler consists of a Gibbs update on the variance
@@ -844,38 +1556,449 @@ class BartModel(samplers.Sampler):
             tree.set_starting_value()
         for mu in self.mus:
             mu.set_starting_value()
+        self._steps[1].compute_fit()
         self._allocate_arrays()
         self._burnin_bar.maxval = self.burnin
         self._sampler_bar.maxval = self.sample_size
 
+    def set_temperature(self, temperature):
+        self.sigsqr._temperature = temperature
+        for tree, mu in zip(self.trees, self.mus):
+            tree._temperature = temperature
+            mu._temperature = temperature
+
+    def loglik(self):
+        """
+        Compute the log-likelihood of the (rescaled) response for the current values of the trees, terminal node means,
+        and variance.
+        """
+        resids = self._steps[1].resids
+        sigsqr = self.sigsqr.value
+        return -0.5 * resids.size * np.log(2.0 * np.pi * sigsqr) - 0.5 * resids.dot(resids) / sigsqr
+
+    def get_state(self, journal=None):
+        state = super(BartModel, self).get_state(journal)
+        state['logliks'] = list(self._logliks)
+        return state
+
+    def set_state(self, state):
+        """
+        Restore the state of the sampler from the output of get_state(). If the MCMC samples are archived, then the
+        archive is rewritten from the restored samples, dropping any samples generated after the state was saved.
+
+        @param state: A dictionary returned by get_state().
+        """
+        super(BartModel, self).set_state(state)
+        self._logliks = list(state['logliks'])
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = self.mcmc_samples.save_archive(self.archive.path, self.archive.compress)
+
+    def _sample(self, first, checkpoint, checkpoint_every):
+        """
+        Generate the samples, see Sampler._sample(). The files of the archive are closed when the run is done, or is
+        interrupted. They are opened again if more samples are appended, e.g., by restart().
+        """
+        try:
+            return super(BartModel, self)._sample(first, checkpoint, checkpoint_every)
+        finally:
+            if self.archive is not None:
+                self.archive.close()
+
     def _allocate_arrays(self):
         """
         Build dictionary of saved values from MCMC sampler. This dictionary is stored in an instance of BartSample
-        class.
+        class. Any earlier samples, e.g., from before restart(), are dropped from the saved marginal log-posteriors and
+        from the archive as well.
         """
-        self.mcmc_samples.samples[self.sigsqr.name] = []
+        self._logliks = []
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = ForestArchive.create(self.archive.path, self.m, self.n_features, self.ymin, self.ymax,
+                                                self.archive.compress)
+        self.mcmc_samples.allocate(self.sigsqr.name)
         for tree in self.trees:
-            self.mcmc_samples.samples[tree.name] = []
+            self.mcmc_samples.allocate(tree.name)
         for mu in self.mus:
-            self.mcmc_samples.samples[mu.name] = []
+            self.mcmc_samples.allocate(mu.name)
 
     def save_values(self):
         """
-        Add the current parameter values to the list of MCMC samples.
+        Add the current parameter values to the list of MCMC samples. Most proposed moves of a tree are rejected, so a
+        tree configuration that has not changed since the last sample is not copied again: the samples share the same
+        BaseTree object.
         """
         self.mcmc_samples.samples[self.sigsqr.name].append(self.sigsqr.value)
         marginal_loglik = 0.0
         for tree, mu in zip(self.trees, self.mus):
-            self.mcmc_samples.samples[tree.name].append(tree.value)
-            self.mcmc_samples.samples[mu.name].append(mu.value)
-            marginal_loglik += tree._log_posterior
+            saved_trees = self.mcmc_samples.samples[tree.name]
+            if len(saved_trees) > 0 and saved_trees[-1].version == tree.value.version:
+                # the tree configuration has not changed since the last sample, so share the copy saved then. the
+                # terminal nodes may be listed in a different order, so put the mu values in the order of the copy.
+                snapshot = saved_trees[-1]
+                mu_value = mu.value[tree.value.nodes.pos[snapshot.leaf_indices()]]
+            else:
+                # the tree is updated in place by the sampler, so save a copy of its configuration
+                snapshot = tree.value.snapshot()
+                mu_value = mu.value
+            saved_trees.append(snapshot)
+            self.mcmc_samples.samples[mu.name].append(mu_value)
+            marginal_loglik += tree.logdensity(tree.value)
 
         self._logliks.append(marginal_loglik)  # save marginal log-posteriors for tree configurations
 
+        if self.archive is not None:
+            self.archive.append(self.sigsqr.value, [tree.value for tree in self.trees], [mu.value for mu in self.mus],
+                                self.cutpoints)
+
+
+class ForestArrays(object):
+    """
+    The MCMC samples of one tree in the BART ensemble, compiled into a single set of flat node arrays. The node arrays
+    of each sampled tree configuration are concatenated, with the links to the children shifted by the offset of that
+    configuration, and the mean value of each terminal node is stored with the node. This way the data points can be
+    dropped down all of the sampled configurations at once.
+    """
+    __slots__ = ["feature", "threshold", "left", "right", "value", "roots"]
+
+    def __init__(self, trees, mus):
+        """
+        Constructor for the flat node arrays of the sampled configurations of a tree.
+
+        @param trees: The list of sampled tree configurations, instances of BaseTree.
+        @param mus: The list of sampled mean values of the terminal nodes, one array for each tree configuration.
+        """
+        sizes = np.array([tree.nodes.size for tree in trees], dtype=np.intp)
+        offsets = np.zeros(len(trees), dtype=np.intp)
+        offsets[1:] = np.cumsum(sizes)[:-1]
+        nnodes = sizes.sum()
+
+        self.feature = np.empty(nnodes, dtype=np.intp)
+        self.threshold = np.empty(nnodes, dtype=np.float64)
+        self.left = np.empty(nnodes, dtype=np.intp)
+        self.right = np.empty(nnodes, dtype=np.intp)
+        self.value = np.zeros(nnodes, dtype=np.float64)
+        self.roots = np.empty(len(trees), dtype=np.intp)
+
+        for i, (tree, mu) in enumerate(zip(trees, mus)):
+            nodes = tree.nodes
+            segment = slice(offsets[i], offsets[i] + sizes[i])
+            self.feature[segment] = nodes.feature[:sizes[i]]
+            self.threshold[segment] = nodes.threshold[:sizes[i]]
+            # keep -1 as the marker of a terminal node
+            left = nodes.left[:sizes[i]]
+            right = nodes.right[:sizes[i]]
+            self.left[segment] = np.where(left >= 0, left + offsets[i], -1)
+            self.right[segment] = np.where(right >= 0, right + offsets[i], -1)
+            self.value[offsets[i] + tree.leaf_indices()] = mu
+            self.roots[i] = offsets[i] + tree.head._index
+
+    @staticmethod
+    def view(feature, threshold, left, right, value, roots):
+        """
+        Create a ForestArrays object from existing flat node arrays, e.g., ones read from a ForestArchive. The node
+        arrays may be shared by several ForestArrays objects with different roots.
+
+        @param feature: The feature of the split rule of each node.
+        @param threshold: The threshold of the split rule of each node.
+        @param left: The index of the left child of each node, or -1 for a terminal node.
+        @param right: The index of the right child of each node, or -1 for a terminal node.
+        @param value: The mean value of each terminal node.
+        @param roots: The index of the head node of each sampled tree configuration.
+        """
+        forest = ForestArrays.__new__(ForestArrays)
+        forest.feature = feature
+        forest.threshold = threshold
+        forest.left = left
+        forest.right = right
+        forest.value = value
+        forest.roots = roots
+        return forest
+
+    @property
+    def ndraws(self):
+        return self.roots.size
+
+    def evaluate(self, data, draws=None):
+        """
+        Drop each row of the input predictors down every sampled tree configuration and return the mean value of the
+        terminal node it ends up in. All (row, configuration) pairs are moved down one level at a time.
+
+        @param data: The array of predictors, shape (n, n_features).
+        @param draws: If not None, only evaluate the sampled configurations selected by this index or slice.
+        @return: The values of the tree for each row and each sampled configuration, an (n, ndraws) array.
+        """
+        roots = self.roots if draws is None else np.atleast_1d(self.roots[draws])
+        npredict = data.shape[0]
+        ndraws = roots.size
+        node = np.tile(roots, npredict)  # flattened (npredict, ndraws) array
+        active = np.flatnonzero(self.left[node] >= 0)
+        while active.size > 0:
+            current = node[active]
+            go_left = data[active // ndraws, self.feature[current]] <= self.threshold[current]
+            node[active] = np.where(go_left, self.left[current], self.right[current])
+            active = active[self.left[node[active]] >= 0]
+
+        return self.value[node].reshape(npredict, ndraws)
+
+
+class ForestArchive(object):
+    """
+    Columnar on-disk archive of the MCMC samples of a BART model. Each sampled tree configuration is stored as a
+    compact block of node records holding the feature, threshold, children and terminal node mean of each node, with
+    the head node first and the children indexed within the block. The blocks of all trees in an MCMC sample are
+    concatenated, and the samples are appended to the archive one at a time, e.g., as the sampler runs. The archive is
+    a directory containing the files
+
+        meta.json: The number of trees and features, the scale of the response, and whether blocks are compressed.
+        nodes.bin: The node records of each MCMC sample, optionally zlib-compressed.
+        draws.bin: The byte offset and byte length in nodes.bin of each MCMC sample, as int64.
+        sizes.bin: The number of nodes of each tree in each MCMC sample, as int32.
+        sigsqr.bin: The variance parameter of each MCMC sample, as float64.
+
+    The MCMC samples are only read when needed, and the files are memory-mapped, so that a subset of the samples can
+    be read without loading the whole archive. The thresholds are always stored as feature values, so that the
+    archive does not need the CutpointGrid the trees were built with.
+    """
+    __slots__ = ["path", "m", "n_features", "ymin", "ymax", "compress", "_files"]
+    node_dtype = np.dtype([('feature', '<i4'), ('left', '<i4'), ('right', '<i4'), ('threshold', '<f8'),
+                           ('value', '<f8')])
+    version = 1
+
+    def __init__(self, path):
+        """
+        Open an existing archive of MCMC samples. Use ForestArchive.create() to make a new one.
+
+        @param path: The directory containing the archive.
+        """
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        if meta['version'] != self.version:
+            raise ValueError("Unsupported forest archive version: " + str(meta['version']))
+        self.path = path
+        self.m = meta['m']
+        self.n_features = meta['n_features']
+        self.ymin = meta['ymin']
+        self.ymax = meta['ymax']
+        self.compress = meta['compress']
+        self._files = None  # open file objects for appending, created by append()
+
+    @staticmethod
+    def create(path, m, n_features, ymin, ymax, compress=False):
+        """
+        Create a new, empty archive of MCMC samples.
+
+        @param path: The directory that will contain the archive. It is created if it does not exist.
+        @param m: The number of trees in the BART ensemble.
+        @param n_features: The number of features (covariates) in the model.
+        @param ymin: The minimum of the training values of the response, used to transform the predictions back to the
+            original scale.
+        @param ymax: The maximum of the training values of the response.
+        @param compress: If true, the node records of each MCMC sample are compressed with zlib.
+        @return: The new archive, an instance of ForestArchive.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in ('nodes.bin', 'draws.bin', 'sizes.bin', 'sigsqr.bin'):
+            open(os.path.join(path, name), 'wb').close()
+        meta = {'version': ForestArchive.version, 'm': m, 'n_features': n_features, 'ymin': float(ymin),
+                'ymax': float(ymax), 'compress': bool(compress)}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        return ForestArchive(path)
+
+    @staticmethod
+    def tree_records(tree, mu, cutpoints=None):
+        """
+        Compile a tree configuration into a block of node records.
+
+        @param tree: The tree configuration, an instance of BaseTree.
+        @param mu: The mean values of the terminal nodes of the tree.
+        @param cutpoints: The CutpointGrid used to code the predictors when building the tree, if any.
+        @return: The node records, an array with dtype ForestArchive.node_dtype.
+        """
+        nodes = tree.nodes
+        order = np.fromiter(tree._walk(), dtype=np.intp)
+        local = -np.ones(nodes.capacity, dtype=np.intp)
+        local[order] = np.arange(order.size)
+
+        records = np.zeros(order.size, dtype=ForestArchive.node_dtype)
+        records['feature'] = nodes.feature[order]
+        left = nodes.left[order]
+        internal = left >= 0
+        records['left'] = np.where(internal, local[left], -1)
+        records['right'] = np.where(internal, local[nodes.right[order]], -1)
+        records['threshold'] = nodes.threshold[order]
+        if cutpoints is not None:
+            # translate the split rules on the codes into split rules on the feature values
+            for i in np.flatnonzero(internal):
+                records['threshold'][i] = cutpoints.threshold(records['feature'][i], records['threshold'][i])
+        records['value'][local[tree.leaf_indices()]] = mu
+
+        return records
+
+    def append(self, sigsqr, trees, mus, cutpoints=None):
+        """
+        Append an MCMC sample to the archive. The files are flushed afterwards, so the archive can be read while the
+        sampler is still running.
+
+        @param sigsqr: The value of the variance parameter.
+        @param trees: The list of tree configurations, instances of BaseTree.
+        @param mus: The list of mean values of the terminal nodes of each tree.
+        @param cutpoints: The CutpointGrid used to code the predictors when building the trees, if any.
+        """
+        if len(trees) != self.m:
+            raise ValueError("Expected " + str(self.m) + " trees, got " + str(len(trees)))
+        if self._files is None:
+            self._files = dict((name, open(os.path.join(self.path, name + '.bin'), 'ab'))
+                               for name in ('nodes', 'draws', 'sizes', 'sigsqr'))
+        records = [self.tree_records(tree, mu, cutpoints) for tree, mu in zip(trees, mus)]
+        sizes = np.array([r.size for r in records], dtype='<i4')
+        block = np.concatenate(records).tostring()
+        if self.compress:
+            block = zlib.compress(block)
+
+        nodes = self._files['nodes']
+        nodes.seek(0, os.SEEK_END)
+        offset = nodes.tell()
+        nodes.write(block)
+        nodes.flush()
+        # write the index last, so that a partially written sample is never visible to readers
+        self._files['sizes'].write(sizes.tostring())
+        self._files['sigsqr'].write(np.array([sigsqr], dtype='<f8').tostring())
+        for name in ('sizes', 'sigsqr'):
+            self._files[name].flush()
+        self._files['draws'].write(np.array([offset, len(block)], dtype='<i8').tostring())
+        self._files['draws'].flush()
+
+    def close(self):
+        """
+        Close the files opened for appending MCMC samples.
+        """
+        if self._files is not None:
+            for f in self._files.values():
+                f.close()
+        self._files = None
+
+    def _read(self, name, dtype, shape=None):
+        # memory-map one of the index files, which is empty until the first MCMC sample is appended
+        filename = os.path.join(self.path, name + '.bin')
+        nitems = os.path.getsize(filename) // np.dtype(dtype).itemsize
+        if nitems == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode='r', shape=(nitems,))
+
+    @property
+    def ndraws(self):
+        return os.path.getsize(os.path.join(self.path, 'draws.bin')) // 16
+
+    @property
+    def sigsqr(self):
+        return self._read('sigsqr', '<f8')[:self.ndraws]
+
+    def _draw_indices(self, draws):
+        ndraws = self.ndraws
+        if draws is None:
+            return np.arange(ndraws)
+        if isinstance(draws, slice):
+            return np.arange(*draws.indices(ndraws))
+        return np.atleast_1d(np.asarray(draws, dtype=np.intp))
+
+    def _read_records(self, draws):
+        """
+        Read the node records of a set of MCMC samples. The index files are memory-mapped once. The records of an
+        uncompressed archive are gathered from a single memory map of nodes.bin, so only compressed archives need a loop
+        over the MCMC samples, to decompress their blocks.
+
+        @param draws: The array of indices of the MCMC samples.
+        @return: A tuple containing the node records of all of the trees in all of the MCMC samples, concatenated, and
+            the number of nodes in each tree, an (ndraws, m) array.
+        """
+        index = self._read('draws', '<i8')
+        ndraws = index.size // 2
+        # the sizes of a sample are written before its index entry, so ignore any sizes past the last indexed sample
+        sizes = self._read('sizes', '<i4')[:self.m * ndraws].reshape(ndraws, self.m)[draws].astype(np.intp)
+        index = index[:2 * ndraws].reshape(ndraws, 2)[draws]
+        if draws.size == 0:
+            return np.zeros(0, dtype=self.node_dtype), sizes
+
+        filename = os.path.join(self.path, 'nodes.bin')
+        if self.compress:
+            with open(filename, 'rb') as f:
+                blocks = []
+                for offset, nbytes in index:
+                    f.seek(offset)
+                    blocks.append(np.frombuffer(zlib.decompress(f.read(nbytes)), dtype=self.node_dtype))
+            return np.concatenate(blocks), sizes
+
+        # position of the first record and number of records of each MCMC sample
+        itemsize = self.node_dtype.itemsize
+        first = index[:, 0] // itemsize
+        nrecords = index[:, 1] // itemsize
+        starts = np.zeros(draws.size, dtype=np.intp)
+        starts[1:] = np.cumsum(nrecords)[:-1]
+        rows = np.arange(nrecords.sum()) + np.repeat(first - starts, nrecords)
+        nodes = np.memmap(filename, dtype=self.node_dtype, mode='r')
+        return np.asarray(nodes[rows]), sizes
+
+    def read_draw(self, i):
+        """
+        Read the node records of an MCMC sample.
+
+        @param i: The index of the MCMC sample.
+        @return: A tuple containing the node records of all of the trees, concatenated, and the number of nodes in each
+            tree.
+        """
+        records, sizes = self._read_records(np.array([i], dtype=np.intp))
+        return records, sizes[0]
+
+    def forests(self, draws=None):
+        """
+        Load MCMC samples of the trees into flat node arrays, for evaluating the trees.
+
+        @param draws: The indices or a slice of the MCMC samples to load. If None, all of the samples are loaded.
+        @return: A list containing an instance of ForestArrays for each tree in the ensemble. These share the same node
+            arrays.
+        """
+        records, sizes = self._read_records(self._draw_indices(draws))
+
+        # index of the head node of each tree in each MCMC sample, in the concatenated node records
+        starts = np.zeros(sizes.size, dtype=np.intp)
+        starts[1:] = np.cumsum(sizes.ravel())[:-1]
+        shift = np.repeat(starts, sizes.ravel())
+        left = np.where(records['left'] >= 0, records['left'] + shift, -1)
+        right = np.where(records['right'] >= 0, records['right'] + shift, -1)
+        feature = records['feature'].astype(np.intp)
+        threshold = records['threshold'].copy()
+        value = records['value'].copy()
+        starts = starts.reshape(sizes.shape)
+
+        return [ForestArrays.view(feature, threshold, left, right, value, starts[:, k]) for k in xrange(self.m)]
+
+    def predict(self, X, draws=None):
+        """
+        Predict the value of the response given the input data for each archived MCMC sample.
+
+        @param X: The array of predictors, an (n_predict, n_features) size array of feature values.
+        @param draws: The indices or a slice of the MCMC samples to use. If None, all of the samples are used.
+        @return: The predicted value at the input data for each MCMC sample, an (n_predict, ndraws) array.
+        """
+        ypredict = np.zeros((X.shape[0], self._draw_indices(draws).size))
+        for forest in self.forests(draws):
+            ypredict += forest.evaluate(X)
+
+        # need to translate predicted value to original data scale
+        ypredict *= self.ymax - self.ymin
+        ypredict += self.ymin + 0.5 * (self.ymax - self.ymin)
+
+        return ypredict
+
 
 class BartSample(object):
-    __slots__ = ["Xtrain", "ytrain", "m", "n_features", "n_samples", "ymin", "ymax", "prior_info", "samples"]
-    def __init__(self, ytrain, m, prior_info, Xtrain=None, n_features=None):
+    __slots__ = ["Xtrain", "ytrain", "m", "n_features", "n_samples", "ymin", "ymax", "prior_info", "samples",
+                 "cutpoints", "nchains", "_forests", "_forest_key", "_journal"]
+    def __init__(self, ytrain, m, prior_info, Xtrain=None, n_features=None, cutpoints=None):
         """
         Constructor class used to access and use the MCMC samples for a BART model. This class can be used to directly
         access the values of the BART variance, tree configurations, and means of the terminal nodes. In addition,
@@ -885,8 +2008,10 @@ class BartSample(object):
         @param ytrain: The values of the response used to train the model.
         @param m: The number of tree used in the BART ensemble.
         @param prior_info: A dictionary containing the values of the prior hyperparameters.
-        @param Xtrain: The array of predictors used to train the model.
+        @param Xtrain: The array of predictors used to train the model, as codes of the cutpoints if cutpoints is not
+            None.
         @param n_features: The number of features (covariates) in the model. Must provide if Xtrain is not input.
+        @param cutpoints: The CutpointGrid used to code the predictors when building the trees, if any.
         """
         try:
             (Xtrain is not None) or (n_features is not None)
@@ -896,7 +2021,7 @@ class BartSample(object):
         self.Xtrain = Xtrain
         self.ytrain = ytrain
         self.m = m
-        self.n_features = Xtrain.shape[1]
+        self.n_features = n_features if Xtrain is None else Xtrain.shape[1]
         self.n_samples = ytrain.size
 
         self.ymin = self.ytrain.min()  # needed for translating the BART output to the original data scale
@@ -905,14 +2030,40 @@ class BartSample(object):
         # dictionary containing the values of the prior hyperparameters
         self.prior_info = prior_info
 
+        self.cutpoints = cutpoints  # needed to code new predictors the same way as the training data
+
         self.samples = dict()  # Empty dictionary. We will place the MCMC samples here.
+        self.nchains = 1  # the number of chains the MCMC samples are pooled from, one after the other
+        self._forests = None  # the samples of each tree compiled into ForestArrays, built by compile_forests()
+        self._forest_key = None  # identifies the MCMC samples that self._forests was compiled from
+        self._journal = None  # (file name, number of samples, size in bytes) of the journal of the MCMC samples
 
-    def predict(self, X):
+    def compile_forests(self):
         """
-        Predict the value of the response given the input data for each BART model generated by the MCMC sampler.
+        Compile the MCMC samples of each tree in the ensemble into flat node arrays. The compiled arrays are cached,
+        and only rebuilt if the MCMC samples have changed.
+
+        @return: A list containing an instance of ForestArrays for each tree in the ensemble.
+        """
+        trees = [self.samples['BART ' + str(m+1)] for m in range(self.m)]
+        mus = [self.samples['Mu ' + str(m+1)] for m in range(self.m)]
+        # the key holds on to the lists of MCMC samples and compares them by identity, since the id of a list that has
+        # been freed, e.g., after set_state(), can be reused by a new list
+        key = [(tree_samples, mu_samples, len(tree_samples), len(mu_samples))
+               for tree_samples, mu_samples in zip(trees, mus)]
+        if self._forests is None or any(new[0] is not old[0] or new[1] is not old[1] or new[2:] != old[2:]
+                                        for new, old in zip(key, self._forest_key)):
+            self._forests = [ForestArrays(trees[m], mus[m]) for m in range(self.m)]
+            self._forest_key = key
+
+        return self._forests
+
+    def _check_predictors(self, X):
+        """
+        Make sure the input predictors have the right shape, and code them the same way as the training data.
 
         @param X: The array of predictors, an (n_predict, n_features) size array.
-        @return: The predicted value at the input data for each MCMC sample.
+        @return: The array of predictors used to drop the data down the trees.
         """
         # data needs to be shape (self.npredict, self.nfeatures)
         try:
@@ -920,27 +2071,264 @@ class BartSample(object):
         except ValueError:
             "Input must be an array with n_features columns."
 
-        nmcmc = len(self.samples['sigsqr'])
-        npredict = X.shape[0]
-        ypredict = np.zeros((npredict, nmcmc))
-
-        for i in xrange(nmcmc):
-            for m in range(self.m):
-                tree = self.samples['BART ' + str(m+1)][i]
-                mu = self.samples['Mu ' + str(m+1)][i]
-                n_idx = 0
-                for node in tree.terminalNodes:
-                    # find which terminal node the x-value ends up in
-                    in_node = np.all(tree.plinko(node, X), axis=1)
-                    if sum(in_node) > 0:
-                        ypredict[in_node] += mu[n_idx]  # add value of f(x) for this tree to the ensemble
-                    n_idx += 1
+        if self.cutpoints is not None:
+            X = self.cutpoints.transform(X)
+
+        return X
+
+    def _predict_draws(self, X, draws=None):
+        """
+        Predict the value of the response for each MCMC sample, given predictors that have already been checked by
+        _check_predictors(). If draws is not None, only the MCMC samples selected by this slice are used.
+        """
+        # each tree is evaluated for all of the MCMC samples at once
+        ypredict = None
+        for forest in self.compile_forests():
+            values = forest.evaluate(X, draws)
+            if ypredict is None:
+                ypredict = values
+            else:
+                ypredict += values  # add value of f(x) for this tree to the ensemble
 
         # need to translate predicted value to original data scale
-        ypredict = self.ymin + (self.ymax - self.ymin) * (ypredict + 0.5)
+        ypredict *= self.ymax - self.ymin
+        ypredict += self.ymin + 0.5 * (self.ymax - self.ymin)
 
         return ypredict
 
+    def predict(self, X):
+        """
+        Predict the value of the response given the input data for each BART model generated by the MCMC sampler.
+
+        @param X: The array of predictors, an (n_predict, n_features) size array.
+        @return: The predicted value at the input data for each MCMC sample.
+        """
+        return self._predict_draws(self._check_predictors(X))
+
+    def predict_chunks(self, X, chunk_size=10000, summary='draws', quantiles=(5.0, 50.0, 95.0)):
+        """
+        Predict the value of the response given the input data, processing the rows of the input data in chunks. This
+        is a generator yielding the predictions for one chunk of rows at a time, so the memory used is set by the chunk
+        size and not by the number of rows.
+
+        @param X: The array of predictors, an (n_predict, n_features) size array. This may also be a memory-mapped
+            array, since only one chunk of rows is read at a time.
+        @param chunk_size: The number of rows of X to predict at a time.
+        @param summary: What to yield for each chunk. If 'draws', the predicted value for each MCMC sample, an
+            (chunk_size, nmcmc) array. If 'mean', the posterior mean of the predicted value, an array of size
+            chunk_size. If 'quantiles', the requested quantiles of the predicted value, a (chunk_size, nquantiles)
+            array.
+        @param quantiles: The percentiles to compute when summary is 'quantiles', between 0 and 100.
+        @return: A generator yielding the predictions for each chunk of rows, in order.
+        """
+        if summary not in ('draws', 'mean', 'quantiles'):
+            raise ValueError("summary must be one of 'draws', 'mean' or 'quantiles'.")
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be positive.")
+
+        self.compile_forests()  # compile the trees once, before the first chunk
+        for start in xrange(0, X.shape[0], chunk_size):
+            ypredict = self._predict_draws(self._check_predictors(X[start:start + chunk_size]))
+            if summary == 'mean':
+                yield ypredict.mean(axis=1)
+            elif summary == 'quantiles':
+                yield np.percentile(ypredict, quantiles, axis=1).T
+            else:
+                yield ypredict
+
+    def predict_summary(self, X, percentiles=(5.0, 50.0, 95.0), draw_block=100):
+        """
+        Compute the posterior mean, variance and percentiles of the predicted value of the response given the input
+        data, without storing the predictions for every MCMC sample. The MCMC samples are processed in blocks, and
+        the summaries are updated online, so the memory used is set by the number of rows times draw_block.
+
+        @param X: The array of predictors, an (n_predict, n_features) size array.
+        @param percentiles: The percentiles of the predicted values to estimate, between 0 and 100.
+        @param draw_block: The number of MCMC samples to predict at a time.
+        @return: An instance of misc.RunningSummary, with the posterior mean, variance and estimated percentiles of
+            the predicted value at each row of X.
+        """
+        X = self._check_predictors(X)
+        summary = misc.RunningSummary(X.shape[0], percentiles)
+        nmcmc = len(self.samples['sigsqr'])
+        for start in xrange(0, nmcmc, draw_block):
+            summary.update(self._predict_draws(X, slice(start, start + draw_block)))
+
+        return summary
+
+    def mark_saved(self, nsaved):
+        """
+        Called by the sampler after each MCMC sample is saved. The samples are appended to lists as they are saved, so
+        there is nothing to do.
+        """
+        pass
+
+    def close(self):
+        """
+        Called by the sampler when it is done. The samples are kept in memory, so there is nothing to do.
+        """
+        pass
+
+    def allocate(self, name):
+        """
+        Create the empty list that will hold the MCMC samples of a parameter, and add it to the dictionary of samples.
+
+        @param name: The name of the parameter.
+        @return: The list holding the MCMC samples.
+        """
+        self._journal = None  # the samples are new, so the samples in the journal are no longer valid
+        self.samples[name] = []
+        return self.samples[name]
+
+    def _encode(self, first, last):
+        """
+        Encode the MCMC samples first to last as a dictionary of lists of values and of tree configurations. A tree
+        configuration shared by several MCMC samples is only included once, and one shared with MCMC sample first - 1
+        is given the index -1.
+        """
+        chunk = {'values': dict(), 'trees': dict()}
+        for name, values in self.samples.items():
+            if len(values) > 0 and isinstance(values[0], BaseTree):
+                configurations = []
+                index = np.empty(last - first, dtype=np.intp)
+                position = dict()  # position of each distinct tree object in the list of configurations
+                if first > 0:
+                    position[id(values[first - 1])] = -1
+                for i in xrange(first, last):
+                    tree = values[i]
+                    if id(tree) not in position:
+                        position[id(tree)] = len(configurations)
+                        configurations.append(tree.get_state())
+                    index[i - first] = position[id(tree)]
+                chunk['trees'][name] = (configurations, index)
+            else:
+                chunk['values'][name] = list(values[first:last])
+
+        return chunk
+
+    def _decode(self, chunk):
+        """
+        Append the MCMC samples encoded by _encode() to the dictionary of samples.
+        """
+        for name, values in chunk['values'].items():
+            self.samples.setdefault(name, []).extend(values)
+        for name, (configurations, index) in chunk['trees'].items():
+            samples = self.samples.setdefault(name, [])
+            trees = [BaseTree.from_state(configuration, self.cutpoints) for configuration in configurations]
+            if len(samples) > 0:
+                trees.append(samples[-1])  # index -1 is the tree configuration of the previous MCMC sample
+            samples.extend(trees[i] for i in index)
+
+    def get_state(self, journal=None):
+        """
+        Return the MCMC samples as a dictionary, e.g., for saving them in a checkpoint. A tree configuration shared by
+        several MCMC samples is only included once.
+
+        @param journal: If not None, the name of a file where the MCMC samples are journaled. Only the MCMC samples
+            saved since the last call with the same journal are appended to it, and the returned dictionary holds the
+            size of the journal instead of the MCMC samples.
+        @return: A dictionary containing the MCMC samples.
+        """
+        nsaved = len(self.samples.get('sigsqr', []))
+        state = {'nsaved': nsaved, 'nchains': self.nchains}
+        if journal is None:
+            state.update(self._encode(0, nsaved))
+            return state
+
+        first, offset = 0, 0
+        if self._journal is not None and self._journal[0] == journal:
+            first, offset = self._journal[1:]
+        self._journal = (journal, nsaved, samplers._append_journal(journal, offset, self._encode(first, nsaved)))
+        state['journal'] = self._journal
+
+        return state
+
+    def set_state(self, state):
+        """
+        Restore the MCMC samples from the output of get_state().
+
+        @param state: A dictionary returned by get_state().
+        """
+        self.samples = dict()
+        self._journal = state.get('journal')
+        if self._journal is None:
+            self._decode(state)
+        else:
+            for chunk in samplers._read_journal(self._journal[0], self._journal[2]):
+                self._decode(chunk)
+        self.nchains = state['nchains']
+        self._forests = None
+        self._forest_key = None
+
+    def get_chains(self, name):
+        """
+        Return the MCMC samples of a parameter for each chain separately.
+
+        @param name: The name of the parameter, e.g., 'sigsqr' or 'BART 1'.
+        @return: A list containing the list of MCMC samples of each chain.
+        """
+        values = self.samples[name]
+        nsamples = len(values) // self.nchains
+        return [values[chain * nsamples:(chain + 1) * nsamples] for chain in range(self.nchains)]
+
+    @staticmethod
+    def merge_chains(chains):
+        """
+        Merge the MCMC samples of several chains of the same BART model, e.g., from samplers.run_chains(), into a single
+        object. The samples of each chain are stored one after the other, so the predictions use the pooled samples.
+
+        @param chains: The list of BartSample objects, one for each chain. They must have the same number of samples.
+        @return: A new BartSample object.
+        """
+        nsamples = len(chains[0].samples['sigsqr'])
+        if any(len(bart_sample.samples['sigsqr']) != nsamples for bart_sample in chains):
+            raise ValueError("All chains must have the same number of samples.")
+        first = chains[0]
+        merged = BartSample(first.ytrain, first.m, first.prior_info, Xtrain=first.Xtrain, cutpoints=first.cutpoints)
+        for name in first.samples:
+            merged.samples[name] = [value for bart_sample in chains for value in bart_sample.samples[name]]
+        merged.nchains = sum(bart_sample.nchains for bart_sample in chains)
+
+        return merged
+
+    @staticmethod
+    def merge_replicas(replicas, indices):
+        """
+        Merge the MCMC samples of the untempered chain saved by the replicas of a ParallelTempering sampler.
+
+        @param replicas: The list of BartSample objects of each replica.
+        @param indices: The list of the indices of the MCMC samples saved by each replica.
+        @return: A new BartSample object.
+        """
+        first = replicas[0]
+        merged = BartSample(first.ytrain, first.m, first.prior_info, Xtrain=first.Xtrain, cutpoints=first.cutpoints)
+        nsamples = sum(len(replica_indices) for replica_indices in indices)
+        for name in first.samples:
+            values = [None] * nsamples
+            for bart_sample, replica_indices in zip(replicas, indices):
+                for value, i in zip(bart_sample.samples[name], replica_indices):
+                    values[i] = value
+            merged.samples[name] = values
+
+        return merged
+
+    def save_archive(self, path, compress=False):
+        """
+        Write the MCMC samples to a ForestArchive.
+
+        @param path: The directory that will contain the archive.
+        @param compress: If true, the MCMC samples in the archive are compressed.
+        @return: The archive, an instance of ForestArchive.
+        """
+        archive = ForestArchive.create(path, self.m, self.n_features, self.ymin, self.ymax, compress)
+        for i in xrange(len(self.samples['sigsqr'])):
+            trees = [self.samples['BART ' + str(m+1)][i] for m in range(self.m)]
+            mus = [self.samples['Mu ' + str(m+1)][i] for m in range(self.m)]
+            archive.append(self.samples['sigsqr'][i], trees, mus, self.cutpoints)
+        archive.close()
+
+        return archive
+
     def feature_importance(self):
         pass
 